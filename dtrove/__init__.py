@@ -13,11 +13,14 @@ To modify any of these values simply edit your django settings file.
 from __future__ import absolute_import
 
 import logging
+import os
+import tempfile
 
 from django.conf import settings
 
 # The celery app must be loaded here to make the @shared_task decorator work.
 from .celery import app as celery_app
+from . import celery as _celery
 
 
 def _get(name, default=None, warn=False):
@@ -27,11 +30,11 @@ def _get(name, default=None, warn=False):
     return getattr(settings, name, default)
 
 
+default_app_config = 'dtrove.apps.DtroveConfig'
+
 # Default set of datastore managers used in choice field
 _MANAGERS = [
     ('dtrove.datastores.mysql.MySQLManager', 'mysql'),
-    ('dtrove.datastores.redis.RedisManager', 'redis'),
-    ('dtrove.datastores.pgsql.PostgresManager', 'postgres')
 ]
 
 
@@ -60,10 +63,20 @@ class config():
     #: Type of the nova endpoint.
     OS_NOVA_ENDPOINT_TYPE = _get('OS_NOVA_ENDPOINT_TYPE', 'publicURL')
 
+    #: Seconds before the keystone token expires that a new one is fetched.
+    OS_TOKEN_STALE_DURATION = _get('OS_TOKEN_STALE_DURATION', 300)
+
+    #: Seconds a worker holds the lock while fetching a new keystone token,
+    #: the other workers wait at most this long for the shared token.
+    OS_TOKEN_LOCK_TIMEOUT = _get('OS_TOKEN_LOCK_TIMEOUT', 10)
+
     #: List of available datastores. This should be a list of tuples::
     #:
     #:     [('path.to.Manager', 'manager_name'), ...]
     #:
+    #: Every manager is imported when the app starts, a missing one stops
+    #: the process with an `ImproperlyConfigured` error.
+    #:
     DTROVE_DATASTORE_MANAGERS = _get('DTROVE_DATASTORE_MANAGERS', _MANAGERS)
 
     #: Prefix for the remote commands this has access to all the instance
@@ -73,6 +86,100 @@ class config():
     #:
     DTROVE_PREFIX = _get('DTROVE_PREFIX', 'sudo ')
 
+    #: Number of items in a page of the list api views
+    DTROVE_API_PAGE_SIZE = _get('DTROVE_API_PAGE_SIZE', 100)
+
+    #: Max page size a client can ask for with the `page_size` parameter
+    DTROVE_API_MAX_PAGE_SIZE = _get('DTROVE_API_MAX_PAGE_SIZE', 1000)
+
+    #: Seconds the events of the cluster change feed are kept
+    DTROVE_FEED_TTL = _get('DTROVE_FEED_TTL', 600)
+
+    #: Max number of events that are sent to a watcher at once
+    DTROVE_FEED_BACKLOG = _get('DTROVE_FEED_BACKLOG', 1000)
+
+    #: Seconds between the checks of the change feed for new events
+    DTROVE_FEED_INTERVAL = _get('DTROVE_FEED_INTERVAL', 0.5)
+
+    #: Seconds a long poll waits for new events before returning empty
+    DTROVE_FEED_WAIT = _get('DTROVE_FEED_WAIT', 30)
+
+    #: Seconds an event stream stays open, clients reconnect after this
+    DTROVE_FEED_STREAM_TIMEOUT = _get('DTROVE_FEED_STREAM_TIMEOUT', 300)
+
+    #: Seconds after which an event that is missing from the feed while
+    #: newer ones are there is taken as lost rather than still being written
+    DTROVE_FEED_GAP_TIMEOUT = _get('DTROVE_FEED_GAP_TIMEOUT', 5)
+
+    #: Options of the fake nova api, see :py:mod:`dtrove.simulator`
+    DTROVE_FAKE_NOVA = _get('DTROVE_FAKE_NOVA', {})
+
+    #: Seconds a process buffers its metrics before adding them to the
+    #: totals in the cache, see :py:mod:`dtrove.metrics`
+    DTROVE_METRICS_FLUSH_INTERVAL = _get('DTROVE_METRICS_FLUSH_INTERVAL', 10)
+
+    #: Record the stages of every build, see :py:mod:`dtrove.tracing`
+    DTROVE_TRACE = _get('DTROVE_TRACE', True)
+
+    #: Number of spans a process buffers before writing them
+    DTROVE_TRACE_BUFFER_SIZE = _get('DTROVE_TRACE_BUFFER_SIZE', 100)
+
+    #: Names of the celery tasks to always run under the profiler, ie
+    #: `('dtrove.tasks.prepare',)`. Use `manage.py profile_report` to read
+    #: the results.
+    DTROVE_PROFILE_TASKS = _get('DTROVE_PROFILE_TASKS', ())
+
+    #: Fraction of all the other tasks to profile, between 0 and 1
+    DTROVE_PROFILE_RATE = _get('DTROVE_PROFILE_RATE', 0)
+
+    #: Directory the task profiles are written to
+    DTROVE_PROFILE_DIR = _get('DTROVE_PROFILE_DIR',
+                              os.path.join(tempfile.gettempdir(),
+                                           'dtrove-profiles'))
+
+    #: Max bytes of profiles to keep, the oldest are removed first
+    DTROVE_PROFILE_MAX_BYTES = _get('DTROVE_PROFILE_MAX_BYTES', 100 * 2 ** 20)
+
+    #: Requests the workers may make to each kind of cloud api endpoint, a
+    #: dict of name to a tuple of (requests, seconds). The provider uses
+    #: 'create' for calls that change things and 'read' for the rest,
+    #: endpoints that are not listed are not paced. See
+    #: :py:mod:`dtrove.ratelimit`.
+    DTROVE_RATE_LIMITS = _get('DTROVE_RATE_LIMITS', {})
+
+    #: Max seconds a call waits for the rate limit before giving up
+    DTROVE_RATE_LIMIT_MAX_WAIT = _get('DTROVE_RATE_LIMIT_MAX_WAIT', 120)
+
+    #: Times a call is retried after the api answered with a 413 or 429
+    DTROVE_RATE_LIMIT_RETRIES = _get('DTROVE_RATE_LIMIT_RETRIES', 3)
+
+    #: Fraction of the rate limit budget that comes back every window
+    #: after it was cut by a 413 or 429 response
+    DTROVE_RATE_LIMIT_RECOVERY = _get('DTROVE_RATE_LIMIT_RECOVERY', 0.1)
+
+    #: Queue of each celery task, a dict of task name to queue name. Tasks
+    #: that are not listed go to the default celery queue.
+    DTROVE_TASK_ROUTES = _get('DTROVE_TASK_ROUTES', _celery.TASK_ROUTES)
+
+    #: Priority of each celery task within its queue, 0 to 9 (highest)
+    DTROVE_TASK_PRIORITIES = _get('DTROVE_TASK_PRIORITIES',
+                                  _celery.TASK_PRIORITIES)
+
+    #: Kinds of workers, a dict of name to the `queues` to consume and
+    #: optionally the `concurrency` and `prefetch_multiplier` to use::
+    #:
+    #:     {'prepare': {'queues': ['dtrove.prepare'], 'concurrency': 16,
+    #:                  'prefetch_multiplier': 1}, ...}
+    #:
+    DTROVE_WORKER_PROFILES = _get('DTROVE_WORKER_PROFILES',
+                                  _celery.WORKER_PROFILES)
+
+    #: Profile of the workers started with these settings, the
+    #: `DTROVE_WORKER_PROFILE` environment variable wins. Options given on
+    #: the worker command line win over the profile. Without one a worker
+    #: consumes every queue.
+    DTROVE_WORKER_PROFILE = _get('DTROVE_WORKER_PROFILE')
+
     #: The :ref:`providers` that you have enabled.
     DTROVE_PROVIDER = _get('DTROVE_PROVIDER',
                            'dtrove.providers.openstack.Provider')
@@ -80,5 +187,77 @@ class config():
     #: Default SSH user to use when connecting to hosts
     DTROVE_SSH_USER = _get('DTROVE_SSH_USER', 'root')
 
+    #: Max number of ssh connections each worker process keeps open
+    DTROVE_SSH_POOL_SIZE = _get('DTROVE_SSH_POOL_SIZE', 20)
+
+    #: Seconds an unused ssh connection is kept open
+    DTROVE_SSH_IDLE_TIMEOUT = _get('DTROVE_SSH_IDLE_TIMEOUT', 300)
+
+    #: Seconds to wait for an ssh connection to open
+    DTROVE_SSH_TIMEOUT = _get('DTROVE_SSH_TIMEOUT', 30)
+
+    #: Minutes the apt package lists on a host are considered fresh, newer
+    #: lists are not updated again before installing packages.
+    DTROVE_APT_LISTS_MAX_AGE = _get('DTROVE_APT_LISTS_MAX_AGE', 60)
+
+    #: Max number of hosts a command runs on at once with `preform_cluster`
+    DTROVE_PREFORM_PARALLEL = _get('DTROVE_PREFORM_PARALLEL', 10)
+
+    #: Type of ssh keys to generate, either 'rsa' or 'ed25519'. Ed25519
+    #: keys are much faster to generate but need the `cryptography` package.
+    DTROVE_SSH_KEY_TYPE = _get('DTROVE_SSH_KEY_TYPE', 'rsa')
+
+    #: Number of unassigned ssh keys to keep ready for new instances
+    DTROVE_KEY_POOL_SIZE = _get('DTROVE_KEY_POOL_SIZE', 10)
+
+    #: Seconds between refills of the ssh key pool
+    DTROVE_KEY_POOL_INTERVAL = _get('DTROVE_KEY_POOL_INTERVAL', 60)
+
+    #: Seconds the count of queued `generate_key` tasks is kept, after
+    #: that the pool is refilled from the number of keys alone
+    DTROVE_KEY_POOL_PENDING_TIMEOUT = _get('DTROVE_KEY_POOL_PENDING_TIMEOUT',
+                                           600)
+
+    #: Number of pooled keys to try before generating one inline
+    DTROVE_KEY_POOL_CLAIM_TRIES = _get('DTROVE_KEY_POOL_CLAIM_TRIES', 5)
+
+    #: Max number of nodes that are destroyed at once when a cluster shrinks
+    DTROVE_DESTROY_PARALLEL = _get('DTROVE_DESTROY_PARALLEL', 10)
+
+    #: Seconds to wait for a server to be deleted before giving up on it
+    DTROVE_DESTROY_TIMEOUT = _get('DTROVE_DESTROY_TIMEOUT', 600)
+
     #: Max number of nodes in a cluster
     DTROVE_MAX_CLUSTER_SIZE = _get('DTROVE_MAX_CLUSTER_SIZE', 5)
+
+    #: Seconds to wait before the first check of a building server, the
+    #: wait doubles after every check.
+    DTROVE_BUILD_POLL_DELAY = _get('DTROVE_BUILD_POLL_DELAY', 5)
+
+    #: Max seconds to wait between checks of a building server
+    DTROVE_BUILD_POLL_MAX_DELAY = _get('DTROVE_BUILD_POLL_MAX_DELAY', 60)
+
+    #: Seconds to wait for a server to build before giving up on it
+    DTROVE_BUILD_TIMEOUT = _get('DTROVE_BUILD_TIMEOUT', 1800)
+
+    #: Seconds between the bulk status polls of building servers
+    DTROVE_POLL_INTERVAL = _get('DTROVE_POLL_INTERVAL', 10)
+
+    #: Seconds a state record written by the bulk poll is trusted, a build
+    #: check asks nova for the server directly once its record is older.
+    DTROVE_STATE_MAX_AGE = _get('DTROVE_STATE_MAX_AGE', 30)
+
+    #: Seconds a writer holds the lock of a state record, a crashed writer
+    #: holds up the others at most this long.
+    DTROVE_STATE_LOCK_TIMEOUT = _get('DTROVE_STATE_LOCK_TIMEOUT', 5)
+
+    #: Prefix of the names of the nova servers dtrove boots, the bulk poll
+    #: only lists the servers with this prefix
+    DTROVE_SERVER_PREFIX = _get('DTROVE_SERVER_PREFIX', 'dtrove-')
+
+    #: Number of servers to ask for per page of the bulk poll, nova may
+    #: return fewer when its `osapi_max_limit` is lower
+    DTROVE_LIST_PAGE_SIZE = _get('DTROVE_LIST_PAGE_SIZE', 1000)
+
+    #: Server statuses that no longer need to be polled
+    DTROVE_POLL_DONE = _get('DTROVE_POLL_DONE', ('active', 'error'))
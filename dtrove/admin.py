@@ -1,8 +1,8 @@
 
 from django.contrib import admin
-from .models import Datastore, Cluster, Key, Instance
+from .models import Datastore, Cluster, Key, Instance, Span
 
 
-@admin.register(Datastore, Cluster, Key, Instance)
+@admin.register(Datastore, Cluster, Key, Instance, Span)
 class DtroveAdmin(admin.ModelAdmin):
     pass
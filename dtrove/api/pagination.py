@@ -0,0 +1,84 @@
+"""
+Pagination
+==========
+
+The list views return a page of results and a link to the next page::
+
+    {
+        "next": "http://dtrove/api/clusters?cursor=MTAw",
+        "results": [...]
+    }
+
+The cursor is the position of the last item of the page, it stays valid
+while items are added or removed so clients never skip or repeat an item.
+Pass `page_size` to change the number of items in a page up to
+:py:attr:`dtrove.config.DTROVE_API_MAX_PAGE_SIZE`.
+"""
+
+import base64
+
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from rest_framework.templatetags.rest_framework import replace_query_param
+
+from dtrove import config
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(str(pk)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    cursor = str(cursor)
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ParseError('Invalid cursor')
+
+
+class CursorPaginationMixin(object):
+    """List view that pages through the queryset ordered by pk
+
+    :param values_serializer: :py:class:`ValuesSerializer` subclass that
+                              renders the rows of the page
+    """
+
+    values_serializer = None
+    cursor_param = 'cursor'
+    page_size_param = 'page_size'
+
+    def get_page_size(self):
+        page_size = self.request.QUERY_PARAMS.get(self.page_size_param)
+        if page_size is None:
+            return config.DTROVE_API_PAGE_SIZE
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            raise ParseError('Invalid page size')
+        if page_size < 1:
+            raise ParseError('Invalid page size')
+        return min(page_size, config.DTROVE_API_MAX_PAGE_SIZE)
+
+    def list(self, request, *args, **kwargs):
+        page_size = self.get_page_size()
+        queryset = self.get_queryset().order_by('pk')
+        cursor = request.QUERY_PARAMS.get(self.cursor_param)
+        if cursor:
+            queryset = queryset.filter(pk__gt=decode_cursor(cursor))
+
+        serializer = self.values_serializer(
+            queryset, context=self.get_serializer_context())
+        # One extra row tells us if there is a next page
+        rows = serializer.fetch(page_size + 1)
+
+        next_url = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), self.cursor_param,
+                encode_cursor(rows[-1]['id']))
+
+        return Response({
+            'next': next_url,
+            'results': [serializer.to_native(row) for row in rows],
+        })
@@ -6,6 +6,7 @@ Turn our models into objects that are consumed by the api routes.
 """
 
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
 from dtrove.models import Cluster, Instance, Datastore
 
@@ -26,3 +27,61 @@ class ClusterSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cluster
         fields = ['id', 'name', 'size', 'datastore', 'datastore_id', 'created']
+
+
+class ValuesSerializer(object):
+    """Render `values()` rows without building model instances
+
+    This is the fast path of the list views, the rows must match the output
+    of the model serializer for the same objects.
+
+    :param queryset: The queryset to read the rows from
+    :param dict context: The serializer context with the request
+    """
+
+    #: Lookups that are passed to `values()`
+    fields = ()
+
+    def __init__(self, queryset, context=None):
+        self.queryset = queryset
+        self.context = context or {}
+
+    def fetch(self, limit):
+        """Read at most `limit` rows"""
+        return list(self.queryset.values(*self.fields)[:limit])
+
+    def to_native(self, row):
+        raise NotImplementedError()
+
+
+class DatastoreValuesSerializer(ValuesSerializer):
+    fields = ('id', 'manager_class', 'version')
+
+    def datastore(self, pk, manager_class, version):
+        return {
+            'id': pk,
+            'name': Datastore.format_name(manager_class, version),
+            'version': version,
+            'url': reverse('datastore-detail', kwargs={'pk': pk},
+                           request=self.context.get('request')),
+        }
+
+    def to_native(self, row):
+        return self.datastore(row['id'], row['manager_class'],
+                              row['version'])
+
+
+class ClusterValuesSerializer(DatastoreValuesSerializer):
+    fields = ('id', 'name', 'size', 'created', 'datastore_id',
+              'datastore__manager_class', 'datastore__version')
+
+    def to_native(self, row):
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'size': row['size'],
+            'datastore': self.datastore(row['datastore_id'],
+                                        row['datastore__manager_class'],
+                                        row['datastore__version']),
+            'created': row['created'],
+        }
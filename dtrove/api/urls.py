@@ -1,7 +1,8 @@
 from django.conf.urls import patterns, url, include
 
 from .views import DatastoreDetail, DatastoreList
-from .views import ClusterDetail, ClusterList
+from .views import ClusterDetail, ClusterEvents, ClusterInstances
+from .views import ClusterList, ClusterResize, ClusterTimeline
 
 
 datastore_urls = patterns(
@@ -13,6 +14,14 @@ datastore_urls = patterns(
 cluster_urls = patterns(
     '',
     url(r'^/(?P<pk>\d+)$', ClusterDetail.as_view(), name='cluster-detail'),
+    url(r'^/(?P<pk>\d+)/instances$', ClusterInstances.as_view(),
+        name='cluster-instances'),
+    url(r'^/(?P<pk>\d+)/events$', ClusterEvents.as_view(),
+        name='cluster-events'),
+    url(r'^/(?P<pk>\d+)/timeline$', ClusterTimeline.as_view(),
+        name='cluster-timeline'),
+    url(r'^/(?P<pk>\d+)/resize$', ClusterResize.as_view(),
+        name='cluster-resize'),
     url(r'^$', ClusterList.as_view(), name='cluster-list')
 )
 
@@ -3,17 +3,33 @@ API Views
 =========
 
 Mapping models and serialisers to Views.
+
+The list views are paged with a cursor, see `dtrove.api.pagination`, and
+read plain `values()` rows so a page costs a single query.
 """
 
-from rest_framework import generics, permissions
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.http import StreamingHttpResponse
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
+from dtrove import config, feed
 from dtrove.models import Datastore, Cluster
+from .pagination import CursorPaginationMixin
 from .serializers import DatastoreSerializer, ClusterSerializer
+from .serializers import DatastoreValuesSerializer, ClusterValuesSerializer
 
 
-class DatastoreList(generics.ListAPIView):
+class DatastoreList(CursorPaginationMixin, generics.ListAPIView):
     model = Datastore
     serializer_class = DatastoreSerializer
+    values_serializer = DatastoreValuesSerializer
     permission_classes = [
         permissions.AllowAny
     ]
@@ -24,14 +40,186 @@ class DatastoreDetail(generics.RetrieveAPIView):
     serializer_class = DatastoreSerializer
 
 
-class ClusterList(generics.ListCreateAPIView):
-    model = Cluster
+class ClusterList(CursorPaginationMixin, generics.ListCreateAPIView):
+    queryset = Cluster.objects.select_related('datastore')
     serializer_class = ClusterSerializer
+    values_serializer = ClusterValuesSerializer
     permission_classes = [
         permissions.AllowAny
     ]
 
 
 class ClusterDetail(generics.RetrieveAPIView):
-    model = Cluster
+    queryset = Cluster.objects.select_related('datastore')
     serializer_class = ClusterSerializer
+
+
+class ClusterInstances(generics.GenericAPIView):
+    """Status of every node in a cluster
+
+    The state is read from the cache in one call, nodes that are not cached
+    yet are 'unknown' until the refresh that this queues has run.
+    """
+    queryset = Cluster.objects.all()
+    permission_classes = [
+        permissions.AllowAny
+    ]
+
+    def get(self, request, *args, **kwargs):
+        cluster = self.get_object()
+        nodes = cluster.node_states()
+        state, progress = Cluster.aggregate(nodes)
+        return Response({
+            'id': cluster.pk,
+            'status': state,
+            'progress': progress,
+            'instances': nodes,
+        })
+
+
+class ClusterTimeline(generics.GenericAPIView):
+    """Waterfall of the recorded build stages of a cluster
+
+    ::
+
+        {"id": 1, "started": "...", "duration": 312.5,
+         "stages": {"boot": {"count": 3, "errors": 0, "mean": 4.1,
+                             "max": 5.2}, ...},
+         "hosts": [{"instance": 1, "name": "...", "duration": 300.1,
+                    "spans": [{"stage": "boot", "offset": 0.2,
+                               "duration": 4.1, "outcome": "ok",
+                               "message": ""}, ...]}]}
+
+    See :py:mod:`dtrove.tracing` for the stages.
+    """
+    queryset = Cluster.objects.all()
+    permission_classes = [
+        permissions.AllowAny
+    ]
+
+    def get(self, request, *args, **kwargs):
+        cluster = self.get_object()
+        timeline = cluster.timeline()
+        timeline['id'] = cluster.pk
+        return Response(timeline)
+
+
+class ClusterResize(generics.GenericAPIView):
+    """Grow or shrink a cluster
+
+    POST the new number of nodes::
+
+        {"size": 3}
+
+    The nodes are added or removed in the background, the response lists
+    the ids of the nodes that are being added and removed::
+
+        {"id": 1, "size": 3, "added": [7], "removed": []}
+
+    See :py:meth:`dtrove.models.Cluster.resize`.
+    """
+    queryset = Cluster.objects.all()
+    permission_classes = [
+        permissions.AllowAny
+    ]
+
+    def post(self, request, *args, **kwargs):
+        cluster = self.get_object()
+        try:
+            size = int(request.DATA.get('size'))
+        except (TypeError, ValueError):
+            return Response({'size': ['A valid integer is required.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            added, removed = cluster.resize(size)
+        except ValidationError as exc:
+            return Response({'size': exc.messages},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'id': cluster.pk,
+            'size': size,
+            'added': added,
+            'removed': removed,
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets clients ask for `text/event-stream`
+
+    The events are streamed by the view, this only renders errors.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return 'event: error\ndata: %s\n\n' % json.dumps(data)
+
+
+class ClusterEvents(generics.GenericAPIView):
+    """State changes of the nodes in a cluster as they happen
+
+    Clients that accept `text/event-stream` get a server sent event stream,
+    everyone else gets a long poll that returns as soon as there are new
+    events::
+
+        {"last": 12, "events": [{"seq": 12, "instance": 1, ...}]}
+
+    Pass the `last` value back as `after` (or the `Last-Event-ID` header)
+    to continue from there. Without it only the changes from now on are
+    returned. The events are read from the :py:mod:`dtrove.feed` of the
+    cluster so watching costs no database queries, but every watcher holds
+    a web worker while it waits, see the feed docs for the limits.
+    """
+    queryset = Cluster.objects.all()
+    renderer_classes = (list(api_settings.DEFAULT_RENDERER_CLASSES) +
+                        [EventStreamRenderer])
+    permission_classes = [
+        permissions.AllowAny
+    ]
+
+    def get_after(self, request, channel):
+        after = request.META.get('HTTP_LAST_EVENT_ID',
+                                 request.QUERY_PARAMS.get('after'))
+        if after is None:
+            return feed.current(channel)
+        try:
+            return int(after)
+        except ValueError:
+            raise ParseError('Invalid event id')
+
+    def get_timeout(self, request):
+        timeout = request.QUERY_PARAMS.get('timeout', config.DTROVE_FEED_WAIT)
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            raise ParseError('Invalid timeout')
+        return max(0, min(timeout, config.DTROVE_FEED_WAIT))
+
+    def stream(self, channel, after):
+        deadline = time.time() + config.DTROVE_FEED_STREAM_TIMEOUT
+        yield 'retry: 1000\n\n'
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            after, events = feed.wait(
+                channel, after, min(remaining, config.DTROVE_FEED_WAIT))
+            if not events:
+                # Keep proxies from closing an idle connection
+                yield ': keepalive\n\n'
+            for event in events:
+                yield 'id: %d\nevent: state\ndata: %s\n\n' % (
+                    event['seq'], json.dumps(event))
+
+    def get(self, request, *args, **kwargs):
+        cluster = self.get_object()
+        after = self.get_after(request, cluster.pk)
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            response = StreamingHttpResponse(
+                self.stream(cluster.pk, after),
+                content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        last, events = feed.wait(cluster.pk, after, self.get_timeout(request))
+        return Response({'last': last, 'events': events})
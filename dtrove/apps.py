@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class DtroveConfig(AppConfig):
+    name = 'dtrove'
+    verbose_name = 'Dtrove'
+
+    def ready(self):
+        # Fail on a bad DTROVE_DATASTORE_MANAGERS setting at startup
+        from dtrove.datastores import load_managers
+        load_managers()
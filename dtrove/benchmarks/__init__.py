@@ -0,0 +1,14 @@
+"""
+Benchmarks
+==========
+
+Repeatable measurements of the hot paths in dtrove. Each module in this
+package exposes a ``run(**options)`` function that returns a dictionary of
+results, they are run with the `benchmark` management command::
+
+    $ python manage.py benchmark nova_clients
+
+The benchmarks run against a throw away test database and the fake
+openstack endpoints in :py:mod:`dtrove.views` so they never touch a real
+cloud.
+"""
@@ -0,0 +1,294 @@
+"""
+Helpers shared by the benchmarks.
+"""
+
+import math
+import socket
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from functools import wraps
+from wsgiref.simple_server import make_server, ServerHandler
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Request handler that doesn't log every request to stderr."""
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+
+class KeepAliveHandler(QuietHandler):
+    """Answer many requests on one HTTP/1.1 connection like nova does
+
+    The wsgiref handler speaks HTTP/1.0 and closes the connection after
+    every request, which would make the clients open a new one each time.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and body of a response in one packet
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # Keep reading requests until the client closes the connection
+        BaseHTTPRequestHandler.handle(self)
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        handler = KeepAliveServerHandler(self.rfile, self.wfile,
+                                         self.get_stderr(),
+                                         self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+
+class ThreadedServer(ThreadingMixIn, WSGIServer):
+    """Serve every connection in its own thread, an idle keep-alive
+    connection would block the others otherwise."""
+    daemon_threads = True
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        WSGIServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """Hang up on the clients that are still connected"""
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def buffered(application):
+    """Answer with a single string so the response has a Content-Length,
+    the clients can't tell where a keep-alive response ends without it."""
+
+    def wrapper(environ, start_response):
+        result = application(environ, start_response)
+        try:
+            return [b''.join(result)]
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    return wrapper
+
+
+@contextmanager
+def test_database(verbosity=0):
+    """Create a test database for the length of the benchmark."""
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from django.test.utils import teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity,
+                                       autoclobber=True,
+                                       serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        teardown_test_environment()
+
+
+@contextmanager
+def fake_cloud(latency=0):
+    """Serve the fake openstack endpoints on a local port.
+
+    Yields the base url of the server, the keystone endpoint is available
+    at `<url>/osauth/v2.0`. Connections are kept open between requests.
+
+    :param float latency: Seconds to wait before answering each request
+    """
+    from django.core.wsgi import get_wsgi_application
+
+    application = get_wsgi_application()
+
+    def slow_application(environ, start_response):
+        time.sleep(latency)
+        return application(environ, start_response)
+
+    server = make_server('127.0.0.1', 0,
+                         buffered(slow_application if latency
+                                  else application),
+                         server_class=ThreadedServer,
+                         handler_class=KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_port
+    finally:
+        server.shutdown()
+        server.close_connections()
+        server.server_close()
+
+
+class Counter(object):
+    """Count the calls made to a function.
+
+    Use :py:meth:`patch` to swap out an attribute on an object for a
+    counting wrapper::
+
+        counter = Counter()
+        with counter.patch(nova_client.Client, '__init__'):
+            ...
+        print counter.calls
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def wrap(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def patch(self, obj, attr):
+        original = getattr(obj, attr)
+        setattr(obj, attr, self.wrap(original))
+        try:
+            yield self
+        finally:
+            setattr(obj, attr, original)
+
+
+class Timer(object):
+    """Context manager that records the elapsed wall time in seconds."""
+
+    def __enter__(self):
+        self.start = time.time()
+        self.elapsed = None
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+
+
+class FakeTransport(object):
+
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient(object):
+    """Stand in for a connected paramiko client"""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport = None
+
+
+@contextmanager
+def fake_ssh(latency=0):
+    """Answer the ssh commands of the datastore managers locally
+
+    New connections and every command wait `latency` seconds, the commands
+    return no output as if nothing was installed yet.
+    """
+    from dtrove import ssh
+    from dtrove.datastores import base, mysql
+
+    def connect(instance):
+        time.sleep(latency)
+        return FakeClient()
+
+    def command(*args, **kwargs):
+        time.sleep(latency)
+        return ''
+
+    patched = [(ssh, 'connect', connect)]
+    for module in (base, mysql):
+        for name in ('run', 'put'):
+            if hasattr(module, name):
+                patched.append((module, name, command))
+    originals = [(obj, name, getattr(obj, name)) for obj, name, _ in patched]
+    for obj, name, fake in patched:
+        setattr(obj, name, fake)
+    try:
+        yield
+    finally:
+        for obj, name, original in originals:
+            setattr(obj, name, original)
+        ssh.POOL.close_all()
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Summarize a list of timings with nearest rank percentiles"""
+    values = sorted(values)
+    summary = {'count': len(values)}
+    if not values:
+        return summary
+    summary['min'] = values[0]
+    summary['max'] = values[-1]
+    summary['mean'] = sum(values) / len(values)
+    for point in points:
+        rank = max(1, int(math.ceil(point / 100.0 * len(values))))
+        summary['p%d' % point] = values[rank - 1]
+    return summary
+
+
+class Stages(object):
+    """Collect the durations of named stages
+
+    ::
+
+        stages = Stages()
+        provider.create = stages.wrap('create_server', provider.create)
+        ...
+        print stages.summary()
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    def record(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def wrap(self, name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.time() - start)
+        return wrapper
+
+    def summary(self):
+        return dict((name, percentiles(values))
+                    for name, values in self.timings.items())
@@ -0,0 +1,93 @@
+"""
+Import time
+-----------
+
+Starts a fresh python process, sets up django and reports how long the
+imports took in the style of ``python -X importtime``. The time of a module
+includes the modules it imported first. It also lists which of the cloud
+and ssh client libraries got imported, none of them should be until the
+provider is used or a manager connects to a node.
+
+Options:
+
+* `top`: Number of the slowest modules to report (default 15)
+* `setup`: Also import this module after django is set up, for example
+  `dtrove.tasks` (default none)
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+#: Seconds `import dtrove.models` may take in a fresh process
+BUDGET = 0.5
+
+#: Libraries that should only be imported when the provider is first used
+CLOUD_CLIENTS = ('novaclient', 'cinderclient', 'keystoneclient')
+
+#: Libraries that should only be imported when a node is connected to
+SSH_CLIENTS = ('paramiko', 'fabric')
+
+SCRIPT = '''
+import __builtin__
+import json
+import sys
+import time
+
+times = {}
+original = __builtin__.__import__
+
+
+def timed_import(*args, **kwargs):
+    # A module is in sys.modules while it is still running, so only the
+    # call that added it gets the time of the whole module.
+    before = set(sys.modules)
+    start = time.time()
+    try:
+        return original(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        for name in set(sys.modules) - before:
+            if name not in times and sys.modules[name] is not None:
+                times[name] = elapsed
+
+for name in sys.modules:
+    times[name] = 0.0
+__builtin__.__import__ = timed_import
+
+start = time.time()
+import django
+django.setup()
+if %(setup)r:
+    __import__(%(setup)r)
+total = time.time() - start
+__builtin__.__import__ = original
+
+print(json.dumps({
+    'seconds': total,
+    'modules': times,
+    'loaded': sorted(name for name in %(clients)r if name in sys.modules),
+    'ssh': sorted(name for name in %(ssh)r if name in sys.modules),
+}))
+'''
+
+
+def run(top=15, setup=''):
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'dtrove.settings')
+    script = SCRIPT % {'setup': setup, 'clients': CLOUD_CLIENTS,
+                       'ssh': SSH_CLIENTS}
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    found = json.loads(output.strip().splitlines()[-1])
+    modules = found['modules']
+    slowest = sorted(modules.items(), key=lambda item: -item[1])[:top]
+    return {
+        'seconds': found['seconds'],
+        'models_seconds': modules.get('dtrove.models', 0.0),
+        'budget': BUDGET,
+        'modules': len([t for t in modules.values() if t]),
+        'slowest': slowest,
+        'cloud_clients': found['loaded'],
+        'ssh_clients': found['ssh'],
+    }
@@ -0,0 +1,60 @@
+"""
+Nova client reuse
+-----------------
+
+Builds a cluster against the fake nova endpoint and counts how many nova
+clients, keystone authentications and TCP connections it took.
+
+Options:
+
+* `nodes`: Number of nodes in the cluster (default 5)
+"""
+
+from requests.packages.urllib3.connection import HTTPConnection
+
+from dtrove.benchmarks.base import Counter, Timer, fake_cloud, test_database
+
+
+def run(nodes=5):
+    from dtrove import models
+    from dtrove.providers import openstack
+
+    clients = Counter()
+    auths = Counter()
+    connections = Counter()
+
+    with test_database(), fake_cloud() as url:
+        provision = models.Cluster.provision
+        models.Cluster.provision = lambda self, instance_ids: None
+        try:
+            ds = models.Datastore.objects.create(
+                manager_class='dtrove.datastores.mysql.MySQLManager',
+                version='5.5', image='fake')
+            cluster = models.Cluster.objects.create(
+                name='bench', datastore=ds, size=nodes)
+        finally:
+            models.Cluster.provision = provision
+
+        provider = openstack.Provider()
+        provider.auth_url = '%s/osauth/v2.0' % url
+        openstack.clear_clients()
+
+        with clients.patch(openstack.nova_client.Client, '__init__'), \
+                auths.patch(openstack.keystone_client.Client, '__init__'), \
+                connections.patch(HTTPConnection, 'connect'), \
+                Timer() as timer:
+            for instance in cluster.instance_set.all():
+                provider.create(instance)
+                # Same checks as the wait_for_server task without the wait,
+                # the fake nova builds a server in ten requests.
+                while provider.update_status(instance)[0] != 'active':
+                    pass
+
+    return {
+        'nodes': nodes,
+        'nova_clients': clients.calls,
+        'keystone_auths': auths.calls,
+        'tcp_connections': connections.calls,
+        'token_cache': openstack.token_stats(),
+        'seconds': timer.elapsed,
+    }
@@ -0,0 +1,106 @@
+"""
+Provisioning throughput
+-----------------------
+
+Creates clusters end to end, from `Cluster.objects.create` through the
+`create_cluster` tasks, `Provider.create` and `Manager.prepare`, against
+the fake openstack endpoints and a fake ssh target. The celery tasks run
+eagerly in this process so the clusters are built one after the other.
+
+It reports the p50/p95/p99 of every stage and the overall throughput:
+
+* `cluster`: Creating a cluster until all of its nodes are prepared
+* `create_server`: Booting one server
+* `wait_for_server`: From the boot until the server is active
+* `prepare`: Installing and configuring the datastore on one node
+
+Options:
+
+* `clusters`: Number of clusters to create (default 10)
+* `size`: Number of nodes in each cluster (default 3)
+* `nova_latency`: Seconds each request to the fake cloud takes (default 0)
+* `ssh_latency`: Seconds each ssh connection and command takes (default 0)
+"""
+
+import time
+
+from dtrove.benchmarks.base import Stages, Timer
+from dtrove.benchmarks.base import fake_cloud, fake_ssh, test_database
+
+
+def run(clusters=10, size=3, nova_latency=0, ssh_latency=0):
+    from dtrove import config, models
+    from dtrove.celery import app
+    from dtrove.datastores.mysql import MySQLManager
+    from dtrove.providers import get_provider, reset_provider
+    from dtrove.providers import openstack
+
+    if size > config.DTROVE_MAX_CLUSTER_SIZE:
+        raise ValueError('size is larger than DTROVE_MAX_CLUSTER_SIZE')
+
+    stages = Stages()
+    booted = {}
+
+    eager = app.conf.CELERY_ALWAYS_EAGER
+    max_age = config.DTROVE_STATE_MAX_AGE
+    prepare = MySQLManager.prepare
+    with test_database(), fake_cloud(nova_latency) as url, \
+            fake_ssh(ssh_latency):
+        reset_provider()
+        openstack.clear_clients()
+        provider = get_provider()
+        provider.auth_url = '%s/osauth/v2.0' % url
+
+        create = stages.wrap('create_server', provider.create)
+        update_status = provider.update_status
+
+        def create_server(instance):
+            create(instance)
+            booted[instance.pk] = time.time()
+
+        def wait(instance):
+            status, progress = update_status(instance)
+            if status == 'active' and instance.pk in booted:
+                stages.record('wait_for_server',
+                              time.time() - booted.pop(instance.pk))
+            return status, progress
+
+        provider.create = create_server
+        provider.update_status = wait
+        MySQLManager.prepare = stages.wrap('prepare', prepare)
+        app.conf.CELERY_ALWAYS_EAGER = True
+        # Nothing runs poll_status while the tasks are eager, so every
+        # check of a building server has to ask nova itself
+        config.DTROVE_STATE_MAX_AGE = -1
+        try:
+            datastore = models.Datastore.objects.create(
+                manager_class='dtrove.datastores.mysql.MySQLManager',
+                version='5.5', image='fake', packages='mysql-server')
+            with Timer() as timer:
+                for number in range(clusters):
+                    with Timer() as cluster:
+                        models.Cluster.objects.create(
+                            name='bench-%d' % number, datastore=datastore,
+                            size=size)
+                    stages.record('cluster', cluster.elapsed)
+        finally:
+            app.conf.CELERY_ALWAYS_EAGER = eager
+            config.DTROVE_STATE_MAX_AGE = max_age
+            MySQLManager.prepare = prepare
+            reset_provider()
+            openstack.clear_clients()
+
+    summary = stages.summary()
+    instances = clusters * size
+    prepared = summary.get('prepare', {}).get('count', 0)
+    return {
+        'clusters': clusters,
+        'size': size,
+        'nova_latency': nova_latency,
+        'ssh_latency': ssh_latency,
+        'seconds': timer.elapsed,
+        'clusters_per_minute': clusters * 60 / timer.elapsed,
+        'instances_per_minute': prepared * 60 / timer.elapsed,
+        'failed': instances - prepared,
+        'stages': summary,
+    }
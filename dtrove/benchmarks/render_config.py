@@ -0,0 +1,48 @@
+"""
+Config rendering
+----------------
+
+Renders the config file of every instance in a set of clusters, once with
+the template cache cleared before each render and once with the cache in
+place, and reports the renders per second of both.
+
+Options:
+
+* `instances`: Number of instances to render a config for (default 1000)
+* `cluster_size`: Number of instances in each cluster (default 5)
+"""
+
+from dtrove.benchmarks.base import Timer
+
+
+def run(instances=1000, cluster_size=5):
+    from dtrove import models
+    from dtrove.datastores import base
+    from dtrove.datastores.mysql import MySQLManager
+
+    datastore = models.Datastore(
+        pk=1, manager_class='dtrove.datastores.mysql.MySQLManager',
+        version='5.5', image='fake')
+    nodes = [models.Instance(name='node-%d' % i, addr='10.0.0.1',
+                             cluster_id=i // cluster_size)
+             for i in range(instances)]
+
+    with Timer() as cold:
+        for instance in nodes:
+            base.clear_template_cache()
+            MySQLManager(datastore).render_config_file(instance)
+
+    base.clear_template_cache()
+    with Timer() as cached:
+        for instance in nodes:
+            MySQLManager(datastore).render_config_file(instance)
+    base.clear_template_cache()
+
+    return {
+        'instances': instances,
+        'cluster_size': cluster_size,
+        'cold_seconds': cold.elapsed,
+        'cached_seconds': cached.elapsed,
+        'cold_per_second': instances / cold.elapsed,
+        'cached_per_second': instances / cached.elapsed,
+    }
@@ -0,0 +1,25 @@
+"""
+Shared counters in the cache.
+"""
+
+from django.core.cache import caches
+
+CACHE = caches['default']
+
+
+def incr(key, delta=1, timeout=None):
+    """Add `delta` to a counter in the cache, creating it when missing
+
+    :param str key: Cache key of the counter
+    :param int delta: Amount to add
+    :param timeout: Seconds the counter lives when it is created, None
+                    for never expiring
+    :returns: The new value of the counter
+    """
+    CACHE.add(key, 0, timeout)
+    try:
+        return CACHE.incr(key, delta)
+    except ValueError:
+        # Evicted between the add and the incr, start it over
+        CACHE.set(key, delta, timeout)
+        return delta
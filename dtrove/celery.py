@@ -1,9 +1,18 @@
 from __future__ import absolute_import
 
+import cProfile
+import glob
 import os
 import logging
+import random
+import threading
+import time
+from datetime import timedelta
 
 from celery import Celery
+from celery.signals import celeryd_init, task_postrun, task_prerun
+from celery.signals import worker_init
+from kombu import Exchange, Queue
 
 from django.conf import settings
 
@@ -17,6 +26,243 @@ app = Celery('dtrove')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Poll the building servers in bulk and keep the ssh key pool full, the
+# intervals are read straight from the settings as `dtrove.config` imports
+# this module.
+_schedule = dict(app.conf.CELERYBEAT_SCHEDULE or {})
+_schedule.setdefault('dtrove-poll-status', {
+    'task': 'dtrove.tasks.poll_status',
+    'schedule': timedelta(
+        seconds=getattr(settings, 'DTROVE_POLL_INTERVAL', 10)),
+})
+_schedule.setdefault('dtrove-fill-key-pool', {
+    'task': 'dtrove.tasks.fill_key_pool',
+    'schedule': timedelta(
+        seconds=getattr(settings, 'DTROVE_KEY_POOL_INTERVAL', 60)),
+})
+app.conf.CELERYBEAT_SCHEDULE = _schedule
+
+CONTROL = 'dtrove.control'
+POLL = 'dtrove.poll'
+PREPARE = 'dtrove.prepare'
+
+#: Queue of each task. The long ssh work has its own queue so it can't hold
+#: up the quick control and status tasks.
+TASK_ROUTES = {
+    'dtrove.tasks.create': CONTROL,
+    'dtrove.tasks.create_cluster': CONTROL,
+    'dtrove.tasks.prepare_cluster': CONTROL,
+    'dtrove.tasks.cluster_ready': CONTROL,
+    'dtrove.tasks.create_server': CONTROL,
+    'dtrove.tasks.preform': CONTROL,
+    'dtrove.tasks.preform_cluster': CONTROL,
+    'dtrove.tasks.fill_key_pool': CONTROL,
+    'dtrove.tasks.wait_for_server': POLL,
+    'dtrove.tasks.poll_status': POLL,
+    'dtrove.tasks.refresh_status': POLL,
+    'dtrove.tasks.prepare': PREPARE,
+    'dtrove.tasks.scale_down': PREPARE,
+    'dtrove.tasks.generate_key': PREPARE,
+    # Chords wait with this task when the result backend can't join them
+    'celery.chord_unlock': CONTROL,
+}
+
+#: Priority of the tasks within their queue, 0 to 9 (highest). Work that
+#: someone waits on goes ahead of the periodic and background tasks.
+TASK_PRIORITIES = {
+    'dtrove.tasks.preform': 8,
+    'dtrove.tasks.preform_cluster': 8,
+    'dtrove.tasks.create': 6,
+    'dtrove.tasks.create_cluster': 6,
+    'dtrove.tasks.create_server': 6,
+    'dtrove.tasks.prepare_cluster': 6,
+    'dtrove.tasks.cluster_ready': 6,
+    'celery.chord_unlock': 6,
+    'dtrove.tasks.fill_key_pool': 2,
+    'dtrove.tasks.refresh_status': 8,
+    'dtrove.tasks.wait_for_server': 5,
+    'dtrove.tasks.poll_status': 2,
+    'dtrove.tasks.prepare': 6,
+    'dtrove.tasks.scale_down': 6,
+    'dtrove.tasks.generate_key': 1,
+}
+
+_DEFAULT_QUEUE = app.conf.CELERY_DEFAULT_QUEUE
+
+#: Queues, pool size and prefetch multiplier of each kind of worker, pick
+#: one with the `DTROVE_WORKER_PROFILE` setting or environment variable.
+#: The 'all' and 'control' workers also consume the default celery queue
+#: for the tasks that are not routed, like the celery built in tasks.
+WORKER_PROFILES = {
+    'all': {'queues': [CONTROL, POLL, PREPARE, _DEFAULT_QUEUE]},
+    'control': {'queues': [CONTROL, _DEFAULT_QUEUE], 'concurrency': 4,
+                'prefetch_multiplier': 4},
+    'poll': {'queues': [POLL], 'concurrency': 4, 'prefetch_multiplier': 8},
+    'prepare': {'queues': [PREPARE], 'concurrency': 16,
+                'prefetch_multiplier': 1},
+}
+
+
+class Router(object):
+    """Send the dtrove tasks to their queue with the task priority"""
+
+    def __init__(self, routes, priorities):
+        self.routes = routes
+        self.priorities = priorities
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        queue = self.routes.get(task)
+        if queue is None:
+            return None
+        route = {'queue': queue}
+        if task in self.priorities:
+            route['priority'] = self.priorities[task]
+        return route
+
+
+def worker_profile(name=None):
+    """The options of a worker profile, see `WORKER_PROFILES`"""
+    if name is None:
+        name = os.environ.get('DTROVE_WORKER_PROFILE',
+                              getattr(settings, 'DTROVE_WORKER_PROFILE', None))
+    if not name:
+        return None
+    profiles = getattr(settings, 'DTROVE_WORKER_PROFILES', WORKER_PROFILES)
+    try:
+        return profiles[name]
+    except KeyError:
+        raise ValueError('Unknown worker profile: %s' % name)
+
+
+# The routes and queues are read straight from the settings too, the ones
+# already in the celery settings win.
+_routes = getattr(settings, 'DTROVE_TASK_ROUTES', TASK_ROUTES)
+_priorities = getattr(settings, 'DTROVE_TASK_PRIORITIES', TASK_PRIORITIES)
+_router = Router(_routes, _priorities)
+_existing = app.conf.CELERY_ROUTES or ()
+if not isinstance(_existing, (list, tuple)):
+    _existing = (_existing,)
+app.conf.CELERY_ROUTES = tuple(_existing) + (_router,)
+
+_queues = list(app.conf.CELERY_QUEUES or [
+    Queue(app.conf.CELERY_DEFAULT_QUEUE,
+          Exchange(app.conf.CELERY_DEFAULT_EXCHANGE,
+                   app.conf.CELERY_DEFAULT_EXCHANGE_TYPE),
+          routing_key=app.conf.CELERY_DEFAULT_ROUTING_KEY),
+])
+_names = set(queue.name for queue in _queues)
+for _name in sorted(set(_routes.values()) - _names):
+    _queues.append(Queue(_name, Exchange(_name), routing_key=_name,
+                         queue_arguments={'x-max-priority': 10}))
+app.conf.CELERY_QUEUES = _queues
+
+
+def _unset(options, name, default):
+    """Whether an option was left at its command line default"""
+    return options.get(name) in (None, 0, default)
+
+
+@celeryd_init.connect
+def _apply_worker_profile(sender=None, instance=None, conf=None, **kwargs):
+    """Size the worker with its profile, command line options win"""
+    profile = worker_profile()
+    if profile is None:
+        return
+    options = kwargs.get('options') or {}
+    if not options.get('queues'):
+        instance.app.amqp.queues.select(profile['queues'])
+    # The worker reads its concurrency from the options, which default to
+    # the setting, so it is set on the worker in `_apply_concurrency`
+    if 'concurrency' in profile and \
+            _unset(options, 'concurrency', conf.CELERYD_CONCURRENCY):
+        instance.profile_concurrency = profile['concurrency']
+    if options.get('prefetch_multiplier') is None and \
+            'prefetch_multiplier' in profile:
+        conf.CELERYD_PREFETCH_MULTIPLIER = profile['prefetch_multiplier']
+
+
+@worker_init.connect
+def _apply_concurrency(sender=None, **kwargs):
+    """Set the profile concurrency before the worker starts its pool"""
+    concurrency = getattr(sender, 'profile_concurrency', None)
+    if concurrency:
+        sender.concurrency = concurrency
+
+
+# Profiles of the tasks running in this process, by task id. Only one
+# profiler can be active in a thread so tasks that run inside another task
+# (like eager subtasks) are not profiled.
+_profiles = {}
+_profiling = threading.local()
+
+
+def _should_profile(name):
+    from dtrove import config
+
+    if name in config.DTROVE_PROFILE_TASKS:
+        return True
+    rate = config.DTROVE_PROFILE_RATE
+    return bool(rate) and random.random() < rate
+
+
+def spool_profile(profile, name, task_id):
+    """Write the stats of a profile to the spool directory
+
+    The oldest files are removed once the directory is larger than
+    :py:attr:`dtrove.config.DTROVE_PROFILE_MAX_BYTES`.
+    """
+    from dtrove import config
+
+    spool = config.DTROVE_PROFILE_DIR
+    if not os.path.isdir(spool):
+        os.makedirs(spool)
+    path = os.path.join(spool, '%s-%d-%d-%s.pstats' % (
+        name, time.time(), os.getpid(), task_id))
+    profile.dump_stats(path)
+
+    files = []
+    for found in glob.glob(os.path.join(spool, '*.pstats')):
+        try:
+            stat = os.stat(found)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, found))
+    files.sort()
+    total = sum(size for mtime, size, found in files)
+    while files and total > config.DTROVE_PROFILE_MAX_BYTES:
+        mtime, size, found = files.pop(0)
+        if found == path:
+            break
+        try:
+            os.remove(found)
+        except OSError:
+            pass
+        total -= size
+    return path
+
+
+@task_prerun.connect
+def _start_profile(task_id=None, task=None, **kwargs):
+    if getattr(_profiling, 'active', False) or not _should_profile(task.name):
+        return
+    profile = cProfile.Profile()
+    _profiles[task_id] = profile
+    _profiling.active = True
+    profile.enable()
+
+
+@task_postrun.connect
+def _stop_profile(task_id=None, task=None, **kwargs):
+    profile = _profiles.pop(task_id, None)
+    if profile is None:
+        return
+    profile.disable()
+    _profiling.active = False
+    try:
+        spool_profile(profile, task.name, task_id)
+    except (IOError, OSError):
+        logging.exception('Unable to save the profile of %s', task_id)
+
 
 @app.task(bind=True)
 def debug_task(self):
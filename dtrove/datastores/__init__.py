@@ -0,0 +1,100 @@
+"""
+Datastore Managers
+==================
+
+The manager classes are resolved once per process. Every entry of
+:py:attr:`dtrove.config.DTROVE_DATASTORE_MANAGERS` is imported and checked
+when the app starts so a typo or a missing module stops the process right
+away instead of failing the first request that uses it::
+
+    from dtrove.datastores import get_manager
+
+    manager = get_manager(datastore)
+    manager.prepare(instance)
+
+The managers are memoized per datastore and dropped again when the
+datastore is saved.
+"""
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from dtrove import config
+
+# dotted path -> manager class
+_CLASSES = {}
+# datastore id -> manager
+_MANAGERS = {}
+_LOCK = threading.Lock()
+
+
+def get_manager_class(path):
+    """Import and check the manager class at a dotted path"""
+    cls = _CLASSES.get(path)
+    if cls is not None:
+        return cls
+
+    from dtrove.datastores.base import BaseManager
+    try:
+        cls = import_string(path)
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            'Unable to import datastore manager %s: %s' % (path, e))
+    if not (isinstance(cls, type) and issubclass(cls, BaseManager)):
+        raise ImproperlyConfigured(
+            'Datastore manager %s is not a BaseManager' % path)
+    with _LOCK:
+        _CLASSES[path] = cls
+    return cls
+
+
+def load_managers(managers=None):
+    """Resolve every configured manager class
+
+    :param managers: List of (path, name) tuples, defaults to
+                     :py:attr:`dtrove.config.DTROVE_DATASTORE_MANAGERS`
+    :raises: ImproperlyConfigured if any of them can't be used
+    """
+    from dtrove.datastores.base import clear_template_cache
+    if managers is None:
+        managers = config.DTROVE_DATASTORE_MANAGERS
+    loaded = dict((name, get_manager_class(path)) for path, name in managers)
+    # Templates rendered by the managers that were loaded before
+    clear_template_cache()
+    return loaded
+
+
+def _signature(datastore):
+    return (datastore.manager_class, datastore.version, datastore.image,
+            datastore.packages)
+
+
+def get_manager(datastore):
+    """The memoized manager of a datastore"""
+    cached = _MANAGERS.get(datastore.pk)
+    # The datastore may have been changed by another process
+    if cached is not None and datastore.pk is not None:
+        signature, manager = cached
+        if signature == _signature(datastore):
+            return manager
+
+    manager = get_manager_class(datastore.manager_class)(datastore)
+    if datastore.pk is not None:
+        with _LOCK:
+            _MANAGERS[datastore.pk] = (_signature(datastore), manager)
+    return manager
+
+
+def forget(datastore):
+    """Drop the memoized manager of a datastore"""
+    with _LOCK:
+        _MANAGERS.pop(datastore.pk, None)
+
+
+def clear():
+    """Drop every memoized manager and manager class"""
+    with _LOCK:
+        _CLASSES.clear()
+        _MANAGERS.clear()
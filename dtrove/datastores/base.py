@@ -8,12 +8,12 @@ If you wish to create your own datastore, simply subclass the base and
 override the methods you need to for example::
 
     from dtrove.datastores import base
-    from dtrove.commands import run
+    from fabric.api import run
 
     class MyBackyardDBManager(base.BaseManager):
 
-        def backup():
-            with self.conn as connection:
+        def backup(self, instance):
+            with self.connection(instance):
                 run('/bin/bash my_backup.sh')
 
         @property
@@ -24,13 +24,124 @@ Templates for the managers live in `dtrove/datastores/<manager_name>` where
 manager name by default is the lowercase manager name with the 'Manager'
 removed. For example 'MySQLManager' would be 'mysql'.
 
-More on templates later.
+Compiled templates are cached per (manager name, version) and reloaded
+when the template file changes, both caches are dropped when the managers
+are loaded again. Templates that don't use the `instance`
+variable render the same for every node so they are rendered once per
+cluster and the output is reused for the other nodes. Templates with
+`{% include %}` or `{% extends %}` are rendered for every node.
 
 """
 
-from django.template.loader import select_template
-from django.template import Context
-from fabric.api import run, env, put
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.template.loader import find_template_loader
+from django.template import Context, Template, TemplateDoesNotExist
+from django.template.loader_tags import ExtendsNode, IncludeNode
+
+from dtrove import config, tracing
+from dtrove.datastores import _signature
+
+LOG = logging.getLogger(__name__)
+
+#: Status reported by dpkg-query for a package that is installed
+INSTALLED = 'install ok installed'
+
+#: Max number of rendered config files that are kept
+RENDERED_CACHE_SIZE = 1024
+
+# (manager name, version) -> (template, path, mtime, uses instance)
+_TEMPLATES = {}
+# (manager name, template mtime, datastore signature, datastore id,
+#  cluster id) -> output
+_RENDERED = OrderedDict()
+_TEMPLATES_LOCK = threading.Lock()
+# Timings being recorded in this thread, see `BaseManager.record_timings`
+_recorders = threading.local()
+
+_USES_INSTANCE = re.compile(r'\binstance\b')
+
+
+def clear_template_cache():
+    """Drop the compiled templates and rendered config files"""
+    with _TEMPLATES_LOCK:
+        _TEMPLATES.clear()
+        _RENDERED.clear()
+
+
+# fabric and paramiko are slow to import and only needed once a manager
+# talks to a node, the managers are loaded by every process at startup.
+def run(*args, **kwargs):
+    """fabric's `run`, imported on first use"""
+    from fabric.api import run
+    return run(*args, **kwargs)
+
+
+def put(*args, **kwargs):
+    """fabric's `put`, imported on first use"""
+    from fabric.api import put
+    return put(*args, **kwargs)
+
+
+def execute(client, cmd, timeout=None):
+    """See :py:func:`dtrove.ssh.execute`"""
+    from dtrove.ssh import execute
+    return execute(client, cmd, timeout)
+
+
+def _pool():
+    from dtrove.ssh import POOL
+    return POOL
+
+
+def _uses_instance(template, source):
+    """Whether a template can render differently for each node
+
+    Templates that include or extend others are looked up when they are
+    rendered, so those always count as using the instance.
+    """
+    if _USES_INSTANCE.search(source):
+        return True
+    nodes = template.nodelist
+    return bool(nodes.get_nodes_by_type(ExtendsNode) or
+                nodes.get_nodes_by_type(IncludeNode))
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError):
+        return None
+
+
+def _source_loaders():
+    for name in settings.TEMPLATE_LOADERS:
+        loader = find_template_loader(name)
+        # Look through the cached loader at the loaders it wraps
+        for loader in getattr(loader, 'loaders', [loader]):
+            yield loader
+
+
+def load_template(names):
+    """Find and compile the first of the template names that exists
+
+    :returns: tuple of (template, source, path to the template file)
+    """
+    for name in names:
+        for loader in _source_loaders():
+            try:
+                source, path = loader.load_template_source(name)
+            except (TemplateDoesNotExist, NotImplementedError):
+                continue
+            return Template(source, name=name), source, path
+    raise TemplateDoesNotExist(', '.join(names))
 
 
 class BaseManager(object):
@@ -52,10 +163,23 @@ class BaseManager(object):
         # filter any blank lines and strip any hanging newlines
         self.packages = filter(None, map(lambda pkg: pkg.strip(), packages))
 
+    @classmethod
+    def manager_name(cls):
+        """Returns the name of the manager ex: MySQLManager = mysql"""
+        return cls.__name__.replace('Manager', '').lower()
+
     @property
     def name(self):
         """Returns the name of the manager ex: MySQLManager = mysql"""
-        return self.__class__.__name__.replace('Manager', '').lower()
+        return self.manager_name()
+
+    def connection(self, instance):
+        """Borrow a pooled ssh connection to the instance.
+
+        Use this as a context manager, fabric commands inside the block run
+        on the instance. See :py:class:`dtrove.ssh.ConnectionPool`.
+        """
+        return _pool().connection(instance)
 
     def backup(self, instance):
         """Preform a backup on the remote instance."""
@@ -65,21 +189,140 @@ class BaseManager(object):
         """Install and configure the datastore on the instance."""
         raise NotImplementedError()
 
-    def render_config_file(self, instance):
-        """Load and render a config file for this datastore."""
-        context = Context({
-            'instance': instance,
-            'datastore': self.datastore,
-        })
+    @staticmethod
+    @contextmanager
+    def record_timings():
+        """Collect the seconds spent in each `timed` step inside the block
+
+        The manager is shared by every instance of a datastore so the
+        timings go to a dict owned by the caller rather than the manager::
+
+            with manager.record_timings() as timings:
+                manager.prepare(instance)
+
+        Each thread (or greenlet) records its own steps.
+        """
+        timings = OrderedDict()
+        stack = _recorders.__dict__.setdefault('stack', [])
+        stack.append(timings)
+        try:
+            yield timings
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def timed(self, step):
+        """Record how long a step takes with `record_timings`
+
+        The step is also traced as a span of the instance being prepared,
+        see :py:mod:`dtrove.tracing`.
+        """
+        start = time.time()
+        try:
+            with tracing.span(step):
+                yield
+        finally:
+            stack = getattr(_recorders, 'stack', None)
+            if stack:
+                stack[-1][step] = time.time() - start
+
+    def install_plan(self, packages):
+        """Find the packages that still need to be installed
+
+        This makes a single round trip to the host which also checks if
+        the apt package lists were updated in the last
+        :py:attr:`dtrove.config.DTROVE_APT_LISTS_MAX_AGE` minutes.
+
+        :returns: tuple of (missing packages, package lists are fresh)
+        """
+        cmd = ("dpkg-query -W -f='${Package} ${Status}\\n' %s 2>/dev/null; "
+               "find /var/lib/apt/lists -maxdepth 1 -name '*Packages' "
+               "-mmin -%d | head -n 1")
+        output = run(cmd % (' '.join(packages),
+                            config.DTROVE_APT_LISTS_MAX_AGE), quiet=True)
+        installed = set()
+        fresh = False
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('/'):
+                fresh = True
+            elif line.endswith(INSTALLED):
+                installed.add(line.split(' ', 1)[0])
+        missing = [pkg for pkg in packages if pkg not in installed]
+        return missing, fresh
+
+    def install_packages(self, packages=None):
+        """Install any missing packages with a single apt-get call
+
+        :returns: list of the packages that were installed
+        """
+        if packages is None:
+            packages = self.packages
+        if not packages:
+            return []
+        with self.timed('plan'):
+            missing, fresh = self.install_plan(packages)
+        if missing:
+            cmd = ('DEBIAN_FRONTEND=noninteractive apt-get install -y %s' %
+                   ' '.join(missing))
+            if not fresh:
+                cmd = 'apt-get update && %s' % cmd
+            with self.timed('install'):
+                run(cmd)
+        return missing
+
+    def config_template(self):
+        """The compiled config template for this datastore version
+
+        :returns: tuple of (template, mtime, uses instance)
+        """
+        key = (self.name, self.datastore.version)
+        cached = _TEMPLATES.get(key)
+        if cached is not None:
+            template, path, mtime, uses_instance = cached
+            if _mtime(path) == mtime:
+                return template, mtime, uses_instance
+
         lookup = {
-            'name': self.datastore.manager.name,
+            'name': self.name,
             'version': self.datastore.version,
         }
-        template = select_template([
+        template, source, path = load_template([
             '%(name)s/%(version)s/config' % lookup,
             '%(name)s/config' % lookup,
         ])
-        return template.render(context)
+        mtime = _mtime(path)
+        uses_instance = _uses_instance(template, source)
+        with _TEMPLATES_LOCK:
+            _TEMPLATES[key] = (template, path, mtime, uses_instance)
+        return template, mtime, uses_instance
+
+    def render_config_file(self, instance):
+        """Load and render a config file for this datastore."""
+        template, mtime, uses_instance = self.config_template()
+        if not uses_instance:
+            # The signature has the manager class and version plus the
+            # rest of the datastore fields the template can use
+            key = (self.name, mtime, _signature(self.datastore),
+                   self.datastore.pk, instance.cluster_id)
+            with _TEMPLATES_LOCK:
+                output = _RENDERED.pop(key, None)
+                if output is not None:
+                    _RENDERED[key] = output
+                    return output
+
+        context = Context({
+            'instance': instance,
+            'datastore': self.datastore,
+        })
+        output = template.render(context)
+
+        if not uses_instance:
+            with _TEMPLATES_LOCK:
+                _RENDERED[key] = output
+                while len(_RENDERED) > RENDERED_CACHE_SIZE:
+                    _RENDERED.popitem(last=False)
+        return output
 
     def restart(self):
         """Restart the datastore."""
@@ -89,6 +332,17 @@ class BaseManager(object):
         """Stop the datastore"""
         run('service %s stop' % self.service_name)
 
+    def drain(self, instance):
+        """Stop the datastore on an instance that is about to be removed
+
+        This uses a pooled paramiko client rather than fabric so many
+        instances can be drained at once from threads.
+
+        :returns: tuple of (stdout, stderr, exit code)
+        """
+        with _pool().client(instance) as client:
+            return execute(client, 'service %s stop' % self.service_name)
+
     def start(self):
         """Start the datastore"""
         run('service %s start' % self.service_name)
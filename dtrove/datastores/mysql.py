@@ -6,9 +6,8 @@ Oracle MySQL Manager
 
 from cStringIO import StringIO
 
-from fabric.api import run, env, put
-
 from dtrove.datastores import base
+from dtrove.datastores.base import run, put
 
 
 class MySQLManager(base.BaseManager):
@@ -16,11 +15,11 @@ class MySQLManager(base.BaseManager):
     service_name = 'mysql'
 
     def prepare(self, instance):
-        run('apt-get update')
-        for pkg in self.packages:
-            run('DEBIAN_FRONTEND=noninteractive apt-get install -y %s' % pkg)
+        self.install_packages()
 
-        config = StringIO(self.render_config_file(instance))
-        put(config, '/etc/mysql/my.cnf')
+        with self.timed('config'):
+            config = StringIO(self.render_config_file(instance))
+            put(config, '/etc/mysql/my.cnf')
 
-        self.restart()
+        with self.timed('restart'):
+            self.restart()
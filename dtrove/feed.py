@@ -0,0 +1,135 @@
+"""
+Change Feed
+===========
+
+Every change to the state of an instance is appended to the feed of its
+cluster in the cache. Watchers remember the sequence number of the last
+event they saw and ask for anything newer::
+
+    from dtrove import feed
+
+    last, events = feed.wait(cluster.pk, after=last)
+
+The feed of a cluster is a counter plus one cache entry per event, so a
+watcher only checks the counter until something changes and then reads the
+new events with a single call. It never touches the database or the
+provider. Events are kept for :py:attr:`dtrove.config.DTROVE_FEED_TTL`
+seconds, a watcher that falls further behind than that should read the
+current state again from the instances api.
+
+A publisher takes its sequence numbers from the counter before it writes
+the events, so a reader can see the new counter before the events are
+there. `read` stops before the first missing event and returns the number
+before it, the watcher picks the rest up on its next read. An event that
+is still missing when a newer one is older than
+:py:attr:`dtrove.config.DTROVE_FEED_GAP_TIMEOUT` seconds was lost (ie
+evicted) and is skipped.
+
+This is a cache poll rather than a real subscription. Every watcher checks
+the counter each :py:attr:`dtrove.config.DTROVE_FEED_INTERVAL` seconds and
+holds its web worker for up to :py:attr:`dtrove.config.DTROVE_FEED_WAIT`
+seconds (long poll) or
+:py:attr:`dtrove.config.DTROVE_FEED_STREAM_TIMEOUT` seconds (event
+stream). Serve the events api from a gevent or eventlet worker, or size
+the sync workers for the number of watchers you expect.
+"""
+
+import time
+
+from django.core.cache import caches
+
+from dtrove import cache, config
+
+CACHE = caches['default']
+
+
+def _seq_key(channel):
+    return 'feed:%s' % channel
+
+
+def _event_key(channel, seq):
+    return 'feed:%s:%d' % (channel, seq)
+
+
+def publish(channel, events):
+    """Append events to the feed of a channel
+
+    :param channel: The feed to write to, usually the cluster id
+    :param list events: The event dicts to append
+    :returns: The sequence number of the last event
+    """
+    if not events:
+        return current(channel)
+    last = cache.incr(_seq_key(channel), len(events))
+    first = last - len(events) + 1
+    now = time.time()
+    data = {}
+    for seq, event in enumerate(events, first):
+        data[_event_key(channel, seq)] = (now, dict(event, seq=seq))
+    CACHE.set_many(data, config.DTROVE_FEED_TTL)
+    return last
+
+
+def current(channel):
+    """The sequence number of the last event of a channel"""
+    return CACHE.get(_seq_key(channel)) or 0
+
+
+def read(channel, after=0):
+    """Read the events newer than `after`
+
+    At most :py:attr:`dtrove.config.DTROVE_FEED_BACKLOG` events are returned,
+    the oldest ones are dropped when the watcher is further behind.
+
+    The sequence number returned is the last one the watcher has seen all
+    the events up to, pass it back as `after` to continue.
+
+    :returns: tuple of (last sequence number, list of events)
+    """
+    last = current(channel)
+    if last <= after:
+        return last, []
+    start = max(after + 1, last - config.DTROVE_FEED_BACKLOG + 1)
+    seqs = range(start, last + 1)
+    found = CACHE.get_many([_event_key(channel, seq) for seq in seqs])
+    records = [found.get(_event_key(channel, seq)) for seq in seqs]
+
+    # Time the oldest event after each position was published
+    lost_before = time.time() - config.DTROVE_FEED_GAP_TIMEOUT
+    oldest_after = []
+    oldest = None
+    for record in reversed(records):
+        oldest_after.append(oldest)
+        if record is not None and (oldest is None or record[0] < oldest):
+            oldest = record[0]
+    oldest_after.reverse()
+
+    events = []
+    for seq, record, newer in zip(seqs, records, oldest_after):
+        if record is not None:
+            events.append(record[1])
+        elif newer is None or newer > lost_before:
+            # Still being written, continue from here next time
+            return seq - 1, events
+    return last, events
+
+
+def wait(channel, after=0, timeout=None):
+    """Block until there are events newer than `after` or the timeout
+
+    :param float timeout: Seconds to wait, defaults to
+                          :py:attr:`dtrove.config.DTROVE_FEED_WAIT`
+    :returns: tuple of (last sequence number, list of events)
+    """
+    if timeout is None:
+        timeout = config.DTROVE_FEED_WAIT
+    deadline = time.time() + timeout
+    while True:
+        last = current(channel)
+        if last > after:
+            last, events = read(channel, after)
+            if last > after:
+                return last, events
+        if time.time() >= deadline:
+            return last, []
+        time.sleep(config.DTROVE_FEED_INTERVAL)
@@ -0,0 +1,46 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+def _coerce(value):
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+class Command(BaseCommand):
+    args = '<benchmark> [option=value ...]'
+    help = ('Run one of the benchmarks in dtrove.benchmarks and print the '
+            'results as JSON.')
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Write the results to this file as well.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: benchmark %s' % self.args)
+        name, params = args[0], args[1:]
+        try:
+            run = import_string('dtrove.benchmarks.%s.run' % name)
+        except ImportError:
+            raise CommandError('Unknown benchmark: %s' % name)
+
+        kwargs = {}
+        for param in params:
+            if '=' not in param:
+                raise CommandError('Options must be option=value: %s' % param)
+            key, value = param.split('=', 1)
+            kwargs[key] = _coerce(value)
+
+        results = json.dumps(run(**kwargs), indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(results)
+        self.stdout.write(results)
@@ -0,0 +1,55 @@
+import glob
+import os
+import pstats
+from cStringIO import StringIO
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dtrove import config
+
+
+class Command(BaseCommand):
+    args = '[directory]'
+    help = ('Merge the task profiles in the spool directory and print the '
+            'functions that took the most time.')
+    option_list = BaseCommand.option_list + (
+        make_option('--top', dest='top', type='int', default=25,
+                    help='Number of functions to print.'),
+        make_option('--task', dest='task', default=None,
+                    help='Only read the profiles of this task.'),
+        make_option('--sort', dest='sort', default='cumulative',
+                    help='Sort by this pstats key, ie tottime or calls.'),
+        make_option('--clear', dest='clear', action='store_true',
+                    default=False,
+                    help='Remove the profiles after reading them.'),
+    )
+
+    def handle(self, *args, **options):
+        spool = args[0] if args else config.DTROVE_PROFILE_DIR
+        pattern = '%s-*.pstats' % (options['task'] or '*')
+        paths = sorted(glob.glob(os.path.join(spool, pattern)))
+        if not paths:
+            raise CommandError('No profiles found in %s' % spool)
+
+        tasks = {}
+        for path in paths:
+            name = os.path.basename(path).split('-', 1)[0]
+            tasks[name] = tasks.get(name, 0) + 1
+        self.stdout.write('Merged %d profiles:' % len(paths))
+        for name, count in sorted(tasks.items()):
+            self.stdout.write('  %6d %s' % (count, name))
+
+        report = StringIO()
+        stats = pstats.Stats(*paths, stream=report)
+        stats.strip_dirs()
+        try:
+            stats.sort_stats(options['sort'])
+        except KeyError:
+            raise CommandError('Unknown sort key: %s' % options['sort'])
+        stats.print_stats(options['top'])
+        self.stdout.write(report.getvalue())
+
+        if options['clear']:
+            for path in paths:
+                os.remove(path)
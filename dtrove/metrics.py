@@ -0,0 +1,319 @@
+"""
+Metrics
+=======
+
+Counters and histograms of the provisioning hot paths in the prometheus
+text format, served at `/metrics`::
+
+    from dtrove import metrics
+
+    with metrics.PROVIDER_SECONDS.time(method='create'):
+        provider.create(instance)
+
+Every process buffers its observations and adds them to the totals in the
+cache at most every :py:attr:`dtrove.config.DTROVE_METRICS_FLUSH_INTERVAL`
+seconds. The interval is also checked after every celery task and web
+request, and a worker process flushes whatever is left when it shuts
+down. The endpoint shows the sum of every worker and web process.
+This needs a cache that is shared by the processes, like memcached.
+
+Available metrics:
+
+* `dtrove_provider_seconds{method}`: Time spent in the provider calls
+* `dtrove_provider_errors_total{method}`: Provider calls that raised
+* `dtrove_task_seconds{task}`: Run time of the celery tasks
+* `dtrove_task_failures_total{task}`: Celery tasks that raised
+* `dtrove_ssh_command_seconds`: Time of every remote command
+* `dtrove_state_cache_total{result}`: Hits and misses of the instance
+  status properties
+* `dtrove_key_pool_*`: The counters of the ssh key pool
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from celery.signals import task_failure, task_postrun, task_prerun
+from celery.signals import worker_process_shutdown
+from django.core.cache import caches
+from django.core.signals import request_finished
+
+from dtrove import cache, config
+
+CACHE = caches['default']
+
+#: Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+           60, 120, 300, 600)
+
+# The sums are kept in the cache as an integer number of microseconds
+_SCALE = 1000000
+
+_METRICS = []
+_COLLECTORS = []
+# cache key -> value to add on the next flush
+_PENDING = {}
+_LOCK = threading.Lock()
+_last_flush = [time.time()]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in pairs)
+
+
+def _add(key, value):
+    with _LOCK:
+        _PENDING[key] = _PENDING.get(key, 0) + value
+    _flush_due()
+
+
+class Metric(object):
+    """Base of the metrics, which are registered when created"""
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # Series seen by this process, they are added to the index of the
+        # metric in the cache on the next flush
+        self.series = set()
+        self._digests = {}
+        _METRICS.append(self)
+
+    @property
+    def index_key(self):
+        return 'metrics:%s' % self.name
+
+    def key(self, series, suffix):
+        # hash() isn't the same in every process when it is randomized
+        digest = self._digests.get(series)
+        if digest is None:
+            digest = hashlib.md5(repr(series)).hexdigest()[:12]
+            self._digests[series] = digest
+        return 'metrics:%s:%s:%s' % (self.name, suffix, digest)
+
+    def keys(self, series):
+        raise NotImplementedError()
+
+    def render(self, series, values):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """A count that only goes up"""
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        series = _labels(labels)
+        self.series.add(series)
+        _add(self.key(series, 'total'), value)
+
+    def keys(self, series):
+        return [self.key(series, 'total')]
+
+    def render(self, series, values):
+        yield '%s%s %d' % (self.name, _format_labels(series),
+                           values.get(self.key(series, 'total'), 0))
+
+
+class Histogram(Metric):
+    """Distribution of durations in seconds"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, seconds, **labels):
+        series = _labels(labels)
+        self.series.add(series)
+        bucket = len(self.buckets)
+        for number, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                bucket = number
+                break
+        _add(self.key(series, bucket), 1)
+        _add(self.key(series, 'sum'), int(seconds * _SCALE))
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def keys(self, series):
+        keys = [self.key(series, number)
+                for number in range(len(self.buckets) + 1)]
+        return keys + [self.key(series, 'sum')]
+
+    def render(self, series, values):
+        total = 0
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for number, bound in enumerate(bounds):
+            total += values.get(self.key(series, number), 0)
+            yield '%s_bucket%s %d' % (self.name,
+                                      _format_labels(series, le=bound), total)
+        labels = _format_labels(series)
+        seconds = values.get(self.key(series, 'sum'), 0) / float(_SCALE)
+        yield '%s_sum%s %s' % (self.name, labels, repr(seconds))
+        yield '%s_count%s %d' % (self.name, labels, total)
+
+
+def timed(histogram, errors=None, **labels):
+    """Decorator that observes the run time of every call
+
+    :param histogram: The :py:class:`Histogram` to observe
+    :param errors: :py:class:`Counter` to bump when the call raises
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+        return wrapper
+    return decorator
+
+
+def collector(func):
+    """Register a function that returns extra lines for the endpoint"""
+    _COLLECTORS.append(func)
+    return func
+
+
+def flush():
+    """Add the buffered observations of this process to the cache"""
+    with _LOCK:
+        pending = dict(_PENDING)
+        _PENDING.clear()
+        _last_flush[0] = time.time()
+    for key, value in pending.items():
+        cache.incr(key, value)
+
+    # Make sure every series this process has seen is in the index
+    indexes = CACHE.get_many([metric.index_key for metric in _METRICS])
+    updates = {}
+    for metric in _METRICS:
+        known = set(indexes.get(metric.index_key) or ())
+        if not metric.series <= known:
+            updates[metric.index_key] = sorted(known | metric.series)
+    if updates:
+        CACHE.set_many(updates, None)
+
+
+def render():
+    """The metrics of every process in the prometheus text format"""
+    flush()
+    indexes = CACHE.get_many([metric.index_key for metric in _METRICS])
+    keys = []
+    for metric in _METRICS:
+        for series in indexes.get(metric.index_key) or ():
+            keys.extend(metric.keys(series))
+    values = CACHE.get_many(keys)
+
+    lines = []
+    for metric in _METRICS:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for series in indexes.get(metric.index_key) or ():
+            lines.extend(metric.render(series, values))
+    for func in _COLLECTORS:
+        lines.extend(func())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Drop the buffered and the cached metrics"""
+    with _LOCK:
+        _PENDING.clear()
+    keys = []
+    for metric in _METRICS:
+        index = CACHE.get(metric.index_key) or ()
+        for series in set(index) | metric.series:
+            keys.extend(metric.keys(series))
+        keys.append(metric.index_key)
+        metric.series.clear()
+    CACHE.delete_many(keys)
+
+
+PROVIDER_SECONDS = Histogram(
+    'dtrove_provider_seconds', 'Time spent in the provider calls')
+PROVIDER_ERRORS = Counter(
+    'dtrove_provider_errors_total', 'Provider calls that raised')
+TASK_SECONDS = Histogram(
+    'dtrove_task_seconds', 'Run time of the celery tasks')
+TASK_FAILURES = Counter(
+    'dtrove_task_failures_total', 'Celery tasks that raised')
+SSH_COMMAND_SECONDS = Histogram(
+    'dtrove_ssh_command_seconds', 'Time of every remote command')
+STATE_CACHE = Counter(
+    'dtrove_state_cache_total', 'Hits and misses of the instance status')
+
+
+def provider_call(method):
+    """Time a provider method, see :py:func:`timed`"""
+    return timed(PROVIDER_SECONDS, PROVIDER_ERRORS, method=method)
+
+
+# Task id -> time the task started in this process
+_STARTED = {}
+
+
+def _task_name(sender):
+    return getattr(sender, 'name', str(sender)).rsplit('.', 1)[-1]
+
+
+@task_prerun.connect
+def _task_started(task_id=None, **kwargs):
+    _STARTED[task_id] = time.time()
+
+
+@task_postrun.connect
+def _task_finished(task_id=None, sender=None, **kwargs):
+    started = _STARTED.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.observe(time.time() - started, task=_task_name(sender))
+    _flush_due()
+
+
+@task_failure.connect
+def _task_failed(sender=None, **kwargs):
+    TASK_FAILURES.inc(task=_task_name(sender))
+
+
+def _flush_due(**kwargs):
+    """Flush once the flush interval has passed"""
+    if time.time() - _last_flush[0] >= config.DTROVE_METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def _flush_pending(**kwargs):
+    """Flush unless there is nothing buffered"""
+    if _PENDING:
+        flush()
+
+
+request_finished.connect(_flush_due)
+worker_process_shutdown.connect(_flush_pending)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrove', '0002_auto_20140708_0318'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='key',
+            name='pooled',
+            field=models.BooleanField(default=False, help_text=b'Unassigned key in the pool', db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrove', '0003_key_pooled'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='datastore',
+            name='manager_class',
+            field=models.CharField(max_length=255, choices=[(b'dtrove.datastores.mysql.MySQLManager', b'mysql')]),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrove', '0004_datastore_managers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Span',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('stage', models.CharField(max_length=50, db_index=True)),
+                ('started', models.DateTimeField()),
+                ('ended', models.DateTimeField()),
+                ('outcome', models.CharField(default=b'ok', max_length=10)),
+                ('message', models.CharField(max_length=255, blank=True)),
+                ('cluster', models.ForeignKey(to='dtrove.Cluster')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to='dtrove.Instance', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='span',
+            index_together=set([('cluster', 'started')]),
+        ),
+    ]
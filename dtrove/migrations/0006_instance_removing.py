@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrove', '0005_span'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='removing',
+            field=models.BooleanField(default=False, help_text=b'Being removed from the cluster'),
+            preserve_default=True,
+        ),
+    ]
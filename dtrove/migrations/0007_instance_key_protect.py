@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dtrove', '0006_instance_removing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='instance',
+            name='key',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, blank=True, to='dtrove.Key', null=True),
+            preserve_default=True,
+        ),
+    ]
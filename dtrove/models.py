@@ -30,17 +30,36 @@ Available models
 
 import logging
 import os
+import time
+from contextlib import contextmanager
 from uuid import uuid4
 
 from django.core.cache import caches
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 
-from dtrove import config
-from dtrove.providers import get_provider
+from dtrove import cache, config, datastores, feed, metrics
+from dtrove.providers import LazyProvider
 
 CACHE = caches['default']
-PROVIDER = get_provider()
+LOG = logging.getLogger(__name__)
+PROVIDER = LazyProvider()
+
+#: The cached runtime state fields of an :py:class:`Instance`
+STATE_FIELDS = ('status', 'progress', 'message')
+
+#: State record of a server that has nothing cached
+EMPTY_STATE = dict.fromkeys(STATE_FIELDS + ('updated_at', 'version'))
+
+#: Status reported for a node that has no cached state yet
+UNKNOWN = 'unknown'
+
+#: Statuses of the nodes that are being removed from their cluster
+REMOVING = ('draining', 'deleting', 'deleted')
+
+# Order the nodes are picked in when a cluster shrinks, broken and
+# unfinished nodes go first
+_VICTIM_ORDER = {'error': 0, None: 1, UNKNOWN: 1, 'build': 2}
 
 
 class Cluster(models.Model):
@@ -77,16 +96,246 @@ class Cluster(models.Model):
         return self.name
 
     def add_node(self, count=1):
-        """Add a node to the cluster."""
-        current_count = self.instance_set.count()
+        """Add a node to the cluster.
+
+        The nodes are inserted in one transaction with the cluster row
+        locked, so concurrent calls can't push the cluster over the max
+        size. All the nodes in a cluster share one ssh key and are
+        provisioned with a single task.
+        """
+        with transaction.atomic():
+            cluster = Cluster.objects.select_for_update().get(pk=self.pk)
+            instance_ids = self._insert_nodes(
+                cluster, len(cluster.live_nodes()), count)
+        if instance_ids:
+            self.provision(instance_ids)
+        return instance_ids
+
+    def _insert_nodes(self, cluster, current_count, count):
+        """Insert `count` nodes, the cluster row must be locked"""
+        # The key of a node that is being removed may be deleted with it
+        key_id = (cluster.instance_set.filter(removing=False)
+                  .exclude(key=None)
+                  .values_list('key', flat=True).first())
         new_size = current_count + count
         if new_size > config.DTROVE_MAX_CLUSTER_SIZE:
             raise ValidationError('Cluster too large')
-        for x in xrange(count):
-            Instance.objects.create(name=str(uuid4()), cluster=self)
-        if new_size != self.size:
-            self.size = new_size
-            self.save()
+        if not count:
+            return []
+        if key_id is None:
+            key_id = Key.claim().pk
+        names = [str(uuid4()) for x in xrange(count)]
+        Instance.objects.bulk_create([
+            Instance(name=name, cluster=self, key_id=key_id)
+            for name in names
+        ])
+        # bulk_create doesn't set the primary keys, look them up
+        instance_ids = list(
+            self.instance_set.filter(name__in=names)
+            .order_by('pk').values_list('pk', flat=True))
+        if new_size != cluster.size:
+            Cluster.objects.filter(pk=self.pk).update(size=new_size)
+        self.size = new_size
+        return instance_ids
+
+    def resize(self, size):
+        """Grow or shrink the cluster to `size` nodes
+
+        Growing adds the nodes like :py:meth:`add_node`. Shrinking picks the
+        nodes to remove with :py:meth:`pick_victims`, marks them 'draining'
+        and removes them in the background with
+        :py:func:`dtrove.tasks.scale_down`. Nodes that are already being
+        removed don't count towards the size. Both happen with the cluster
+        row locked so concurrent resizes end at the last size asked for.
+
+        :param int size: The new number of nodes, 0 removes them all
+        :returns: tuple of (added node ids, removed node ids)
+        """
+        if size < 0 or size > config.DTROVE_MAX_CLUSTER_SIZE:
+            raise ValidationError('Invalid cluster size')
+        added = []
+        removed = []
+        with transaction.atomic():
+            cluster = Cluster.objects.select_for_update().get(pk=self.pk)
+            nodes = cluster.live_nodes()
+            if size > len(nodes):
+                added = self._insert_nodes(cluster, len(nodes),
+                                           size - len(nodes))
+            elif size < len(nodes):
+                picked = self.pick_victims(nodes, len(nodes) - size)
+                victims = list(Instance.objects.filter(
+                    pk__in=[node['id'] for node in picked]))
+                removed = [victim.pk for victim in victims]
+                # Mark them while the cluster is locked so another resize
+                # doesn't pick them again, and so a build that is still
+                # running throws its server away, see `Provider.create`
+                Instance.objects.filter(pk__in=removed).update(removing=True)
+                states = dict((victim.server, {'status': 'draining',
+                                               'progress': 0, 'message': ''})
+                              for victim in victims if victim.server)
+                if states:
+                    Instance.set_state_many(states, instances=victims)
+                Cluster.objects.filter(pk=self.pk).update(size=size)
+                self.size = size
+        # Queue the tasks once the nodes are committed
+        if added:
+            self.provision(added)
+        if removed:
+            self.scale_down(removed)
+        return added, removed
+
+    def live_nodes(self):
+        """The nodes that are not being removed, with their cached status
+
+        :returns: list of dicts with the node id, server and status
+        """
+        nodes = list(self.instance_set.filter(removing=False)
+                     .order_by('pk').values('id', 'server'))
+        states = Instance.get_state_many(
+            [node['server'] for node in nodes if node['server']])
+        for node in nodes:
+            node['status'] = states.get(node['server'], {}).get('status')
+        return nodes
+
+    @staticmethod
+    def pick_victims(nodes, count):
+        """Pick the nodes to remove when shrinking
+
+        Nodes in the 'error' state go first, then the ones that are not
+        built yet and then the newest.
+
+        :param list nodes: The nodes from :py:meth:`live_nodes`
+        :param int count: Number of nodes to pick
+        """
+        ranked = sorted(nodes, key=lambda node: (
+            _VICTIM_ORDER.get(node['status'], 3), -node['id']))
+        return ranked[:count]
+
+    def scale_down(self, instance_ids):
+        """Drain and destroy the given nodes in the background"""
+        from dtrove.tasks import scale_down
+        return scale_down.delay(self.pk, instance_ids)
+
+    def provision(self, instance_ids):
+        """Build and prepare the given nodes of this cluster in parallel"""
+        from dtrove.tasks import create_cluster
+        return create_cluster.delay(self.pk, instance_ids)
+
+    def node_states(self):
+        """The cached state of every node in this cluster
+
+        The state is read with a single cache call and the provider is never
+        called. Nodes that are missing from the cache are reported as
+        'unknown' and a refresh of their status is queued instead.
+
+        :returns: list of dicts with the node id, name, addr, server,
+                  status, progress and message
+        """
+        nodes = list(self.instance_set.order_by('pk')
+                     .values('id', 'name', 'addr', 'server'))
+        states = Instance.get_state_many(
+            [node['server'] for node in nodes if node['server']])
+        missing = []
+        for node in nodes:
+            state = states.get(node['server'], {})
+            status = state.get('status')
+            if status is None:
+                status = UNKNOWN
+                if node['server']:
+                    missing.append(node['id'])
+            node.update(status=status,
+                        progress=state.get('progress'),
+                        message=state.get('message') or '')
+        # Only queue one refresh per cluster every poll interval
+        if missing and CACHE.add('refresh:%s' % self.pk, True,
+                                 config.DTROVE_POLL_INTERVAL):
+            self.refresh_status(missing)
+        return nodes
+
+    @staticmethod
+    def aggregate(nodes):
+        """Combine the state of the nodes into the cluster status
+
+        :param list nodes: The node states from :py:meth:`node_states`
+        :returns: tuple of (status, progress) where progress is the average
+                  progress of the nodes
+        """
+        statuses = set(node['status'] for node in nodes)
+        if 'error' in statuses:
+            status = 'error'
+        elif statuses == set(['active']):
+            status = 'active'
+        elif not statuses or statuses == set([UNKNOWN]):
+            status = UNKNOWN
+        else:
+            status = 'build'
+
+        if not nodes:
+            return status, 0
+        total = sum(100 if node['status'] == 'active'
+                    else node['progress'] or 0 for node in nodes)
+        return status, total // len(nodes)
+
+    def refresh_status(self, instance_ids):
+        """Refresh the cached status of the given nodes in the background"""
+        from dtrove.tasks import refresh_status
+        return refresh_status.delay(instance_ids)
+
+    def timeline(self):
+        """The recorded build stages of this cluster as a waterfall
+
+        Offsets are in seconds from the start of the first stage. Read with
+        a single query.
+
+        :returns: dict with the `started` time, total `duration`, a summary
+                  of each stage and the spans of each node
+        """
+        spans = list(Span.objects.filter(cluster=self)
+                     .order_by('started', 'pk')
+                     .values('instance', 'instance__name', 'stage',
+                             'started', 'ended', 'outcome', 'message'))
+        if not spans:
+            return {'started': None, 'duration': 0, 'stages': {},
+                    'hosts': []}
+
+        start = spans[0]['started']
+        end = max(span['ended'] for span in spans)
+        stages = {}
+        hosts = {}
+        for span in spans:
+            duration = (span['ended'] - span['started']).total_seconds()
+            stage = stages.setdefault(span['stage'], {
+                'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stage['count'] += 1
+            stage['total'] += duration
+            stage['max'] = max(stage['max'], duration)
+            if span['outcome'] != 'ok':
+                stage['errors'] += 1
+
+            host = hosts.setdefault(span['instance'], {
+                'instance': span['instance'],
+                'name': span['instance__name'],
+                'duration': 0.0,
+                'spans': [],
+            })
+            offset = (span['started'] - start).total_seconds()
+            host['duration'] = max(host['duration'], offset + duration)
+            host['spans'].append({
+                'stage': span['stage'],
+                'offset': offset,
+                'duration': duration,
+                'outcome': span['outcome'],
+                'message': span['message'],
+            })
+        for stage in stages.values():
+            stage['mean'] = stage.pop('total') / stage['count']
+        return {
+            'started': start,
+            'duration': (end - start).total_seconds(),
+            'stages': stages,
+            'hosts': sorted(hosts.values(),
+                            key=lambda host: host['instance'] or 0),
+        }
 
     def save(self, *args, **kwargs):
         if self.size > config.DTROVE_MAX_CLUSTER_SIZE:
@@ -129,16 +378,25 @@ class Datastore(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        super(Datastore, self).save(*args, **kwargs)
+        datastores.forget(self)
+
     @property
     def manager(self):
         """The manager object initialize with this datastores information"""
-        from django.utils.module_loading import import_string
-        return import_string(self.manager_class)(self)
+        return datastores.get_manager(self)
 
     @property
     def name(self):
         """The display name of the datastore (manager.name - version)"""
-        return '%s-%s' % (self.manager.name, self.version)
+        return self.format_name(self.manager_class, self.version)
+
+    @staticmethod
+    def format_name(manager_class, version):
+        """The display name of a datastore without loading the datastore"""
+        cls = datastores.get_manager_class(manager_class)
+        return '%s-%s' % (cls.manager_name(), version)
 
 
 class Key(models.Model):
@@ -164,28 +422,129 @@ class Key(models.Model):
     You can access the information in this key in the
     :py:data:`dtrove.models.Instance.connection_info` property on the
     instance(s) the key is attached to.
+
+    Generating a key is slow, so the `dtrove.tasks.fill_key_pool` task keeps
+    :py:attr:`dtrove.config.DTROVE_KEY_POOL_SIZE` keys ready with `pooled`
+    set. New instances :py:meth:`claim` one of those instead.
     """
     name = models.CharField(max_length=50)
     passphrase = models.CharField(max_length=512, blank=True)
     private = models.TextField(blank=True)
     public = models.TextField(blank=True)
+    pooled = models.BooleanField(default=False, db_index=True,
+                                 help_text='Unassigned key in the pool')
 
     def __unicode__(self):
         return self.name
 
+    @staticmethod
+    def generate(key_type=None):
+        """Generate a new key pair
+
+        :param str key_type: 'rsa' or 'ed25519', defaults to
+                             :py:attr:`dtrove.config.DTROVE_SSH_KEY_TYPE`
+        :returns: tuple of the (public, private) keys
+        """
+        key_type = key_type or config.DTROVE_SSH_KEY_TYPE
+        if key_type == 'rsa':
+            from Crypto.PublicKey import RSA
+            key = RSA.generate(2048, os.urandom)
+            return key.exportKey('OpenSSH'), key.exportKey('PEM')
+        elif key_type == 'ed25519':
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric import ed25519
+            key = ed25519.Ed25519PrivateKey.generate()
+            public = key.public_key().public_bytes(
+                serialization.Encoding.OpenSSH,
+                serialization.PublicFormat.OpenSSH)
+            private = key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.OpenSSH,
+                serialization.NoEncryption())
+            return public, private
+        raise ValueError('Unknown key type: %s' % key_type)
+
     @classmethod
-    def create(cls, save=True):
+    def create(cls, save=True, pooled=False):
         """Factory method to create a new private/public key pair"""
-        from Crypto.PublicKey import RSA
         name = str(uuid4())
-        key = RSA.generate(2048, os.urandom)
-        public = key.exportKey('OpenSSH')
-        private = key.exportKey('PEM')
-        obj = cls.objects.create(name=name, public=public, private=private)
+        public, private = cls.generate()
+        obj = cls.objects.create(name=name, public=public, private=private,
+                                 pooled=pooled)
         if save:
             obj.save()
         return obj
 
+    @classmethod
+    def claim(cls):
+        """Take a key out of the pool, or create one if the pool is empty
+
+        Each candidate is claimed with a conditional update so two workers
+        never get the same key, a worker that loses the race moves on to the
+        next one rather than waiting on a lock.
+        """
+        candidates = cls.objects.filter(pooled=True).values_list('pk',
+                                                                 flat=True)
+        for pk in candidates[:config.DTROVE_KEY_POOL_CLAIM_TRIES]:
+            if cls.objects.filter(pk=pk, pooled=True).update(pooled=False):
+                cache.incr('key_pool:claims')
+                return cls.objects.get(pk=pk)
+        cache.incr('key_pool:empty')
+        return cls.create(save=True)
+
+    @classmethod
+    def pending(cls):
+        """Number of pool keys that are queued but not generated yet"""
+        return max(0, CACHE.get('key_pool:pending') or 0)
+
+    @classmethod
+    def add_pending(cls, count):
+        """Count keys that were queued to be generated
+
+        The counter expires after
+        :py:attr:`dtrove.config.DTROVE_KEY_POOL_PENDING_TIMEOUT` seconds so
+        tasks that were lost don't keep the pool from filling forever.
+        """
+        cache.incr('key_pool:pending', count,
+                   config.DTROVE_KEY_POOL_PENDING_TIMEOUT)
+
+    @classmethod
+    def done_pending(cls):
+        """Count a queued key as generated"""
+        try:
+            CACHE.decr('key_pool:pending')
+        except ValueError:
+            # Expired, the next refill starts from the pool level again
+            pass
+
+    @classmethod
+    def record_pool_level(cls, available):
+        """Remember the lowest number of keys seen in the pool"""
+        low_water = CACHE.get('key_pool:low_water')
+        if low_water is None or available < low_water:
+            CACHE.set('key_pool:low_water', available, None)
+        CACHE.set('key_pool:available', available, None)
+
+    @classmethod
+    def pool_stats(cls):
+        """Return the available, low water, claims and empty counters"""
+        names = ('available', 'low_water', 'claims', 'empty')
+        found = CACHE.get_many(['key_pool:%s' % name for name in names])
+        return dict((name, found.get('key_pool:%s' % name, 0))
+                    for name in names)
+
+
+@metrics.collector
+def _key_pool_metrics():
+    stats = Key.pool_stats()
+    for name, kind in (('available', 'gauge'), ('low_water', 'gauge'),
+                       ('claims', 'counter'), ('empty', 'counter')):
+        metric = 'dtrove_key_pool_%s' % name
+        if kind == 'counter':
+            metric += '_total'
+        yield '# TYPE %s %s' % (metric, kind)
+        yield '%s %d' % (metric, stats[name])
+
 
 class Instance(models.Model):
     """Instance
@@ -206,67 +565,191 @@ class Instance(models.Model):
               thought the cluster model and or the manager class on the
               cluster
 
-    Remote operations can be preformed on this instance by using the
-    connection_info property like so::
+    Remote operations can be preformed on this instance by borrowing a
+    connection from the ssh pool, which uses the connection_info property,
+    like so::
 
-        from fabric.api import sudo, settings
-        from fabric.network import disconnect_all
+        from fabric.api import sudo
         from dtrove.models import Instance
+        from dtrove.ssh import POOL
 
         instance = Instance.objects.first()
 
-        with settings(**instance.connection_info):
+        with POOL.connection(instance):
             sudo('rm -rf /etc/trove/*')
 
-        # Always remember to disconnect ssh sessions
-        disconnect_all()
+    The connection stays open for the next command, see
+    :py:mod:`dtrove.ssh`.
 
     See the :py:class:`dtrove.datastores.base.BaseManager` class for more
     examples.
     """
     name = models.CharField(max_length=255)
     cluster = models.ForeignKey(Cluster)
-    key = models.ForeignKey(Key, null=True, blank=True)
+    # Protected so removing a node can't take the key of a new one with it
+    key = models.ForeignKey(Key, null=True, blank=True,
+                            on_delete=models.PROTECT)
     user = models.CharField(max_length=25, default=config.DTROVE_SSH_USER)
     addr = models.GenericIPAddressField(null=True, blank=True)
     server = models.CharField(max_length=36, blank=True,
                               help_text='Nova server UUID')
+    removing = models.BooleanField(default=False,
+                                   help_text='Being removed from the cluster')
 
     def __unicode__(self):
         return self.name
 
+    @staticmethod
+    def state_key(server):
+        """Cache key of the state record of a server"""
+        return 'state:%s' % server
+
+    @property
+    def state(self):
+        """The cached state record of the server
+
+        A dict of the `STATE_FIELDS` plus the `updated_at` time and the
+        `version` of the record, the version goes up by one on every write.
+        """
+        record = dict(EMPTY_STATE)
+        record.update(CACHE.get(self.state_key(self.server)) or {})
+        return record
+
+    def set_state(self, **state):
+        """Write some of the `STATE_FIELDS` of this server"""
+        versions = self.set_state_many({self.server: state},
+                                       instances=[self])
+        return versions[self.server]
+
     @property
     def server_status(self):
         """Status of the server"""
-        status = CACHE.get('status:%s' % self.server)
+        status = self.state['status']
         if status is None:
+            metrics.STATE_CACHE.inc(result='miss')
             status, progress = PROVIDER.update_status(self)
+        else:
+            metrics.STATE_CACHE.inc(result='hit')
         return status
 
     @server_status.setter
     def server_status(self, status):
-        CACHE.set('status:%s' % self.server, status)
+        self.set_state(status=status)
 
     @property
     def progress(self):
         """Progress of the current server task"""
-        progress = CACHE.get('progress:%s' % self.server)
+        progress = self.state['progress']
         if progress is None:
+            metrics.STATE_CACHE.inc(result='miss')
             status, progress = PROVIDER.update_status(self)
+        else:
+            metrics.STATE_CACHE.inc(result='hit')
         return progress
 
     @progress.setter
     def progress(self, percent):
-        CACHE.set('progress:%s' % self.server, percent)
+        self.set_state(progress=percent)
 
     @property
     def message(self):
         """Error message of the last server task"""
-        return CACHE.get('message:%s' % self.server, '')
+        return self.state['message'] or ''
 
     @message.setter
     def message(self, msg):
-        CACHE.set('message:%s' % self.server, msg)
+        self.set_state(message=msg)
+
+    @staticmethod
+    def get_state_many(servers):
+        """Read the cached state of many servers in a single cache call
+
+        :param list servers: The nova server ids to look up
+        :returns: dict of server id to its state record, any field that is
+                  not cached is None
+        """
+        keys = dict((Instance.state_key(server), server) for server in servers)
+        found = CACHE.get_many(keys.keys())
+        states = {}
+        for key, server in keys.items():
+            states[server] = dict(EMPTY_STATE)
+            states[server].update(found.get(key) or {})
+        return states
+
+    @staticmethod
+    @contextmanager
+    def lock_states(servers):
+        """Hold the write locks of the state records of `servers`
+
+        The locks are cache keys taken with `add`, in order so two writers
+        can't each wait on a lock the other holds. A lock left by a crashed
+        writer expires after `DTROVE_STATE_LOCK_TIMEOUT` seconds.
+        """
+        held = []
+        try:
+            for server in sorted(servers):
+                key = '%s:lock' % Instance.state_key(server)
+                while not CACHE.add(key, 1,
+                                    config.DTROVE_STATE_LOCK_TIMEOUT):
+                    time.sleep(0.01)
+                held.append(key)
+            yield
+        finally:
+            CACHE.delete_many(held)
+
+    @staticmethod
+    def set_state_many(states, observed=None, instances=()):
+        """Write the cached state of many servers
+
+        The records are locked with :py:meth:`lock_states`, read with one
+        cache call, merged and written back with another, so two writers
+        that change different fields of a record don't lose each other's
+        update. A record is only replaced when the new state was observed
+        at or after the time of the record, so a slow poller can't
+        overwrite the state that a newer poll already wrote.
+
+        Every record that changed is also published to the
+        :py:mod:`dtrove.feed` of its cluster when the instance is given.
+
+        :param dict states: server id to a dict with any of the `STATE_FIELDS`
+        :param float observed: Time the state was read from the provider,
+                               defaults to now
+        :param list instances: The instances of the servers, used to find
+                               the cluster feed to publish to
+        :returns: dict of server id to the new version of the record, or
+                  None if the record was newer and left alone
+        """
+        data = {}
+        versions = {}
+        with Instance.lock_states(states.keys()):
+            if observed is None:
+                observed = time.time()
+            current = Instance.get_state_many(states.keys())
+            for server, state in states.items():
+                record = current[server]
+                if record['updated_at'] is not None and \
+                        record['updated_at'] > observed:
+                    LOG.debug('Skipping stale state for %s', server)
+                    versions[server] = None
+                    continue
+                record.update(state)
+                record['updated_at'] = observed
+                record['version'] = (record['version'] or 0) + 1
+                data[Instance.state_key(server)] = record
+                versions[server] = record['version']
+            if data:
+                CACHE.set_many(data)
+
+        events = {}
+        for instance in instances:
+            record = data.get(Instance.state_key(instance.server))
+            if record is not None:
+                event = dict(record, instance=instance.pk,
+                             server=instance.server)
+                events.setdefault(instance.cluster_id, []).append(event)
+        for cluster_id, cluster_events in events.items():
+            feed.publish(cluster_id, cluster_events)
+        return versions
 
     @property
     def connection_info(self):
@@ -284,8 +767,41 @@ class Instance(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.key:
-            self.key = Key.create(save=True)
+            self.key = Key.claim()
         created = not self.pk
         super(Instance, self).save(*args, **kwargs)
         if created:
             self.provision()
+
+
+class Span(models.Model):
+    """Span
+
+    How long one stage of building a node took, see :py:mod:`dtrove.tracing`
+
+    :param cluster: Cluster that was being built
+    :param instance: The node, the span is kept if the node is removed
+    :param str stage: Name of the stage ie 'boot'
+    :param datetime started: When the stage started
+    :param datetime ended: When the stage finished
+    :param str outcome: 'ok' or 'error'
+    :param str message: The error of a failed stage
+    """
+    cluster = models.ForeignKey(Cluster)
+    instance = models.ForeignKey(Instance, null=True, blank=True,
+                                 on_delete=models.SET_NULL)
+    stage = models.CharField(max_length=50, db_index=True)
+    started = models.DateTimeField()
+    ended = models.DateTimeField()
+    outcome = models.CharField(max_length=10, default='ok')
+    message = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        index_together = [('cluster', 'started')]
+
+    def __unicode__(self):
+        return self.stage
+
+    @property
+    def duration(self):
+        return (self.ended - self.started).total_seconds()
@@ -1,2 +1,2 @@
 
-from .base import get_provider
+from .base import LazyProvider, get_provider, reset_provider
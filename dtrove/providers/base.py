@@ -12,24 +12,54 @@ Here is a example::
 
     from celery import shared_task
     from dtrove.models import Instance
-    from dtrove.provider import get_provider
+    from dtrove.providers import LazyProvider
 
-    provider = get_provider()
+    provider = LazyProvider()
 
     @shared_task
     def create(instance_id):
         instance = Instance.objects.get(pk=instance_id)
         provider.create(instance)
 
+The provider, and the cloud client libraries it uses, are only imported
+when it is first used so processes that never talk to the cloud don't pay
+for them.
 """
 
+import threading
+
 from dtrove import config
 
+_PROVIDER = None
+_PROVIDER_LOCK = threading.Lock()
+
 
 def get_provider():
-    "Return the current provider class"
-    from django.utils.module_loading import import_string
-    return import_string(config.DTROVE_PROVIDER)()
+    "Return the current provider, it is created on the first call"
+    global _PROVIDER
+    if _PROVIDER is None:
+        with _PROVIDER_LOCK:
+            if _PROVIDER is None:
+                from django.utils.module_loading import import_string
+                _PROVIDER = import_string(config.DTROVE_PROVIDER)()
+    return _PROVIDER
+
+
+def reset_provider():
+    "Forget the current provider, the next call creates a new one"
+    global _PROVIDER
+    with _PROVIDER_LOCK:
+        _PROVIDER = None
+
+
+class LazyProvider(object):
+    """Stand in for the current provider that looks it up on use"""
+
+    def __getattr__(self, name):
+        return getattr(get_provider(), name)
+
+    def __repr__(self):
+        return '<LazyProvider %s>' % config.DTROVE_PROVIDER
 
 
 class ProviderError(Exception):
@@ -54,9 +84,15 @@ class BaseProvider(object):
             If the create failed
 
         Typically the provider should respond with a 202 message and work
-        in the background to create the instance. So during creation of the
-        instance on the provider this should update the progress field of the
-        instance.
+        in the background to create the instance. This method should return
+        as soon as the build is requested, do not wait for the server here.
+        The :py:func:`dtrove.tasks.wait_for_server` task polls
+        `update_status` until the server is active without holding a worker.
+
+        Set the server with an update of only the `server` and `addr`
+        fields for instances that are not `removing`. When the instance was
+        removed from its cluster during the boot destroy the new server
+        instead.
 
         The provider should update instance with the following info:
 
@@ -78,23 +114,38 @@ class BaseProvider(object):
             If the status failed
         :returns: tuple of (status, progress)
 
-        A call to this method should set the properties on the instance. For
-        example here::
+        A call to this method should write the state of the instance in a
+        single call. For example here::
 
             def update_status(self, instance):
                 obj = self.get(instance.id)
 
-                instance.message = obj.error_message
-                instance.server_status = obj.status
-                instance.progress = obj.progress
+                instance.set_state(status=obj.status,
+                                   progress=obj.progress,
+                                   message=obj.error_message)
 
-                return instance.server_status, instance.progress
+                return obj.status, obj.progress
 
         * `status` property should be a string of the current status
         * `progress` property should be an int which is the percent complete
         """
         raise NotImplementedError()
 
+    def update_status_bulk(self, instances):
+        """Updates the status of many instances at once
+
+        :param instances: The instances to refresh
+        :type instances: list of :py:class:`dtrove.models.Instance`
+        :raises: :py:class:`dtrove.providers.base.ProviderError`
+            If the status failed
+        :returns: dict of instance id to a tuple of (status, progress)
+
+        Providers that can list all of their servers in one call should
+        override this, by default it calls `update_status` on each instance.
+        """
+        return dict((instance.pk, self.update_status(instance))
+                    for instance in instances)
+
     def destroy(self, instance):
         """Destroys an instance
 
@@ -107,6 +158,18 @@ class BaseProvider(object):
         """
         raise NotImplementedError()
 
+    def delete_key(self, key):
+        """Removes an ssh key pair from the provider
+
+        :param key: The key that no instance uses anymore
+        :type key: :py:class:`dtrove.models.Key`
+        :raises: :py:class:`dtrove.providers.base.ProviderError`
+            If the delete failed
+
+        A key that doesn't exist on the provider should be ignored.
+        """
+        raise NotImplementedError()
+
     def snapshot(self, instance):
         """Creates a snapshot of an instance
 
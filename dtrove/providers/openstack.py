@@ -1,12 +1,96 @@
-
+import hashlib
+import logging
+import re
+import threading
 import time
+from datetime import datetime, timedelta
+from functools import wraps
 
+from django.core.cache import caches
+from django.utils import timezone
+from novaclient import exceptions as nova_exceptions
 from novaclient.v1_1 import client as nova_client
 from cinderclient.v2 import client as cinder_client
 from keystoneclient.v2_0 import client as keystone_client
 
-from dtrove import config
-from .base import BaseProvider
+from dtrove import cache, config, metrics, ratelimit, tracing
+from .base import BaseProvider, ProviderError
+
+CACHE = caches['default']
+LOG = logging.getLogger(__name__)
+
+#: Names of the counters kept for the shared token cache
+TOKEN_STATS = ('hits', 'misses', 'auths', 'waits')
+
+# Nova clients are expensive to build (each one sets up its own HTTP
+# session) so they are cached per process, keyed by the credentials and
+# region they were built for. Each entry is a tuple of (auth_token, client).
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def clear_clients():
+    """Drop every cached nova client in this process."""
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
+def _count(name):
+    """Bump one of the shared token counters"""
+    cache.incr('os_token_stats:%s' % name)
+
+
+def token_stats():
+    """Return the hit/miss counters of the shared token cache"""
+    keys = dict(('os_token_stats:%s' % name, name) for name in TOKEN_STATS)
+    found = CACHE.get_many(keys.keys())
+    return dict((name, found.get(key, 0)) for key, name in keys.items())
+
+
+def _naive_utc(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def reauth(func):
+    """Retry the wrapped call once with a fresh token on a 401 response."""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except nova_exceptions.Unauthorized:
+            self.invalidate()
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+# RateLimit (429) is not a subclass of OverLimit (413) in every novaclient
+_OVER_LIMIT = (nova_exceptions.OverLimit, nova_exceptions.RateLimit)
+
+
+def throttled(endpoint):
+    """Pace the wrapped nova call with the shared rate limit of an endpoint
+
+    A 413 or 429 response slows every worker down and the call is retried
+    up to :py:attr:`dtrove.config.DTROVE_RATE_LIMIT_RETRIES` times, see
+    :py:mod:`dtrove.ratelimit`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            limiter = ratelimit.limiter(endpoint)
+            retries = config.DTROVE_RATE_LIMIT_RETRIES
+            for attempt in range(retries + 1):
+                limiter.acquire()
+                try:
+                    return func(self, *args, **kwargs)
+                except _OVER_LIMIT as exc:
+                    limiter.backoff(exc.retry_after)
+                    if attempt == retries:
+                        raise ratelimit.RateLimited(str(exc))
+        return wrapper
+    return decorator
 
 
 class Provider(BaseProvider):
@@ -19,27 +103,98 @@ class Provider(BaseProvider):
         self.region_name = 'IAD'
         self.endpoints = None
         self.auth_token = None
+        self.expires = None
 
-    def _auth(self):
+    @property
+    def cache_key(self):
+        return (self.username, self.project_id, self.auth_url,
+                self.region_name)
+
+    @property
+    def token_key(self):
+        """Key of the token shared by every worker using these credentials"""
+        ident = '|'.join([self.username or '', self.project_id or '',
+                          self.auth_url or ''])
+        return 'os_token:%s' % hashlib.md5(ident).hexdigest()
+
+    def _stale(self, expires):
+        stale = timedelta(seconds=config.OS_TOKEN_STALE_DURATION)
+        return expires - stale <= datetime.utcnow()
+
+    def _load(self, token):
+        self.auth_token = token['auth_token']
+        self.expires = token['expires']
+        self.endpoints = token['endpoints']
+
+    def _cached_token(self):
+        token = CACHE.get(self.token_key)
+        if token is not None and not self._stale(token['expires']):
+            return token
+
+    def _authenticate(self):
+        """Get a new token from keystone and share it with the workers"""
+        _count('auths')
         self.ks = keystone_client.Client(username=self.username,
                                          password=self.password,
                                          project_id=self.project_id,
                                          auth_url=self.auth_url)
         auth_ref = self.ks.auth_ref
-        self.auth_token = auth_ref.auth_token
-        self.endpoints = auth_ref.service_catalog.get_endpoints()
+        token = {
+            'auth_token': auth_ref.auth_token,
+            'expires': _naive_utc(auth_ref.expires),
+            'endpoints': auth_ref.service_catalog.get_endpoints(),
+        }
+        lifetime = token['expires'] - datetime.utcnow()
+        timeout = (lifetime.days * 86400 + lifetime.seconds -
+                   config.OS_TOKEN_STALE_DURATION)
+        if timeout > 0:
+            CACHE.set(self.token_key, token, timeout)
+        return token
 
-    def _poll(self, instance):
-        while True:
-            status, progress = self.update_status(instance)
+    def _auth(self):
+        token = self._cached_token()
+        if token is not None:
+            _count('hits')
+            return self._load(token)
 
-            if status in ['active']:
-                instance.progress = 100
-                break
-            elif status == "error":
-                raise Exception(instance.message)
+        _count('misses')
+        lock_key = '%s:lock' % self.token_key
+        lock_timeout = config.OS_TOKEN_LOCK_TIMEOUT
+        if CACHE.add(lock_key, 1, lock_timeout):
+            try:
+                token = self._authenticate()
+            finally:
+                CACHE.delete(lock_key)
+            return self._load(token)
+
+        # Another worker is talking to keystone, wait for it to finish
+        # rather than piling on.
+        _count('waits')
+        deadline = time.time() + lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.1)
+            token = self._cached_token()
+            if token is not None:
+                return self._load(token)
+        self._load(self._authenticate())
 
-            time.sleep(5)
+    def _expiring(self):
+        """Whether the current token is missing or about to expire"""
+        if self.auth_token is None or self.expires is None:
+            return True
+        return self._stale(self.expires)
+
+    def invalidate(self):
+        """Forget the current token and the client built with it"""
+        with _CLIENTS_LOCK:
+            _CLIENTS.pop(self.cache_key, None)
+        token = CACHE.get(self.token_key)
+        # Only drop the shared token if another worker hasn't replaced it
+        if token is not None and token['auth_token'] == self.auth_token:
+            CACHE.delete(self.token_key)
+        self.auth_token = None
+        self.expires = None
+        self.endpoints = None
 
     def url(self, service):
         if self.endpoints is None:
@@ -52,41 +207,198 @@ class Provider(BaseProvider):
 
     @property
     def nova(self):
-        if self.auth_token is None:
+        if self._expiring():
             self._auth()
-        return nova_client.Client(username=self.username,
-                                  api_key=self.password,
-                                  project_id=self.project_id,
-                                  auth_token=self.auth_token,
-                                  region_name=self.region_name,
-                                  auth_url=self.auth_url,
-                                  bypass_url=self.url('compute'))
-
-    def update_status(self, instance):
-        if not instance.server:
-            return 'NA', 0
-        obj = self.nova.servers.get(instance.server)
+        with _CLIENTS_LOCK:
+            token, client = _CLIENTS.get(self.cache_key, (None, None))
+            if client is None or token != self.auth_token:
+                client = nova_client.Client(username=self.username,
+                                            api_key=self.password,
+                                            project_id=self.project_id,
+                                            auth_token=self.auth_token,
+                                            region_name=self.region_name,
+                                            auth_url=self.auth_url,
+                                            bypass_url=self.url('compute'),
+                                            connection_pool=True)
+                _CLIENTS[self.cache_key] = (self.auth_token, client)
+        return client
 
+    def _state(self, obj):
+        """Pull the status, progress and error message off a nova server"""
         status = getattr(obj, 'status', 'none').lower()
         progress = getattr(obj, 'progress', None) or 0
-
+        message = None
         if status == "error":
-            instance.message = obj.fault['message']
+            message = obj.fault['message']
+        return status, progress, message
+
+    @reauth
+    @throttled('read')
+    def _get(self, server):
+        return self.nova.servers.get(server)
 
-        instance.server_status = status
-        instance.progress = progress
+    @metrics.provider_call('update_status')
+    def update_status(self, instance):
+        if not instance.server:
+            return 'NA', 0
+        observed = time.time()
+        obj = self._get(instance.server)
+
+        status, progress, message = self._state(obj)
+        state = {'status': status, 'progress': progress}
+        if message is not None:
+            state['message'] = message
+        instance.set_state_many({instance.server: state}, observed,
+                                [instance])
         if not instance.addr:
             instance.addr = obj.accessIPv4
-            instance.save()
+            instance.save(update_fields=['addr'])
 
         return status, progress
 
+    @reauth
+    @throttled('read')
+    def _list(self, marker=None):
+        """One page of the servers that dtrove booted"""
+        search = {'name': '^%s' % re.escape(config.DTROVE_SERVER_PREFIX)}
+        return self.nova.servers.list(detailed=True, search_opts=search,
+                                      marker=marker,
+                                      limit=config.DTROVE_LIST_PAGE_SIZE)
+
+    def _find(self, wanted):
+        """Page through the servers until all the `wanted` ids are seen
+
+        Nova caps the page size at its `osapi_max_limit` so this keeps
+        asking for the next page until one comes back empty.
+        """
+        servers = {}
+        marker = None
+        while True:
+            page = self._list(marker)
+            if not page:
+                break
+            servers.update((obj.id, obj) for obj in page)
+            if wanted.issubset(servers):
+                break
+            marker = page[-1].id
+        return servers
+
+    @metrics.provider_call('update_status_bulk')
+    def update_status_bulk(self, instances):
+        observed = time.time()
+        wanted = set(instance.server for instance in instances
+                     if instance.server)
+        servers = self._find(wanted) if wanted else {}
+        results = {}
+        states = {}
+        model = None
+        for instance in instances:
+            model = instance.__class__
+            if not instance.server:
+                results[instance.pk] = ('NA', 0)
+                continue
+            obj = servers.get(instance.server)
+            if obj is None:
+                # Servers booted before they were named with the prefix
+                try:
+                    obj = self._get(instance.server)
+                except nova_exceptions.NotFound:
+                    LOG.warning('Server %s for instance %s not found',
+                                instance.server, instance.pk)
+                    # Stop polling for it, nova won't bring it back
+                    states[instance.server] = {
+                        'status': 'error', 'progress': 0,
+                        'message': 'Server not found'}
+                    results[instance.pk] = ('error', 0)
+                    continue
+
+            status, progress, message = self._state(obj)
+            state = {'status': status, 'progress': progress}
+            if message is not None:
+                state['message'] = message
+            states[instance.server] = state
+
+            if not instance.addr and obj.accessIPv4:
+                instance.addr = obj.accessIPv4
+                instance.save(update_fields=['addr'])
+
+            results[instance.pk] = (status, progress)
+
+        if states:
+            model.set_state_many(states, observed, instances)
+        return results
+
+    @reauth
+    @throttled('read')
+    def _get_keypair(self, name):
+        return self.nova.keypairs.get(name)
+
+    @reauth
+    @throttled('create')
+    def _create_keypair(self, key):
+        return self.nova.keypairs.create(name=key.name, public_key=key.public)
+
+    @metrics.provider_call('create_key')
     def create_key(self, key):
         try:
-            existing = self.nova.keypairs.get(key.name)
+            existing = self._get_keypair(key.name)
+        except (nova_exceptions.Unauthorized, ProviderError):
+            raise
         except:
-            self.nova.keypairs.create(name=key.name, public_key=key.public)
+            self._create_keypair(key)
+
+    @reauth
+    @throttled('create')
+    def _delete_keypair(self, name):
+        return self.nova.keypairs.delete(name)
+
+    @metrics.provider_call('delete_key')
+    def delete_key(self, key):
+        try:
+            self._delete_keypair(key.name)
+        except nova_exceptions.NotFound:
+            pass
+
+    @reauth
+    @throttled('create')
+    def _delete(self, server):
+        return self.nova.servers.delete(server)
+
+    @metrics.provider_call('destroy')
+    def destroy(self, instance):
+        if not instance.server:
+            return
+        try:
+            self._delete(instance.server)
+        except nova_exceptions.NotFound:
+            return
+        deadline = time.time() + config.DTROVE_DESTROY_TIMEOUT
+        delay = config.DTROVE_BUILD_POLL_DELAY
+        while True:
+            try:
+                self._get(instance.server)
+            except nova_exceptions.NotFound:
+                return
+            # A server that failed to build can stay in 'error' while it is
+            # deleted, so only the timeout gives up on it.
+            if time.time() > deadline:
+                raise ProviderError('Timed out waiting for the server to '
+                                    'be deleted')
+            time.sleep(delay)
+            delay = min(delay * 2, config.DTROVE_BUILD_POLL_MAX_DELAY)
+
+    @reauth
+    @throttled('create')
+    def _boot(self, instance, image, flavor):
+        # The prefix lets the bulk poll ask for only the dtrove servers
+        return self.nova.servers.create(
+            name=config.DTROVE_SERVER_PREFIX + instance.name,
+            image=image,
+            flavor=flavor,
+            meta={'dtrove_cluster': str(instance.cluster_id)},
+            key_name=instance.key.name)
 
+    @metrics.provider_call('create')
     def create(self, instance):
         cluster = instance.cluster
         datastore = cluster.datastore
@@ -95,14 +407,19 @@ class Provider(BaseProvider):
         # TODO: don't hard code this
         flavor = '3'
         # First create a keypair to log in with
-        self.create_key(key)
-        server = self.nova.servers.create(name=instance.name,
-                                          image=image,
-                                          flavor=flavor,
-                                          key_name=key.name)
-        time.sleep(3)
-        server = self.nova.servers.get(server.id)
+        with tracing.span('keypair', instance):
+            self.create_key(key)
+        with tracing.span('boot', instance):
+            server = self._boot(instance, image, flavor)
         instance.server = server.id
-        instance.addr = server.accessIPv4
-        instance.save()
-        self._poll(instance)
+        instance.addr = getattr(server, 'accessIPv4', None) or None
+        # Only the new fields are written so a node that was deleted while
+        # it booted is not inserted again
+        updated = type(instance).objects.filter(
+            pk=instance.pk, removing=False
+        ).update(server=instance.server, addr=instance.addr)
+        if not updated:
+            LOG.info('Instance %s was removed while it booted', instance.pk)
+            self.destroy(instance)
+            return
+        instance.set_state(status='build', progress=0)
@@ -0,0 +1,137 @@
+"""
+Rate Limits
+===========
+
+Paces the calls every worker makes to the cloud api so the fleet as a whole
+stays under the quota of the account. Each endpoint gets a budget of
+requests per window in :py:attr:`dtrove.config.DTROVE_RATE_LIMITS`::
+
+    DTROVE_RATE_LIMITS = {
+        'create': (10, 60),   # 10 writes a minute
+        'read': (120, 60),    # 120 reads a minute
+    }
+
+The budget is shared through the cache: every call takes a token from the
+counter of the current window and waits for the next window once it is
+empty. The cache has no compare and swap, so the bucket is refilled in one
+go at the start of each window rather than a little at a time::
+
+    from dtrove import ratelimit
+
+    ratelimit.limiter('create').acquire()
+    nova.servers.create(...)
+
+When the api answers with a 413 or 429 anyway, call
+:py:meth:`Limiter.backoff` with the Retry-After seconds. Every worker then
+waits that long and the budget is cut in half, it grows back by
+:py:attr:`dtrove.config.DTROVE_RATE_LIMIT_RECOVERY` every window. So the
+budget settles just under the real quota instead of bouncing off it.
+"""
+
+import random
+import threading
+import time
+
+from django.core.cache import caches
+
+from dtrove import cache, config
+from dtrove.providers.base import ProviderError
+
+CACHE = caches['default']
+
+#: Smallest fraction of the budget a backoff can cut it to
+MIN_SCALE = 0.1
+
+_LIMITERS = {}
+_LOCK = threading.Lock()
+
+
+class RateLimited(ProviderError):
+    """Waited longer than `DTROVE_RATE_LIMIT_MAX_WAIT` for the api"""
+
+
+class Limiter(object):
+    """Shared request budget of one endpoint
+
+    :param str name: The key in :py:attr:`dtrove.config.DTROVE_RATE_LIMITS`
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def _key(self, suffix):
+        return 'ratelimit:%s:%s' % (self.name, suffix)
+
+    @property
+    def limit(self):
+        """The configured (requests, seconds) or None"""
+        return config.DTROVE_RATE_LIMITS.get(self.name)
+
+    @property
+    def scale(self):
+        """Fraction of the budget that is in use after backoffs"""
+        return CACHE.get(self._key('scale'), 1.0)
+
+    def budget(self):
+        requests, seconds = self.limit
+        return max(1, int(requests * self.scale))
+
+    def _recover(self):
+        scale = self.scale
+        if scale < 1:
+            scale = min(1.0, scale + config.DTROVE_RATE_LIMIT_RECOVERY)
+            CACHE.set(self._key('scale'), scale, None)
+
+    def _take(self, now):
+        """Take a token, returns the seconds to wait when there is none"""
+        requests, seconds = self.limit
+        window = int(now // seconds)
+        count = cache.incr(self._key(window), 1, seconds * 2)
+        if count == 1:
+            # First call of a new window
+            self._recover()
+        if count <= self.budget():
+            return 0
+        # Spread the waiting workers over the start of the next window
+        return (window + 1) * seconds - now + random.uniform(0, 0.1)
+
+    def acquire(self):
+        """Wait until a request can be made
+
+        :raises: :py:class:`RateLimited` if that takes longer than
+                 :py:attr:`dtrove.config.DTROVE_RATE_LIMIT_MAX_WAIT`
+        """
+        deadline = time.time() + config.DTROVE_RATE_LIMIT_MAX_WAIT
+        while True:
+            now = time.time()
+            blocked = CACHE.get(self._key('blocked'))
+            if blocked is not None and blocked > now:
+                wait = blocked - now
+            elif self.limit is None:
+                return
+            else:
+                wait = self._take(now)
+                if not wait:
+                    return
+            if now + wait > deadline:
+                raise RateLimited('Rate limit of %s exceeded' % self.name)
+            time.sleep(wait)
+
+    def backoff(self, retry_after):
+        """The api refused a request, slow every worker down
+
+        :param int retry_after: Seconds the api asked to wait
+        """
+        retry_after = max(1, retry_after or 1)
+        CACHE.set(self._key('blocked'), time.time() + retry_after,
+                  retry_after)
+        CACHE.set(self._key('scale'), max(MIN_SCALE, self.scale / 2), None)
+
+
+def limiter(name):
+    """The :py:class:`Limiter` of an endpoint"""
+    found = _LIMITERS.get(name)
+    if found is None:
+        with _LOCK:
+            found = _LIMITERS.setdefault(name, Limiter(name))
+    return found
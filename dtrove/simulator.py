@@ -0,0 +1,338 @@
+"""
+Nova Simulator
+==============
+
+An in process stand in for the nova api that the fake endpoints in
+:py:mod:`dtrove.views` serve at `/osnova/`. It keeps servers, volumes and
+snapshots in memory so the provider can be load tested without a cloud::
+
+    from dtrove.simulator import SIMULATOR
+
+    SIMULATOR.configure(build_time=(5, 20), latency=0.05,
+                        latency_distribution='exponential',
+                        fail_rate=0.01, rate_limit=600)
+
+The options default to :py:attr:`dtrove.config.DTROVE_FAKE_NOVA`:
+
+* `build_time`: Range in seconds a server or volume takes to build, the
+  duration is picked at random for each one. When this is None the
+  progress goes up by `build_step` percent on every read instead.
+* `build_step`: Percent of progress per read (default 10)
+* `latency`: Mean seconds every request takes (default 0)
+* `latency_distribution`: 'fixed', 'uniform' (between 0 and twice the
+  mean) or 'exponential' (default 'fixed')
+* `fail_rate`: Chance that a new server ends up in the ERROR state
+* `error_rate`: Chance that any request fails with a 500
+* `rate_limit`: Max requests in `rate_limit_window` seconds before the
+  requests get a 413 with a Retry-After header, 0 turns it off
+* `max_limit`: Max items in a page of a list, like nova's
+  `osapi_max_limit` (default 1000)
+* `seed`: Seed of the random numbers so a run can be repeated
+
+Supported requests, relative to the nova endpoint:
+
+* `os-keypairs` (POST)
+* `flavors`, `flavors/detail`, `flavors/<id>` (GET)
+* `servers` (POST, GET), `servers/detail` (GET), `servers/<id>`
+  (GET, DELETE). The lists take the `name` (a regex), `marker` and
+  `limit` query parameters.
+* `os-volumes`, `os-snapshots` and their `detail` and `<id>` routes
+  (POST, GET, DELETE)
+"""
+
+import collections
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from dtrove import config
+
+DEFAULTS = {
+    'build_time': None,
+    'build_step': 10,
+    'latency': 0,
+    'latency_distribution': 'fixed',
+    'fail_rate': 0,
+    'error_rate': 0,
+    'rate_limit': 0,
+    'rate_limit_window': 60,
+    'max_limit': 1000,
+    'seed': None,
+}
+
+FLAVORS = [
+    {'id': '1', 'name': '512MB Standard Instance', 'ram': 512,
+     'vcpus': 1, 'disk': 20},
+    {'id': '2', 'name': '1GB Standard Instance', 'ram': 1024,
+     'vcpus': 1, 'disk': 40},
+    {'id': '3', 'name': '2GB Standard Instance', 'ram': 2048,
+     'vcpus': 2, 'disk': 80},
+    {'id': '4', 'name': '4GB Standard Instance', 'ram': 4096,
+     'vcpus': 2, 'disk': 160},
+]
+
+KEYPAIR = {
+    "keypair": {
+        "fingerprint": "1e:2c:9b:56:79:4b:45:77:f9:ca:7a:98:2c:b0:d5:3c",
+        "name": "keypair-dab428fe-6186-4a14-b3de-92131f76cd39",
+        "public_key": "ssh-rsa AAAAB3NzaC1yc2EAAAADAQsdHw== FAKE",
+        "user_id": "fake"
+    }
+}
+
+# Collection name -> (singular name, status while building, status when
+# built)
+RESOURCES = {
+    'servers': ('server', 'BUILD', 'ACTIVE'),
+    'os-volumes': ('volume', 'creating', 'available'),
+    'os-snapshots': ('snapshot', 'creating', 'available'),
+}
+
+
+def _now():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Response(object):
+
+    def __init__(self, status=200, body=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+def error(status, kind, message, **extra):
+    body = {kind: dict(code=status, message=message, **extra)}
+    return Response(status, body)
+
+
+class Simulator(object):
+    """In memory nova api, see the module docs for the options"""
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self.configure(**options)
+
+    def configure(self, **options):
+        """Set the options and drop every resource"""
+        unknown = set(options) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown options: %s' % ', '.join(unknown))
+        with self._lock:
+            self.options = dict(DEFAULTS)
+            self.options.update(config.DTROVE_FAKE_NOVA)
+            self.options.update(options)
+            self.random = random.Random(self.options['seed'])
+            self.resources = dict((name, collections.OrderedDict())
+                                  for name in RESOURCES)
+            self.requests = collections.deque()
+            self.addresses = 0
+            #: Count of the responses by status code
+            self.stats = collections.Counter()
+
+    def reset(self):
+        """Drop every resource and go back to the default options"""
+        self.configure()
+
+    def latency(self):
+        mean = self.options['latency']
+        kind = self.options['latency_distribution']
+        if not mean:
+            return 0
+        if kind == 'uniform':
+            return self.random.uniform(0, 2 * mean)
+        if kind == 'exponential':
+            return self.random.expovariate(1.0 / mean)
+        return mean
+
+    def _limited(self, now):
+        limit = self.options['rate_limit']
+        if not limit:
+            return None
+        window = self.options['rate_limit_window']
+        while self.requests and self.requests[0] <= now - window:
+            self.requests.popleft()
+        if len(self.requests) >= limit:
+            return max(1, int(math.ceil(self.requests[0] + window - now)))
+        self.requests.append(now)
+        return None
+
+    def handle(self, method, path, body=None, query=None):
+        """Answer one api request
+
+        :param str method: The HTTP method
+        :param str path: The path relative to the nova endpoint
+        :param dict body: The decoded JSON body
+        :param dict query: The query string parameters
+        :returns: :py:class:`Response`
+        """
+        delay = self.latency()
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            response = self._handle(method, path, body or {}, query or {})
+            self.stats[response.status] += 1
+        return response
+
+    def _handle(self, method, path, body, query):
+        now = time.time()
+        retry_after = self._limited(now)
+        if retry_after is not None:
+            response = error(413, 'overLimit', 'Rate limit exceeded',
+                             retryAfter=str(retry_after))
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        if self.random.random() < self.options['error_rate']:
+            return error(500, 'computeFault', 'Injected failure')
+
+        parts = [part for part in path.split('/') if part]
+        # Skip the tenant id if the client put one in the path
+        if parts and parts[0] not in RESOURCES and \
+                parts[0] not in ('flavors', 'os-keypairs'):
+            parts = parts[1:]
+        if not parts:
+            return error(404, 'itemNotFound', 'Not found')
+
+        name, rest = parts[0], parts[1:]
+        if name == 'os-keypairs':
+            return Response(200, KEYPAIR)
+        if name == 'flavors':
+            return self.flavors(rest)
+        if name not in RESOURCES:
+            return error(404, 'itemNotFound', 'Not found')
+
+        if method == 'POST' and not rest:
+            return self.create(name, body, now)
+        if method == 'GET' and rest in ([], ['detail']):
+            return self.list(name, now, query)
+        if len(rest) == 1 and method in ('GET', 'DELETE'):
+            record = self.resources[name].get(rest[0])
+            if record is None:
+                return error(404, 'itemNotFound',
+                             'Instance could not be found')
+            if method == 'DELETE':
+                del self.resources[name][rest[0]]
+                return Response(204)
+            singular = RESOURCES[name][0]
+            return Response(200, {singular: self.render(name, record, now)})
+        return error(405, 'badMethod', 'Method not allowed')
+
+    def flavors(self, rest):
+        if rest in ([], ['detail']):
+            return Response(200, {'flavors': FLAVORS})
+        for flavor in FLAVORS:
+            if [flavor['id']] == rest:
+                return Response(200, {'flavor': flavor})
+        return error(404, 'itemNotFound', 'Flavor could not be found')
+
+    def create(self, name, body, now):
+        singular = RESOURCES[name][0]
+        data = body.get(singular, {})
+        build_time = self.options['build_time']
+        record = {
+            'id': str(uuid.uuid4()),
+            'data': data,
+            'created': now,
+            'created_at': _now(),
+            'build_time': build_time and self.random.uniform(*build_time),
+            'progress': 0,
+            'failed': False,
+        }
+        if name == 'servers':
+            self.addresses += 1
+            record['addr'] = '10.%d.%d.%d' % (
+                self.addresses >> 16 & 255, self.addresses >> 8 & 255,
+                self.addresses & 255)
+            record['failed'] = self.random.random() < self.options['fail_rate']
+        self.resources[name][record['id']] = record
+        return Response(202, {singular: self.render(name, record, now,
+                                                    created=True)})
+
+    def list(self, name, now, query):
+        records = self.resources[name].values()
+        if query.get('name'):
+            pattern = re.compile(query['name'])
+            records = [record for record in records
+                       if pattern.search(record['data'].get('name', ''))]
+        if query.get('marker'):
+            ids = [record['id'] for record in records]
+            if query['marker'] not in ids:
+                return error(400, 'badRequest',
+                             'marker [%s] not found' % query['marker'])
+            records = records[ids.index(query['marker']) + 1:]
+        limit = self.options['max_limit']
+        if query.get('limit'):
+            limit = min(limit, int(query['limit']))
+        records = [self.render(name, record, now)
+                   for record in records[:limit]]
+        return Response(200, {name.replace('os-', ''): records})
+
+    def progress(self, record, now):
+        """Move the build of a resource along and return the progress"""
+        if record['build_time'] is None:
+            record['progress'] = min(100, record['progress'] +
+                                     self.options['build_step'])
+        elif record['build_time'] <= 0:
+            record['progress'] = 100
+        else:
+            elapsed = now - record['created']
+            record['progress'] = min(
+                100, int(100 * elapsed / record['build_time']))
+        return record['progress']
+
+    def render(self, name, record, now, created=False):
+        singular, building, built = RESOURCES[name]
+        data = record['data']
+        progress = 0 if created else self.progress(record, now)
+        status = building if progress < 100 else built
+        if status == 'ACTIVE' and record['failed']:
+            status = 'ERROR'
+
+        if name == 'servers':
+            server = {
+                'id': record['id'],
+                'name': data.get('name', 'server'),
+                'status': status,
+                'progress': progress,
+                'accessIPv4': '' if created else record['addr'],
+                'addresses': {},
+                'created': record['created_at'],
+                'updated': _now(),
+                'flavor': {'id': data.get('flavorRef', '1'), 'links': []},
+                'image': {'id': data.get('imageRef', ''), 'links': []},
+                'key_name': data.get('key_name'),
+                'hostId': '36',
+                'links': [],
+                'metadata': data.get('metadata', {}),
+                'tenant_id': 'openstack',
+                'user_id': 'fake',
+            }
+            if created:
+                server['adminPass'] = 'aabbccddeeff'
+            if status == 'ERROR':
+                server['fault'] = {'code': 500, 'created': _now(),
+                                   'message': 'Injected build failure'}
+            return server
+
+        resource = {
+            'id': record['id'],
+            'status': status,
+            'displayName': data.get('display_name'),
+            'displayDescription': data.get('display_description'),
+            'size': data.get('size', 1),
+            'createdAt': record['created_at'],
+        }
+        if name == 'os-volumes':
+            resource['attachments'] = []
+            resource['availabilityZone'] = 'nova'
+        else:
+            resource['volumeId'] = data.get('volume_id')
+        return resource
+
+
+#: The simulator behind the fake nova endpoint
+SIMULATOR = Simulator()
@@ -0,0 +1,219 @@
+"""
+SSH Connections
+===============
+
+Opening an ssh connection costs a TCP handshake plus a key exchange, which
+is often slower than the command we want to run. Instead of disconnecting
+at the end of every task the workers keep their connections open in a
+:py:class:`ConnectionPool` and hand them to fabric when they are needed::
+
+    from fabric.api import sudo
+    from dtrove.ssh import POOL
+
+    with POOL.connection(instance):
+        sudo('service mysql restart')
+
+Connections are keyed by the host, user and the fingerprint of the key so
+a rebuilt server or a new key never reuses a stale session. Code that
+doesn't go through fabric, for example to talk to many hosts from threads,
+can borrow the raw paramiko client with :py:meth:`ConnectionPool.client`
+and run commands with :py:func:`execute`. Idle
+connections are closed after :py:attr:`dtrove.config.DTROVE_SSH_IDLE_TIMEOUT`
+seconds and at most :py:attr:`dtrove.config.DTROVE_SSH_POOL_SIZE` are kept
+open per worker process.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from StringIO import StringIO
+
+import paramiko
+from celery.signals import worker_process_shutdown
+from fabric.api import env, settings
+from fabric.state import connections
+
+from dtrove import config
+
+LOG = logging.getLogger(__name__)
+
+
+def private_key(key):
+    """Load the private key of a :py:class:`dtrove.models.Key`"""
+    key_class = paramiko.RSAKey
+    if 'OPENSSH PRIVATE KEY' in key.private:
+        key_class = paramiko.Ed25519Key
+    return key_class.from_private_key(StringIO(key.private),
+                                      password=key.passphrase or None)
+
+
+def connect(instance):
+    """Open a new ssh connection to the instance"""
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(instance.addr,
+                   username=instance.user,
+                   pkey=private_key(instance.key),
+                   timeout=config.DTROVE_SSH_TIMEOUT,
+                   allow_agent=False,
+                   look_for_keys=False)
+    return client
+
+
+def execute(client, cmd, timeout=None):
+    """Run a command on a paramiko client
+
+    :returns: tuple of (stdout, stderr, exit code)
+    """
+    stdin, stdout, stderr = client.exec_command(cmd, timeout=timeout)
+    stdin.close()
+    out = stdout.read()
+    err = stderr.read()
+    return out, err, stdout.channel.recv_exit_status()
+
+
+def healthy(client):
+    """Check that the transport of a paramiko client is still usable"""
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+class ConnectionPool(object):
+    """Pool of open ssh connections for this process
+
+    :param int max_connections: Max number of connections to keep open
+    :param int idle_timeout: Seconds before an unused connection is closed
+    """
+
+    def __init__(self, max_connections=None, idle_timeout=None):
+        if max_connections is None:
+            max_connections = config.DTROVE_SSH_POOL_SIZE
+        if idle_timeout is None:
+            idle_timeout = config.DTROVE_SSH_IDLE_TIMEOUT
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        # pool key -> (client, last used), least recently used first
+        self._idle = OrderedDict()
+        # id(client) -> client of the connections that are borrowed
+        self._busy = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle) + len(self._busy)
+
+    @staticmethod
+    def key(instance):
+        """The pool key of an instance (host, user, key fingerprint)"""
+        fingerprint = hashlib.md5(instance.key.public).hexdigest()
+        return instance.addr, instance.user, fingerprint
+
+    def _close(self, client):
+        # Fabric must not hand out a closed client either
+        for host_string, cached in connections.items():
+            if cached is client:
+                del connections[host_string]
+        try:
+            client.close()
+        except Exception:
+            LOG.exception('Unable to close ssh connection')
+
+    def _evict(self):
+        """Close idle connections that timed out or don't fit in the pool"""
+        now = time.time()
+        for key, (client, used) in self._idle.items():
+            if (now - used > self.idle_timeout or
+                    len(self) > self.max_connections):
+                del self._idle[key]
+                self._close(client)
+
+    def _checkout(self, instance):
+        key = self.key(instance)
+        with self._lock:
+            self._evict()
+            client, used = self._idle.pop(key, (None, None))
+        if client is not None and not healthy(client):
+            LOG.info('Dropping broken ssh connection to %s', key[0])
+            self._close(client)
+            client = None
+        if client is None:
+            client = connect(instance)
+        with self._lock:
+            self._busy[id(client)] = client
+        return key, client
+
+    def _checkin(self, key, client):
+        with self._lock:
+            self._busy.pop(id(client), None)
+            # Only one idle connection is kept per key
+            previous, used = self._idle.pop(key, (None, None))
+            if previous is not None:
+                self._close(previous)
+            self._idle[key] = (client, time.time())
+            self._evict()
+
+    @contextmanager
+    def connection(self, instance):
+        """Borrow a connection to the instance for fabric commands
+
+        The fabric env is set up with the instance `connection_info` for
+        the length of the block.
+        """
+        with settings(**instance.connection_info):
+            key, client = self._checkout(instance)
+            # Fabric looks up the connection for the host in its own cache
+            connections[env.host_string] = client
+            try:
+                yield client
+            finally:
+                self._checkin(key, client)
+
+    @contextmanager
+    def client(self, instance):
+        """Borrow the paramiko client of an instance without using fabric
+
+        Unlike :py:meth:`connection` this doesn't touch the global fabric
+        env so it is safe to use from many threads at once.
+        """
+        key, client = self._checkout(instance)
+        try:
+            yield client
+        finally:
+            self._checkin(key, client)
+
+    def discard(self, instance):
+        """Close the idle connection to an instance, ie when it is removed"""
+        with self._lock:
+            client, used = self._idle.pop(self.key(instance), (None, None))
+        if client is not None:
+            self._close(client)
+
+    def close_all(self):
+        """Close every connection in the pool"""
+        with self._lock:
+            clients = [client for client, used in self._idle.values()]
+            clients.extend(self._busy.values())
+            self._idle.clear()
+            self._busy.clear()
+        for client in clients:
+            self._close(client)
+        connections.clear()
+
+
+#: The connection pool of this worker process
+POOL = ConnectionPool()
+
+
+@worker_process_shutdown.connect
+def close_connections(**kwargs):
+    POOL.close_all()
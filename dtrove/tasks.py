@@ -28,8 +28,44 @@ We can use the `perform` task to run any command on the remote systems.
          out:
          [root@10.0.0.1] run: echo everything gone
          out: everything gone
-         Disconnecting from 127.0.0.1...
-         done.
+
+    The ssh connection is borrowed from :py:data:`dtrove.ssh.POOL` and
+    left open for the next task that talks to the same instance.
+
+.. py:function:: dtrove.tasks.preform_cluster(cluster_id, name, *cmds, \
+                                              fail_fast=False, parallel=None)
+
+    Execute remote commands on every instance of a cluster at once
+
+    :param int cluster_id: ID of the cluster to run the commands on
+    :param str name: Identifier of this task
+    :param str cmds: The actual commands to run
+    :param bool fail_fast: Skip the hosts that haven't started yet once a
+                           command fails on any host
+    :param int parallel: Max number of hosts to run on at the same time,
+                         defaults to
+                         :py:attr:`dtrove.config.DTROVE_PREFORM_PARALLEL`
+
+    The commands run in order on each host and stop at the first one that
+    exits non zero. The result has the output of every instance by name::
+
+        {
+            'name': 'uptime',
+            'ok': True,
+            'hosts': {
+                'node-1': {
+                    'host': 'root@10.0.0.1',
+                    'status': 'ok',
+                    'results': [
+                        {'cmd': 'uptime', 'stdout': '...', 'stderr': '',
+                         'exit_code': 0},
+                    ],
+                },
+            },
+        }
+
+    The status of a host is 'ok', 'failed' (a command exited non zero or
+    the connection failed) or 'skipped'.
 
 Build Tasks
 -----------
@@ -44,6 +80,20 @@ These tasks handle creating and managing the servers themselves.
     :param str volume_id: Optional volume id to attach
 
 
+.. py:function:: dtrove.tasks.wait_for_server(instance_id, started=None)
+
+    Wait for a nova server to become active
+
+    :param int instance_id: ID of the instance being built
+    :param float started: Time the wait started, set on the first run
+
+    Rather than sleeping in the worker this checks the status once and
+    reschedules itself with exponential backoff and jitter, so a single
+    worker can watch many builds. After
+    :py:attr:`dtrove.config.DTROVE_BUILD_TIMEOUT` seconds the instance is
+    put into the 'error' state.
+
+
 .. py:function:: dtrove.tasks.create_volume(instance_id)
 
     Create a volume for the instance
@@ -58,26 +108,112 @@ These tasks handle creating and managing the servers themselves.
     :param int instance_id: ID of the instance to build
     :param str volume_id: Optional volume id to attach
 
+.. py:function:: dtrove.tasks.scale_down(cluster_id, instance_ids, \
+                                         parallel=None)
+
+    Remove nodes from a cluster, see :py:meth:`dtrove.models.Cluster.resize`
+
+    :param int cluster_id: ID of the cluster
+    :param list instance_ids: IDs of the nodes to remove
+    :param int parallel: Max number of nodes to remove at the same time,
+                         defaults to
+                         :py:attr:`dtrove.config.DTROVE_DESTROY_PARALLEL`
+
+    Each node is drained (the datastore is stopped) and destroyed with the
+    provider, the status goes from 'draining' to 'deleting' and 'deleted'.
+    Nodes that could not be destroyed are left in the 'error' state. The
+    ssh keys that no node uses anymore are removed from the provider and
+    the database. A node that is still booting destroys its own server as
+    soon as the boot returns and the build tasks skip it. Returns the ids
+    that were removed and the ones that failed::
+
+        {'removed': [4, 5], 'failed': []}
+
+Periodic Tasks
+--------------
+
+.. py:function:: dtrove.tasks.poll_status()
+
+    Refresh the status of every server that is not active yet with a single
+    call to the provider. This runs every
+    :py:attr:`dtrove.config.DTROVE_POLL_INTERVAL` seconds when celery beat
+    is running.
+
+.. py:function:: dtrove.tasks.refresh_status(instance_ids)
+
+    Refresh the cached status of the given instances with a single call to
+    the provider. The api queues this for nodes that have no cached state
+    rather than calling the provider during the request.
+
+.. py:function:: dtrove.tasks.fill_key_pool()
+
+    Top up the pool of unassigned ssh keys to
+    :py:attr:`dtrove.config.DTROVE_KEY_POOL_SIZE`. The keys are generated
+    in parallel by `generate_key` tasks on the workers, the keys that are
+    still queued count as in the pool. This runs every
+    :py:attr:`dtrove.config.DTROVE_KEY_POOL_INTERVAL` seconds.
+
+Queues
+------
+
+The tasks are split over three queues so a burst of long installs can't
+hold up the rest, see :py:attr:`dtrove.config.DTROVE_TASK_ROUTES`:
+
+* `dtrove.control`: Short tasks that start builds or run commands, its
+  workers also take the unrouted tasks from the default `celery` queue
+* `dtrove.poll`: `wait_for_server`, `poll_status` and `refresh_status`
+* `dtrove.prepare`: The ssh work of `prepare` and `scale_down` and
+  generating keys
+
+Start a worker for each with its profile from
+:py:attr:`dtrove.config.DTROVE_WORKER_PROFILES`, which sets the queues,
+pool size and prefetch multiplier::
+
+    $ DTROVE_WORKER_PROFILE=control celery -A dtrove worker
+    $ DTROVE_WORKER_PROFILE=poll celery -A dtrove worker
+    $ DTROVE_WORKER_PROFILE=prepare celery -A dtrove worker
+
+A worker without a profile consumes every queue.
+
 """
 
 from __future__ import absolute_import
 
-from time import sleep
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from celery import shared_task
-from celery import chain
-from fabric.api import run, env, settings, prefix
-from fabric.network import disconnect_all
+from celery import chain, chord, group
+from celery.utils.log import get_task_logger
+from django.db.models import ProtectedError
+from fabric.api import run, env, prefix
 
-from dtrove import config
-from dtrove.models import Instance
-from dtrove.providers import get_provider
+from dtrove import config, metrics, tracing
+from dtrove.models import REMOVING, Cluster, Instance, Key
+from dtrove.providers import LazyProvider
+from dtrove.providers.base import ProviderError
+from dtrove.ssh import POOL, execute
 
-PROVIDER = get_provider()
+PROVIDER = LazyProvider()
+LOG = get_task_logger(__name__)
 
 
 def runner(cmd):
-    return run(cmd % env)
+    with metrics.SSH_COMMAND_SECONDS.time():
+        return run(cmd % env)
+
+
+def backoff(retries):
+    """Seconds to wait before the next status check
+
+    The delay doubles with every retry up to a max, half of it is random so
+    builds that started together don't all poll at the same time.
+    """
+    delay = min(config.DTROVE_BUILD_POLL_MAX_DELAY,
+                config.DTROVE_BUILD_POLL_DELAY * 2 ** retries)
+    return random.uniform(delay / 2.0, delay)
 
 
 @shared_task
@@ -85,30 +221,282 @@ def preform(instance_id, name, *cmds):
     """Connects to the instance and preforms the commands"""
     instance = Instance.objects.get(pk=instance_id)
 
-    with settings(**instance.connection_info):
+    with POOL.connection(instance):
         map(runner, cmds)
 
-    # Always remember to disconnect ssh sessions
-    disconnect_all()
+
+def _command_vars(instance):
+    """Values the commands can use like `%(host)s`, never the key"""
+    return {
+        'host_string': '%s@%s' % (instance.user, instance.addr),
+        'user': instance.user,
+        'host': instance.addr,
+    }
+
+
+def _preform_host(instance, cmds, stop, fail_fast):
+    """Run the commands on one instance, for `preform_cluster`"""
+    info = _command_vars(instance)
+    if stop.is_set():
+        return {'host': info['host_string'], 'status': 'skipped',
+                'results': []}
+    results = []
+    status = 'ok'
+    try:
+        with POOL.client(instance) as client:
+            for cmd in cmds:
+                cmd = cmd % info
+                with metrics.SSH_COMMAND_SECONDS.time():
+                    out, err, code = execute(client, cmd)
+                results.append({'cmd': cmd, 'stdout': out, 'stderr': err,
+                                'exit_code': code})
+                if code != 0:
+                    status = 'failed'
+                    break
+    except Exception as exc:
+        LOG.exception('Unable to run %s on %s', cmds, instance)
+        results.append({'cmd': None, 'stdout': '', 'stderr': str(exc),
+                        'exit_code': None})
+        status = 'failed'
+    if status == 'failed' and fail_fast:
+        stop.set()
+    return {'host': info['host_string'], 'status': status,
+            'results': results}
+
+
+@shared_task
+def preform_cluster(cluster_id, name, *cmds, **kwargs):
+    """Connects to every instance in the cluster and preforms the commands"""
+    fail_fast = kwargs.get('fail_fast', False)
+    parallel = kwargs.get('parallel') or config.DTROVE_PREFORM_PARALLEL
+    # Nodes on their way out or without an address yet can't take commands
+    instances = list(Instance.objects.filter(cluster_id=cluster_id,
+                                             removing=False)
+                     .exclude(addr=None)
+                     .select_related('key'))
+    stop = threading.Event()
+
+    def run_host(instance):
+        return _preform_host(instance, cmds, stop, fail_fast)
+
+    pool = ThreadPool(min(parallel, len(instances)) or 1)
+    try:
+        outputs = pool.map(run_host, instances, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    hosts = dict((instance.name, output)
+                 for instance, output in zip(instances, outputs))
+    ok = all(output['status'] == 'ok' for output in outputs)
+    return {'name': name, 'ok': ok, 'hosts': hosts}
 
 
 @shared_task
 def create(instance_id):
-    chain(create_server(instance_id), prepare(instance_id))
+    chain(create_server.si(instance_id),
+          wait_for_server.si(instance_id),
+          prepare.si(instance_id))()
+
+
+@shared_task
+def create_cluster(cluster_id, instance_ids):
+    builds = group(chain(create_server.si(pk), wait_for_server.si(pk))
+                   for pk in instance_ids)
+    chord(builds)(prepare_cluster.si(cluster_id, instance_ids))
+
+
+@shared_task
+def prepare_cluster(cluster_id, instance_ids):
+    chord(prepare.si(pk) for pk in instance_ids)(cluster_ready.si(cluster_id))
+
+
+@shared_task
+def cluster_ready(cluster_id):
+    cluster = Cluster.objects.get(pk=cluster_id)
+    LOG.info('Cluster %s is ready', cluster)
+    return cluster_id
+
+
+def _building(instance_id):
+    """The instance to build, None when it was removed from its cluster"""
+    instance = Instance.objects.filter(pk=instance_id,
+                                       removing=False).first()
+    if instance is None:
+        LOG.info('Instance %s was removed, skipping the build', instance_id)
+    return instance
 
 
 @shared_task
 def create_server(instance_id):
-    instance = Instance.objects.get(pk=instance_id)
-    PROVIDER.create(instance)
+    instance = _building(instance_id)
+    if instance is None:
+        return
+    with tracing.span('create_server', instance):
+        PROVIDER.create(instance)
+
+
+def _build_status(instance):
+    """Status and progress of a building server
+
+    The state record that `poll_status` keeps fresh is used when it can
+    be, nova is only asked for this one server when the record is stale.
+    """
+    state = instance.state
+    updated = state['updated_at']
+    if state['status'] is None or updated is None or \
+            time.time() - updated > config.DTROVE_STATE_MAX_AGE:
+        return PROVIDER.update_status(instance)
+    return state['status'], state['progress']
+
+
+@shared_task(bind=True, max_retries=None)
+def wait_for_server(self, instance_id, started=None):
+    if started is None:
+        started = time.time()
+    instance = _building(instance_id)
+    if instance is None:
+        return
+    status, progress = _build_status(instance)
+
+    if status == 'active':
+        instance.set_state(progress=100)
+        tracing.record('build', started, time.time(), instance=instance)
+        return instance_id
+    elif status == 'error':
+        tracing.record('build', started, time.time(), tracing.ERROR,
+                       instance, instance.message)
+        raise ProviderError(instance.message)
+
+    if time.time() - started > config.DTROVE_BUILD_TIMEOUT:
+        message = 'Timed out waiting for the server to build'
+        instance.set_state(status='error', message=message)
+        tracing.record('build', started, time.time(), tracing.ERROR,
+                       instance, message)
+        raise ProviderError(message)
+
+    raise self.retry(args=[instance_id, started],
+                     countdown=backoff(self.request.retries))
 
 
 @shared_task
 def prepare(instance_id):
-    instance = Instance.objects.get(pk=instance_id)
+    instance = _building(instance_id)
+    if instance is None:
+        return {}
     manager = instance.cluster.datastore.manager
-    with settings(**instance.connection_info):
-        manager.prepare(instance)
+    with tracing.span('prepare', instance):
+        with manager.connection(instance):
+            with manager.record_timings() as timings:
+                manager.prepare(instance)
+    timings = dict(timings)
+    LOG.info('Prepared %s in %s', instance, timings)
+    return timings
+
+
+@shared_task
+def poll_status():
+    servers = dict(Instance.objects.exclude(server='')
+                   .values_list('server', 'pk'))
+    states = Instance.get_state_many(servers.keys())
+    # Only ask about the servers that are still changing
+    pending = [servers[server] for server, state in states.items()
+               if state['status'] not in config.DTROVE_POLL_DONE and
+               state['status'] not in REMOVING]
+    if not pending:
+        return {}
+    instances = Instance.objects.filter(pk__in=pending)
+    return PROVIDER.update_status_bulk(list(instances))
+
+
+@shared_task
+def refresh_status(instance_ids):
+    instances = Instance.objects.filter(pk__in=instance_ids).exclude(server='')
+    if not instances:
+        return {}
+    return PROVIDER.update_status_bulk(list(instances))
+
+
+def _remove_node(instance):
+    """Drain and destroy one node, for `scale_down`
+
+    Only the cache and the provider are used so this is safe to run from
+    many threads.
+    """
+    if not instance.server:
+        return True
+    with tracing.span('drain', instance):
+        try:
+            instance.cluster.datastore.manager.drain(instance)
+        except Exception:
+            # A broken node is removed all the same
+            LOG.warning('Unable to drain %s', instance, exc_info=True)
+    instance.set_state(status='deleting', progress=50)
+    try:
+        with tracing.span('destroy', instance):
+            PROVIDER.destroy(instance)
+    except Exception as exc:
+        LOG.exception('Unable to destroy %s', instance)
+        instance.set_state(status='error', message=str(exc))
+        return False
+    POOL.discard(instance)
+    instance.set_state(status='deleted', progress=100)
+    return True
+
 
-    # Always remember to disconnect ssh sessions
-    disconnect_all()
+@shared_task
+def scale_down(cluster_id, instance_ids, parallel=None):
+    """Drain and destroy nodes of a cluster at once
+
+    The nodes that are gone are deleted along with the ssh keys that no
+    node uses anymore.
+    """
+    parallel = parallel or config.DTROVE_DESTROY_PARALLEL
+    instances = list(Instance.objects.filter(pk__in=instance_ids)
+                     .select_related('key', 'cluster__datastore'))
+
+    pool = ThreadPool(min(parallel, len(instances)) or 1)
+    try:
+        results = pool.map(_remove_node, instances, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    removed = [instance for instance, ok in zip(instances, results) if ok]
+    failed = [instance.pk for instance, ok in zip(instances, results)
+              if not ok]
+    Instance.objects.filter(pk__in=[i.pk for i in removed]).delete()
+
+    key_ids = set(instance.key_id for instance in removed if instance.key_id)
+    for key in Key.objects.filter(pk__in=key_ids, instance=None):
+        try:
+            Key.objects.filter(pk=key.pk).delete()
+        except ProtectedError:
+            # A node added since the query above uses the key again
+            continue
+        try:
+            PROVIDER.delete_key(key)
+        except Exception:
+            LOG.exception('Unable to delete the keypair %s', key.name)
+    return {'removed': [instance.pk for instance in removed],
+            'failed': failed}
+
+
+@shared_task
+def fill_key_pool():
+    available = Key.objects.filter(pooled=True).count()
+    Key.record_pool_level(available)
+    # Keys queued by an earlier run that the workers haven't got to yet
+    missing = config.DTROVE_KEY_POOL_SIZE - available - Key.pending()
+    if missing > 0:
+        Key.add_pending(missing)
+        group(generate_key.si() for x in xrange(missing))()
+    return max(missing, 0)
+
+
+@shared_task
+def generate_key():
+    try:
+        return Key.create(pooled=True).pk
+    finally:
+        Key.done_pending()
@@ -0,0 +1,277 @@
+
+from rest_framework.test import APIClient
+
+from dtrove import tracing
+from dtrove.api.pagination import encode_cursor
+from .base import *
+
+
+class ClusterListTests(DtroveTest):
+
+    def setUp(self):
+        patcher = patch('dtrove.models.Cluster.provision')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.datastore = create_datastore(save=True)
+
+    def create_clusters(self, count):
+        return [create_cluster(name='cluster-%d' % i,
+                               datastore=self.datastore, save=True)
+                for i in range(count)]
+
+    def test_list(self):
+        clusters = self.create_clusters(3)
+        response = self.client.get('/api/clusters')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(None, response.data['next'])
+        self.assertEqual([c.pk for c in clusters],
+                         [c['id'] for c in response.data['results']])
+
+    def test_matches_serializer(self):
+        cluster = self.create_clusters(1)[0]
+        response = self.client.get('/api/clusters')
+        detail = self.client.get('/api/clusters/%d' % cluster.pk)
+        self.assertEqual(detail.data, response.data['results'][0])
+        self.assertEqual('mysql-1.0', detail.data['datastore']['name'])
+
+    def test_pages(self):
+        clusters = self.create_clusters(5)
+        response = self.client.get('/api/clusters', {'page_size': 2})
+        self.assertEqual([c.pk for c in clusters[:2]],
+                         [c['id'] for c in response.data['results']])
+        self.assertTrue(
+            'cursor=%s' % encode_cursor(clusters[1].pk)
+            in response.data['next'])
+        found = []
+        next_url = response.data['next']
+        while next_url:
+            response = self.client.get(next_url)
+            found.extend(c['id'] for c in response.data['results'])
+            next_url = response.data['next']
+        self.assertEqual([c.pk for c in clusters[2:]], found)
+
+    def test_constant_queries(self):
+        self.create_clusters(20)
+        for page_size in (1, 5, 20):
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/clusters',
+                                           {'page_size': page_size})
+            self.assertEqual(page_size, len(response.data['results']))
+
+    def test_max_page_size(self):
+        self.create_clusters(3)
+        with patch('dtrove.config.DTROVE_API_MAX_PAGE_SIZE', 2):
+            response = self.client.get('/api/clusters', {'page_size': 10})
+        self.assertEqual(2, len(response.data['results']))
+
+    def test_bad_cursor(self):
+        response = self.client.get('/api/clusters', {'cursor': 'nope'})
+        self.assertEqual(400, response.status_code)
+
+    def test_bad_page_size(self):
+        response = self.client.get('/api/clusters', {'page_size': 0})
+        self.assertEqual(400, response.status_code)
+
+    def test_datastore_list(self):
+        response = self.client.get('/api/datastores')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['mysql-1.0'],
+                         [d['name'] for d in response.data['results']])
+
+
+class ClusterInstancesTests(DtroveTest):
+
+    def setUp(self):
+        for name in ('Instance', 'Cluster'):
+            patcher = patch('dtrove.models.%s.provision' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        refresh = patch('dtrove.models.Cluster.refresh_status')
+        self.refresh = refresh.start()
+        self.addCleanup(refresh.stop)
+        models.CACHE.clear()
+        self.addCleanup(models.CACHE.clear)
+        self.client = APIClient()
+        self.cluster = create_cluster(save=True)
+        self.nodes = [
+            create_instance(name='node-%d' % i, cluster=self.cluster,
+                            server='server-%d' % i, save=True)
+            for i in range(3)
+        ]
+
+    def test_instances(self):
+        models.Instance.set_state_many({
+            'server-0': {'status': 'active', 'progress': 100},
+            'server-1': {'status': 'build', 'progress': 40},
+            'server-2': {'status': 'build', 'progress': 20},
+        })
+        with patch('dtrove.models.PROVIDER') as prov:
+            response = self.client.get(
+                '/api/clusters/%d/instances' % self.cluster.pk)
+            self.assertFalse(prov.method_calls)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('build', response.data['status'])
+        self.assertEqual(53, response.data['progress'])
+        self.assertEqual(['active', 'build', 'build'],
+                         [n['status'] for n in response.data['instances']])
+        self.assertFalse(self.refresh.called)
+
+    def test_unknown_refreshed(self):
+        models.Instance.set_state_many({
+            'server-0': {'status': 'active', 'progress': 100},
+        })
+        url = '/api/clusters/%d/instances' % self.cluster.pk
+        response = self.client.get(url)
+        self.assertEqual(['active', 'unknown', 'unknown'],
+                         [n['status'] for n in response.data['instances']])
+        self.refresh.assert_called_once_with(
+            [self.nodes[1].pk, self.nodes[2].pk])
+        # The refresh is only queued once per poll interval
+        self.client.get(url)
+        self.assertEqual(1, self.refresh.call_count)
+
+    def test_single_cache_read(self):
+        with patch('dtrove.models.CACHE.get_many',
+                   return_value={}) as get_many:
+            self.client.get('/api/clusters/%d/instances' % self.cluster.pk)
+        self.assertEqual(1, get_many.call_count)
+
+    def test_not_found(self):
+        response = self.client.get('/api/clusters/0/instances')
+        self.assertEqual(404, response.status_code)
+
+
+class ClusterEventsTests(DtroveTest):
+
+    def setUp(self):
+        for name in ('Instance', 'Cluster'):
+            patcher = patch('dtrove.models.%s.provision' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        models.CACHE.clear()
+        self.addCleanup(models.CACHE.clear)
+        self.client = APIClient()
+        self.cluster = create_cluster(save=True)
+        self.instance = create_instance(cluster=self.cluster, save=True)
+        self.url = '/api/clusters/%d/events' % self.cluster.pk
+
+    def test_long_poll(self):
+        self.instance.set_state(status='build', progress=10)
+        response = self.client.get(self.url, {'after': 0})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.data['last'])
+        event = response.data['events'][0]
+        self.assertEqual(self.instance.pk, event['instance'])
+        self.assertEqual('build', event['status'])
+
+    def test_long_poll_timeout(self):
+        self.instance.set_state(status='build', progress=10)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'timeout': 0})
+        self.assertEqual({'last': 1, 'events': []}, response.data)
+
+    def test_bad_after(self):
+        response = self.client.get(self.url, {'after': 'x'})
+        self.assertEqual(400, response.status_code)
+
+    def test_stream(self):
+        self.instance.set_state(status='build', progress=10)
+        self.instance.set_state(status='active', progress=100)
+        with patch('dtrove.config.DTROVE_FEED_STREAM_TIMEOUT', 0.1), \
+                patch('dtrove.config.DTROVE_FEED_WAIT', 0.05), \
+                patch('dtrove.config.DTROVE_FEED_INTERVAL', 0.01):
+            response = self.client.get(self.url,
+                                       HTTP_ACCEPT='text/event-stream',
+                                       HTTP_LAST_EVENT_ID='1')
+            self.assertEqual('text/event-stream', response['Content-Type'])
+            body = ''.join(response.streaming_content)
+        self.assertTrue(body.startswith('retry: 1000\n\n'))
+        self.assertTrue('id: 2\nevent: state\ndata: ' in body)
+        self.assertFalse('id: 1\n' in body)
+        self.assertTrue(': keepalive' in body)
+
+    def test_stream_not_found(self):
+        response = self.client.get('/api/clusters/0/events',
+                                   HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(404, response.status_code)
+        self.assertTrue(response.content.startswith('event: error\n'))
+
+
+class ClusterTimelineTests(DtroveTest):
+
+    def setUp(self):
+        for name in ('Instance', 'Cluster'):
+            patcher = patch('dtrove.models.%s.provision' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        tracing.clear()
+        self.addCleanup(tracing.clear)
+        self.client = APIClient()
+        self.cluster = create_cluster(save=True)
+        self.instance = create_instance(cluster=self.cluster, save=True)
+
+    def test_timeline(self):
+        tracing.record('boot', 100.0, 104.0, instance=self.instance)
+        tracing.record('build', 104.0, 150.0, instance=self.instance)
+        tracing.flush()
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                '/api/clusters/%d/timeline' % self.cluster.pk)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.cluster.pk, response.data['id'])
+        self.assertEqual(50, response.data['duration'])
+        self.assertEqual(['boot', 'build'],
+                         [span['stage'] for span
+                          in response.data['hosts'][0]['spans']])
+
+    def test_not_found(self):
+        response = self.client.get('/api/clusters/0/timeline')
+        self.assertEqual(404, response.status_code)
+
+
+class ClusterResizeTests(DtroveTest):
+
+    def setUp(self):
+        for name in ('Instance', 'Cluster'):
+            patcher = patch('dtrove.models.%s.provision' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        scale_down = patch('dtrove.models.Cluster.scale_down')
+        self.scale_down = scale_down.start()
+        self.addCleanup(scale_down.stop)
+        models.CACHE.clear()
+        self.addCleanup(models.CACHE.clear)
+        self.client = APIClient()
+        self.cluster = create_cluster(size=2, save=True)
+        self.url = '/api/clusters/%d/resize' % self.cluster.pk
+
+    def test_grow(self):
+        response = self.client.post(self.url, {'size': 3}, format='json')
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(3, response.data['size'])
+        self.assertEqual(1, len(response.data['added']))
+        self.assertEqual([], response.data['removed'])
+        self.assertEqual(3, self.cluster.instance_set.count())
+
+    def test_shrink(self):
+        newest = self.cluster.instance_set.latest('pk')
+        response = self.client.post(self.url, {'size': 1}, format='json')
+        self.assertEqual(202, response.status_code)
+        self.assertEqual([newest.pk], response.data['removed'])
+        self.scale_down.assert_called_once_with([newest.pk])
+
+    def test_too_large(self):
+        response = self.client.post(self.url, {'size': 50}, format='json')
+        self.assertEqual(400, response.status_code)
+        self.assertTrue(response.data['size'])
+
+    def test_invalid(self):
+        for data in ({}, {'size': 'big'}):
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(400, response.status_code)
+
+    def test_not_found(self):
+        response = self.client.post('/api/clusters/0/resize', {'size': 1},
+                                    format='json')
+        self.assertEqual(404, response.status_code)
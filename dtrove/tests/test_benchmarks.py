@@ -0,0 +1,70 @@
+from .base import *
+
+
+class NovaClientsTests(DtroveTest):
+
+    def test_connections_reused(self):
+        from dtrove.benchmarks import nova_clients
+        # The test database is already set up
+        with patch('dtrove.benchmarks.nova_clients.test_database'):
+            found = nova_clients.run(nodes=3)
+        self.assertEqual(1, found['nova_clients'])
+        self.assertEqual(1, found['keystone_auths'])
+        # One for keystone and one for nova, not one per request
+        self.assertTrue(found['tcp_connections'] <= 2, found)
+
+
+class PercentilesTests(DtroveTest):
+
+    def test_empty(self):
+        from dtrove.benchmarks.base import percentiles
+        self.assertEqual({'count': 0}, percentiles([]))
+
+    def test_one_sample(self):
+        from dtrove.benchmarks.base import percentiles
+        self.assertEqual({'count': 1, 'min': 2.0, 'max': 2.0, 'mean': 2.0,
+                          'p50': 2.0, 'p95': 2.0, 'p99': 2.0},
+                         percentiles([2.0]))
+
+    def test_nearest_rank(self):
+        from dtrove.benchmarks.base import percentiles
+        summary = percentiles(range(100, 0, -1))
+        self.assertEqual(50, summary['p50'])
+        self.assertEqual(95, summary['p95'])
+        self.assertEqual(99, summary['p99'])
+        # Ranks round up to the next sample
+        summary = percentiles([1, 2, 3])
+        self.assertEqual(2, summary['p50'])
+        self.assertEqual(3, summary['p95'])
+        self.assertEqual(3, summary['p99'])
+        self.assertEqual(2, summary['mean'])
+
+
+class StagesTests(DtroveTest):
+
+    def test_wrap(self):
+        from dtrove.benchmarks.base import Stages
+        stages = Stages()
+        wrapped = stages.wrap('double', lambda x: x * 2)
+        self.assertEqual(4, wrapped(2))
+
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, stages.wrap('fail', fail))
+        summary = stages.summary()
+        self.assertEqual(1, summary['double']['count'])
+        # Failed calls are timed too
+        self.assertEqual(1, summary['fail']['count'])
+
+
+class ProvisioningTests(DtroveTest):
+
+    def test_smoke(self):
+        from dtrove.benchmarks import provisioning
+        with patch('dtrove.benchmarks.provisioning.test_database'):
+            found = provisioning.run(clusters=2, size=2)
+        self.assertEqual(0, found['failed'])
+        stages = found['stages']
+        self.assertEqual(2, stages['cluster']['count'])
+        for name in ('create_server', 'wait_for_server', 'prepare'):
+            self.assertEqual(4, stages[name]['count'])
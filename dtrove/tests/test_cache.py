@@ -0,0 +1,25 @@
+from dtrove import cache
+from .base import *
+
+
+class CounterTests(DtroveTest):
+
+    def setUp(self):
+        cache.CACHE.clear()
+        self.addCleanup(cache.CACHE.clear)
+
+    def test_incr(self):
+        self.assertEqual(1, cache.incr('counter'))
+        self.assertEqual(4, cache.incr('counter', 3))
+        self.assertEqual(4, cache.CACHE.get('counter'))
+
+    def test_timeout(self):
+        with patch.object(cache.CACHE, 'add') as add:
+            cache.incr('counter', timeout=30)
+        add.assert_called_once_with('counter', 0, 30)
+
+    def test_evicted(self):
+        # Gone between the add and the incr
+        with patch.object(cache.CACHE, 'incr', side_effect=ValueError):
+            self.assertEqual(2, cache.incr('counter', 2, 30))
+        self.assertEqual(2, cache.CACHE.get('counter'))
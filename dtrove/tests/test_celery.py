@@ -0,0 +1,128 @@
+
+import os
+
+from dtrove import celery
+from .base import *
+
+
+class RoutingTests(DtroveTest):
+
+    def route(self, task):
+        return celery.app.amqp.router.route({}, task)
+
+    def test_prepare(self):
+        route = self.route('dtrove.tasks.prepare')
+        self.assertEqual(celery.PREPARE, route['queue'].name)
+        self.assertEqual(celery.PREPARE, route['queue'].routing_key)
+        self.assertEqual(6, route['priority'])
+
+    def test_poll(self):
+        route = self.route('dtrove.tasks.wait_for_server')
+        self.assertEqual(celery.POLL, route['queue'].name)
+
+    def test_priority_within_queue(self):
+        refresh = self.route('dtrove.tasks.refresh_status')
+        poll = self.route('dtrove.tasks.poll_status')
+        self.assertEqual(refresh['queue'].name, poll['queue'].name)
+        self.assertGreater(refresh['priority'], poll['priority'])
+        keys = self.route('dtrove.tasks.generate_key')
+        self.assertGreater(self.route('dtrove.tasks.prepare')['priority'],
+                           keys['priority'])
+
+    def test_chord_unlock(self):
+        route = self.route('celery.chord_unlock')
+        self.assertEqual(celery.CONTROL, route['queue'].name)
+
+    def test_control(self):
+        route = self.route('dtrove.tasks.refresh_status')
+        self.assertEqual(celery.POLL, route['queue'].name)
+        route = self.route('dtrove.tasks.preform')
+        self.assertEqual(celery.CONTROL, route['queue'].name)
+        self.assertEqual(8, route['priority'])
+
+    def test_other_tasks(self):
+        route = self.route('dtrove.celery.debug_task')
+        self.assertEqual('celery', route['queue'].name)
+        self.assertNotIn('priority', route)
+
+    def test_router(self):
+        router = celery.Router({'a': 'q'}, {})
+        self.assertEqual({'queue': 'q'}, router.route_for_task('a'))
+        self.assertEqual(None, router.route_for_task('b'))
+        router = celery.Router({'a': 'q'}, {'a': 3})
+        self.assertEqual({'queue': 'q', 'priority': 3},
+                         router.route_for_task('a'))
+
+    def test_queues(self):
+        queues = celery.app.amqp.queues
+        for name in (celery.CONTROL, celery.POLL, celery.PREPARE):
+            arguments = queues[name].queue_arguments
+            self.assertEqual(10, arguments['x-max-priority'])
+
+
+class Conf(object):
+    CELERYD_CONCURRENCY = 0
+    CELERYD_PREFETCH_MULTIPLIER = None
+
+
+class WorkerProfileTests(DtroveTest):
+
+    def setUp(self):
+        self.env = patch.dict(os.environ)
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        os.environ.pop('DTROVE_WORKER_PROFILE', None)
+        self.worker = MagicMock(spec=['app', 'concurrency'])
+        self.worker.concurrency = 0
+        self.conf = Conf()
+
+    def start(self, *args):
+        """Start a worker with the real `celery worker` options"""
+        from celery.bin.worker import worker
+        command = worker(app=celery.app)
+        parser = command.create_parser('celery', 'worker')
+        options, _ = parser.parse_args(list(args))
+        celery._apply_worker_profile(instance=self.worker,
+                                     conf=self.conf,
+                                     options=vars(options))
+        celery._apply_concurrency(sender=self.worker)
+
+    def test_no_profile(self):
+        self.assertEqual(None, celery.worker_profile())
+        self.start()
+        self.assertFalse(self.worker.app.amqp.queues.select.called)
+        self.assertEqual(0, self.worker.concurrency)
+        self.assertEqual(None, self.conf.CELERYD_PREFETCH_MULTIPLIER)
+
+    def test_profile(self):
+        os.environ['DTROVE_WORKER_PROFILE'] = 'prepare'
+        self.start()
+        self.worker.app.amqp.queues.select.assert_called_once_with(
+            [celery.PREPARE])
+        self.assertEqual(16, self.worker.concurrency)
+        self.assertEqual(1, self.conf.CELERYD_PREFETCH_MULTIPLIER)
+
+    def test_setting(self):
+        with patch('dtrove.celery.settings.DTROVE_WORKER_PROFILE', 'poll',
+                   create=True):
+            self.assertEqual(celery.WORKER_PROFILES['poll'],
+                             celery.worker_profile())
+
+    def test_command_line_wins(self):
+        os.environ['DTROVE_WORKER_PROFILE'] = 'control'
+        self.start('-Q', 'other', '-c', '2')
+        self.assertFalse(self.worker.app.amqp.queues.select.called)
+        self.assertEqual(0, self.worker.concurrency)
+        self.assertEqual(4, self.conf.CELERYD_PREFETCH_MULTIPLIER)
+
+    def test_default_queue_consumed(self):
+        default = celery.app.conf.CELERY_DEFAULT_QUEUE
+        for name in ('all', 'control'):
+            self.assertIn(default, celery.WORKER_PROFILES[name]['queues'])
+        os.environ['DTROVE_WORKER_PROFILE'] = 'all'
+        self.start()
+        self.worker.app.amqp.queues.select.assert_called_once_with(
+            [celery.CONTROL, celery.POLL, celery.PREPARE, default])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, celery.worker_profile, 'nope')
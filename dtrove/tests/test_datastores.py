@@ -1,6 +1,9 @@
 
+from django.core.exceptions import ImproperlyConfigured
 from django.template import TemplateDoesNotExist
 
+from dtrove import datastores
+from dtrove.datastores import base
 from dtrove.datastores.base import BaseManager
 from dtrove.datastores.mysql import MySQLManager
 from .base import *
@@ -15,6 +18,8 @@ class BaseDatastoreTests(DtroveTest):
         patcher = patch('dtrove.datastores.base.run')
         self.mock_run = patcher.start()
         self.addCleanup(patcher.stop)
+        base.clear_template_cache()
+        self.addCleanup(base.clear_template_cache)
 
     def test_backup(self):
         self.assertRaises(NotImplementedError, self.manager.backup, None)
@@ -23,9 +28,69 @@ class BaseDatastoreTests(DtroveTest):
         self.assertRaises(NotImplementedError, self.manager.prepare, None)
 
     def test_render_config_file(self):
-        template = self.manager.render_config_file(self.instance)
+        manager = MySQLManager(self.datastore)
+        template = manager.render_config_file(self.instance)
         self.assertTemplateUsed(template, 'mysql/config')
 
+    def test_config_template_cached(self):
+        manager = MySQLManager(self.datastore)
+        with patch('dtrove.datastores.base.load_template',
+                   wraps=base.load_template) as load:
+            first = manager.config_template()
+            second = MySQLManager(self.datastore).config_template()
+        self.assertEqual(1, load.call_count)
+        self.assertTrue(first[0] is second[0])
+
+    def test_config_template_changed(self):
+        manager = MySQLManager(self.datastore)
+        template, mtime, uses_instance = manager.config_template()
+        with patch('dtrove.datastores.base._mtime', return_value=mtime + 1):
+            changed = manager.config_template()
+        self.assertFalse(template is changed[0])
+        self.assertEqual(mtime + 1, changed[1])
+
+    def test_render_once_per_cluster(self):
+        manager = MySQLManager(self.datastore)
+        other = create_instance(name='other', cluster=self.instance.cluster)
+        config = manager.render_config_file(self.instance)
+        with patch('dtrove.datastores.base.Context') as context:
+            self.assertEqual(config, manager.render_config_file(other))
+            self.assertFalse(context.called)
+
+    def test_render_datastore_changed(self):
+        manager = MySQLManager(self.datastore)
+        manager.render_config_file(self.instance)
+        # The same datastore row was edited
+        self.datastore.packages = 'mysql-server-5.6'
+        with patch('dtrove.datastores.base.Context') as context:
+            manager.render_config_file(self.instance)
+        self.assertTrue(context.called)
+
+    def test_render_per_node(self):
+        manager = MySQLManager(self.datastore)
+        template, mtime, uses_instance = manager.config_template()
+        key = (manager.name, self.datastore.version)
+        path = base._TEMPLATES[key][1]
+        source = base.Template('server_id = {{ instance.name }}')
+        base._TEMPLATES[key] = (source, path, mtime, True)
+        other = create_instance(name='other')
+        self.assertEqual('server_id = test_instance',
+                         manager.render_config_file(self.instance))
+        self.assertEqual('server_id = other',
+                         manager.render_config_file(other))
+
+    def test_uses_instance(self):
+        for source, expected in [
+                ('port = 3306', False),
+                ('server_id = {{ instance.pk }}', True),
+                ('{% include "mysql/node" %}', True),
+                ('{% extends "mysql/base" %}{% block a %}{% endblock %}',
+                 True),
+                ('{% if datastore %}{% include "x" %}{% endif %}', True)]:
+            template = base.Template(source)
+            self.assertEqual(expected,
+                             base._uses_instance(template, source), source)
+
     def test_config_not_found(self):
         ds = create_datastore(manager='dtrove.datastores.base.BaseManager')
         manager = BaseManager(ds)
@@ -55,6 +120,62 @@ class BaseDatastoreTests(DtroveTest):
         manager = BaseManager(ds_spacey)
         self.assertEqual([], manager.packages)
 
+    def test_install_plan(self):
+        self.mock_run.return_value = '\n'.join([
+            'curl install ok installed',
+            'ssh deinstall ok config-files',
+            '/var/lib/apt/lists/archive_Packages',
+        ])
+        missing, fresh = self.manager.install_plan(['curl', 'ssh', 'vim'])
+        self.assertEqual(['ssh', 'vim'], missing)
+        self.assertTrue(fresh)
+        cmd = self.mock_run.call_args[0][0]
+        self.assertTrue(cmd.startswith('dpkg-query'))
+        self.assertTrue('curl ssh vim' in cmd)
+
+    def test_install_packages_fresh(self):
+        self.mock_run.return_value = '/var/lib/apt/lists/archive_Packages'
+        self.assertEqual(['curl', 'ssh'],
+                         self.manager.install_packages(['curl', 'ssh']))
+        self.mock_run.assert_called_with(
+            'DEBIAN_FRONTEND=noninteractive apt-get install -y curl ssh')
+
+    def test_install_packages_installed(self):
+        self.mock_run.return_value = 'curl install ok installed'
+        with self.manager.record_timings() as timings:
+            self.assertEqual([], self.manager.install_packages(['curl']))
+        self.assertEqual(1, self.mock_run.call_count)
+        self.assertEqual(['plan'], timings.keys())
+
+    def test_timings_per_thread(self):
+        import threading
+        self.mock_run.return_value = ''
+        found = {}
+
+        def prepare(name):
+            with self.manager.record_timings() as timings:
+                with self.manager.timed(name):
+                    started.wait()
+            found[name] = timings.keys()
+        started = threading.Event()
+        threads = [threading.Thread(target=prepare, args=(name,))
+                   for name in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+        # The shared manager keeps the steps of each caller apart
+        self.assertEqual({'first': ['first'], 'second': ['second']}, found)
+
+    def test_timed_without_recorder(self):
+        with self.manager.timed('plan'):
+            pass
+
+    def test_install_no_packages(self):
+        self.assertEqual([], self.manager.install_packages())
+        self.assertFalse(self.mock_run.called)
+
 
 class TestMySQLManager(DtroveTest):
 
@@ -73,11 +194,70 @@ class TestMySQLManager(DtroveTest):
         self.manager = MySQLManager(self.datastore)
 
     def test_prepare(self):
-        self.manager.prepare(self.instance)
+        self.mock_base_run.return_value = ''
+        with self.manager.record_timings() as timings:
+            self.manager.prepare(self.instance)
         apt = 'DEBIAN_FRONTEND=noninteractive apt-get install -y mysql-server'
-        self.mock_run.assert_has_calls([
-            call('apt-get update'),
-            call(apt)
+        self.mock_base_run.assert_has_calls([
+            call(ANY, quiet=True),
+            call('apt-get update && %s' % apt),
+            call('service mysql restart'),
         ])
+        self.assertFalse(self.mock_run.called)
         self.mock_put.assert_called_with(ANY, '/etc/mysql/my.cnf')
-        self.mock_base_run.assert_called_with('service mysql restart')
+        self.assertEqual(['plan', 'install', 'config', 'restart'],
+                         timings.keys())
+
+
+class RegistryTests(DtroveTest):
+
+    def setUp(self):
+        datastores.clear()
+        self.addCleanup(datastores.clear)
+        self.datastore = create_datastore(save=True)
+
+    def test_load_managers(self):
+        self.assertEqual({'mysql': MySQLManager}, datastores.load_managers())
+
+    def test_load_managers_clears_templates(self):
+        base._RENDERED['stale'] = 'output'
+        datastores.load_managers()
+        self.assertEqual({}, base._RENDERED)
+
+    def test_load_missing_manager(self):
+        managers = [('dtrove.datastores.redis.RedisManager', 'redis')]
+        self.assertRaises(ImproperlyConfigured,
+                          datastores.load_managers, managers)
+
+    def test_load_not_a_manager(self):
+        managers = [('dtrove.datastores.base.LOG', 'log')]
+        self.assertRaises(ImproperlyConfigured,
+                          datastores.load_managers, managers)
+
+    def test_class_imported_once(self):
+        path = self.datastore.manager_class
+        with patch('dtrove.datastores.import_string',
+                   return_value=MySQLManager) as import_string:
+            datastores.get_manager_class(path)
+            datastores.get_manager_class(path)
+            import_string.assert_called_once_with(path)
+
+    def test_manager_memoized(self):
+        manager = self.datastore.manager
+        self.assertTrue(manager is self.datastore.manager)
+        fetched = models.Datastore.objects.get(pk=self.datastore.pk)
+        self.assertTrue(manager is fetched.manager)
+
+    def test_manager_forgotten_on_save(self):
+        manager = self.datastore.manager
+        self.datastore.packages = 'mysql-server'
+        self.datastore.save()
+        self.assertFalse(manager is self.datastore.manager)
+        self.assertEqual(['mysql-server'], self.datastore.manager.packages)
+
+    def test_manager_changed_elsewhere(self):
+        manager = self.datastore.manager
+        models.Datastore.objects.filter(pk=self.datastore.pk).update(
+            version='5.6')
+        fetched = models.Datastore.objects.get(pk=self.datastore.pk)
+        self.assertFalse(manager is fetched.manager)
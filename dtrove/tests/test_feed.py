@@ -0,0 +1,113 @@
+
+import time
+
+from dtrove import feed
+from .base import *
+
+
+class FeedTests(DtroveTest):
+
+    def setUp(self):
+        feed.CACHE.clear()
+        self.addCleanup(feed.CACHE.clear)
+
+    def test_publish(self):
+        self.assertEqual(0, feed.current('c'))
+        self.assertEqual(2, feed.publish('c', [{'a': 1}, {'a': 2}]))
+        self.assertEqual(3, feed.publish('c', [{'a': 3}]))
+        last, events = feed.read('c')
+        self.assertEqual(3, last)
+        self.assertEqual([1, 2, 3], [e['seq'] for e in events])
+        self.assertEqual([1, 2, 3], [e['a'] for e in events])
+
+    def test_publish_nothing(self):
+        self.assertEqual(0, feed.publish('c', []))
+
+    def test_read_after(self):
+        feed.publish('c', [{'a': 1}, {'a': 2}, {'a': 3}])
+        last, events = feed.read('c', after=2)
+        self.assertEqual([3], [e['seq'] for e in events])
+        self.assertEqual((3, []), feed.read('c', after=3))
+
+    def test_channels(self):
+        feed.publish('c', [{'a': 1}])
+        self.assertEqual((0, []), feed.read('other'))
+
+    def test_backlog(self):
+        feed.publish('c', [{'a': i} for i in range(10)])
+        with patch('dtrove.config.DTROVE_FEED_BACKLOG', 3):
+            last, events = feed.read('c')
+        self.assertEqual([8, 9, 10], [e['seq'] for e in events])
+
+    def reserve(self, count):
+        """Take sequence numbers like a publisher that hasn't written yet"""
+        feed.CACHE.add(feed._seq_key('c'), 0, None)
+        feed.CACHE.incr(feed._seq_key('c'), count)
+
+    def test_read_in_flight(self):
+        feed.publish('c', [{'a': 1}])
+        self.reserve(1)
+        feed.publish('c', [{'a': 3}])
+        self.assertEqual(3, feed.current('c'))
+        last, events = feed.read('c')
+        # Stops before the event that is still being written
+        self.assertEqual(1, last)
+        self.assertEqual([1], [e['seq'] for e in events])
+        self.assertEqual((1, []), feed.read('c', after=1))
+        feed.CACHE.set(feed._event_key('c', 2), (0, {'a': 2, 'seq': 2}))
+        last, events = feed.read('c', after=1)
+        self.assertEqual(3, last)
+        self.assertEqual([2, 3], [e['seq'] for e in events])
+
+    def test_read_lost(self):
+        self.reserve(1)
+        feed.publish('c', [{'a': 2}])
+        later = time.time() + 6
+        with patch('dtrove.feed.time.time', return_value=later):
+            last, events = feed.read('c')
+        self.assertEqual(2, last)
+        self.assertEqual([2], [e['seq'] for e in events])
+
+    def test_wait_in_flight(self):
+        self.reserve(1)
+
+        def publish(seconds):
+            feed.CACHE.set(feed._event_key('c', 1), (0, {'a': 1, 'seq': 1}))
+        with patch('dtrove.feed.time.sleep', side_effect=publish) as sleep:
+            last, events = feed.wait('c', timeout=10)
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual((1, [1]), (last, [e['seq'] for e in events]))
+
+    def test_wait_timeout(self):
+        with patch('dtrove.feed.time.sleep') as sleep:
+            self.assertEqual((0, []), feed.wait('c', timeout=0))
+            self.assertFalse(sleep.called)
+
+    def test_wait(self):
+        def publish(seconds):
+            feed.publish('c', [{'a': 1}])
+        with patch('dtrove.feed.time.sleep', side_effect=publish) as sleep:
+            last, events = feed.wait('c', timeout=10)
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual([1], [e['seq'] for e in events])
+
+    def test_state_published(self):
+        instance = create_instance(server='feed', save=False)
+        instance.cluster_id = 7
+        instance.pk = 3
+        instance.set_state(status='build', progress=10)
+        last, events = feed.read(7)
+        self.assertEqual(1, len(events))
+        self.assertEqual('build', events[0]['status'])
+        self.assertEqual(3, events[0]['instance'])
+        self.assertEqual('feed', events[0]['server'])
+        self.assertEqual(1, events[0]['version'])
+
+    def test_stale_state_not_published(self):
+        instance = create_instance(server='feed', save=False)
+        instance.cluster_id = 7
+        models.Instance.set_state_many({'feed': {'status': 'active'}}, 2000,
+                                       [instance])
+        models.Instance.set_state_many({'feed': {'status': 'build'}}, 1000,
+                                       [instance])
+        self.assertEqual(1, feed.current(7))
@@ -0,0 +1,159 @@
+import time
+
+from django.test import Client
+
+from dtrove import metrics
+from dtrove.models import Instance
+from dtrove.providers.openstack import Provider
+from dtrove.tasks import runner
+from .base import *
+
+
+class MetricsTests(DtroveTest):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_counter(self):
+        metrics.STATE_CACHE.inc(result='hit')
+        metrics.STATE_CACHE.inc(result='hit')
+        metrics.STATE_CACHE.inc(result='miss')
+        text = metrics.render()
+        self.assertIn('dtrove_state_cache_total{result="hit"} 2', text)
+        self.assertIn('dtrove_state_cache_total{result="miss"} 1', text)
+        self.assertIn('# TYPE dtrove_state_cache_total counter', text)
+
+    def test_histogram(self):
+        metrics.PROVIDER_SECONDS.observe(0.003, method='create')
+        metrics.PROVIDER_SECONDS.observe(0.2, method='create')
+        metrics.PROVIDER_SECONDS.observe(1000, method='create')
+        text = metrics.render()
+        series = 'dtrove_provider_seconds_bucket{method="create",le="%s"}'
+        self.assertIn(series % '0.005' + ' 1', text)
+        self.assertIn(series % '0.1' + ' 1', text)
+        self.assertIn(series % '0.25' + ' 2', text)
+        self.assertIn(series % '+Inf' + ' 3', text)
+        self.assertIn(
+            'dtrove_provider_seconds_count{method="create"} 3', text)
+        self.assertIn(
+            'dtrove_provider_seconds_sum{method="create"} 1000.203', text)
+
+    def test_buffered(self):
+        with patch('dtrove.config.DTROVE_METRICS_FLUSH_INTERVAL', 60):
+            metrics.flush()
+            metrics.STATE_CACHE.inc(result='hit')
+            key = metrics.STATE_CACHE.key((('result', 'hit'),), 'total')
+            self.assertEqual(None, metrics.CACHE.get(key))
+            metrics.flush()
+            self.assertEqual(1, metrics.CACHE.get(key))
+
+    def test_flush_after_task(self):
+        key = metrics.TASK_SECONDS.key((('task', 'prepare'),), 'sum')
+        task = MagicMock(spec=['name'])
+        task.name = 'dtrove.tasks.prepare'
+        with patch('dtrove.config.DTROVE_METRICS_FLUSH_INTERVAL', 60):
+            metrics.flush()
+            metrics._task_started(task_id='t1')
+            metrics._task_finished(task_id='t1', sender=task)
+            self.assertEqual(None, metrics.CACHE.get(key))
+            # Once the interval has passed
+            with patch('dtrove.metrics._last_flush', [time.time() - 60]):
+                metrics._task_started(task_id='t2')
+                metrics._task_finished(task_id='t2', sender=task)
+        self.assertNotEqual(None, metrics.CACHE.get(key))
+
+    def test_flush_after_request(self):
+        key = metrics.STATE_CACHE.key((('result', 'miss'),), 'total')
+        with patch('dtrove.config.DTROVE_METRICS_FLUSH_INTERVAL', 60):
+            metrics.flush()
+            metrics.STATE_CACHE.inc(result='miss')
+            Client().get('/api/datastores')
+            self.assertEqual(None, metrics.CACHE.get(key))
+            with patch('dtrove.metrics._last_flush', [time.time() - 60]):
+                Client().get('/api/datastores')
+        self.assertEqual(1, metrics.CACHE.get(key))
+
+    def test_flush_on_shutdown(self):
+        from celery.signals import worker_process_shutdown
+        key = metrics.STATE_CACHE.key((('result', 'hit'),), 'total')
+        with patch('dtrove.config.DTROVE_METRICS_FLUSH_INTERVAL', 60):
+            metrics.flush()
+            metrics.STATE_CACHE.inc(result='hit')
+            worker_process_shutdown.send(sender=None)
+        self.assertEqual(1, metrics.CACHE.get(key))
+
+    def test_aggregated(self):
+        # Another process already added to the totals in the cache
+        metrics.STATE_CACHE.inc(result='hit')
+        metrics.flush()
+        metrics.STATE_CACHE.series.clear()
+        metrics.STATE_CACHE.inc(5, result='hit')
+        metrics.STATE_CACHE.inc(result='miss')
+        text = metrics.render()
+        self.assertIn('dtrove_state_cache_total{result="hit"} 6', text)
+        self.assertIn('dtrove_state_cache_total{result="miss"} 1', text)
+
+    def test_timed_error(self):
+        @metrics.timed(metrics.PROVIDER_SECONDS, metrics.PROVIDER_ERRORS,
+                       method='boom')
+        def boom():
+            raise ValueError()
+
+        self.assertRaises(ValueError, boom)
+        text = metrics.render()
+        self.assertIn('dtrove_provider_seconds_count{method="boom"} 1', text)
+        self.assertIn('dtrove_provider_errors_total{method="boom"} 1', text)
+
+    @patch('dtrove.providers.openstack.Provider.nova')
+    def test_provider_create_key(self, nova):
+        key = create_key()
+        Provider().create_key(key)
+        self.assertIn('dtrove_provider_seconds_count{method="create_key"} 1',
+                      metrics.render())
+
+    @patch('dtrove.tasks.run')
+    def test_ssh_command(self, run):
+        runner('ls')
+        self.assertIn('dtrove_ssh_command_seconds_count 1', metrics.render())
+
+    def test_state_cache(self):
+        instance = create_instance(server='abc')
+        instance.set_state(status='build', progress=5)
+        self.assertEqual('build', instance.server_status)
+        self.assertEqual(5, instance.progress)
+        self.assertIn('dtrove_state_cache_total{result="hit"} 2',
+                      metrics.render())
+
+    @patch('dtrove.models.PROVIDER')
+    def test_state_cache_miss(self, provider):
+        provider.update_status.return_value = ('active', 100)
+        instance = create_instance(server='missing')
+        self.assertEqual('active', instance.server_status)
+        self.assertIn('dtrove_state_cache_total{result="miss"} 1',
+                      metrics.render())
+
+    def test_task_duration(self):
+        from dtrove.tasks import preform
+        instance = create_instance()
+        with patch('dtrove.tasks.POOL'):
+            preform.apply(args=(instance.pk, 'test', 'ls'))
+        self.assertIn('dtrove_task_seconds_count{task="preform"} 1',
+                      metrics.render())
+
+    def test_task_failure(self):
+        from dtrove.tasks import preform
+        preform.apply(args=(0, 'test'))
+        self.assertIn('dtrove_task_failures_total{task="preform"} 1',
+                      metrics.render())
+
+    def test_key_pool(self):
+        self.assertIn('dtrove_key_pool_available 0', metrics.render())
+
+    def test_endpoint(self):
+        metrics.STATE_CACHE.inc(result='hit')
+        response = Client().get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('dtrove_state_cache_total{result="hit"} 1',
+                      response.content)
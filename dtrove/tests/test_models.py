@@ -1,3 +1,6 @@
+import threading
+import time
+
 
 from .base import *
 
@@ -46,6 +49,81 @@ class InstanceModelTests(DtroveTest):
         instance.message = 'I am a message'
         self.assertEqual('I am a message', instance.message)
 
+    def test_state_many(self):
+        models.Instance.set_state_many({
+            'many_1': {'status': 'build', 'progress': 10},
+            'many_2': {'status': 'error', 'progress': 0, 'message': 'fail'},
+        }, observed=1000)
+        found = models.Instance.get_state_many(['many_1', 'many_2', 'none'])
+        self.assertEqual({
+            'many_1': {'status': 'build', 'progress': 10, 'message': None,
+                       'updated_at': 1000, 'version': 1},
+            'many_2': {'status': 'error', 'progress': 0, 'message': 'fail',
+                       'updated_at': 1000, 'version': 1},
+            'none': {'status': None, 'progress': None, 'message': None,
+                     'updated_at': None, 'version': None},
+        }, found)
+        instance = create_instance(server='many_2')
+        self.assertEqual('error', instance.server_status)
+        self.assertEqual('fail', instance.message)
+
+    def test_state_record(self):
+        instance = create_instance(server='record')
+        instance.server_status = 'build'
+        instance.progress = 20
+        state = instance.state
+        self.assertEqual('build', state['status'])
+        self.assertEqual(20, state['progress'])
+        self.assertEqual(2, state['version'])
+        self.assertEqual(state, models.CACHE.get('state:record'))
+        self.assertEqual(None, models.CACHE.get('status:record'))
+
+    def test_stale_state(self):
+        models.Instance.set_state_many(
+            {'stale': {'status': 'active', 'progress': 100}}, observed=2000)
+        versions = models.Instance.set_state_many(
+            {'stale': {'status': 'build', 'progress': 50}}, observed=1000)
+        self.assertEqual({'stale': None}, versions)
+        instance = create_instance(server='stale')
+        self.assertEqual('active', instance.server_status)
+        self.assertEqual(1, instance.state['version'])
+
+    def test_state_locked(self):
+        instance = create_instance(server='locked')
+        with models.Instance.lock_states(['locked']):
+            writer = threading.Thread(target=instance.set_state,
+                                      kwargs={'progress': 50})
+            writer.start()
+            time.sleep(0.05)
+            self.assertEqual(None, models.CACHE.get('state:locked'))
+        writer.join()
+        self.assertEqual(50, instance.state['progress'])
+        self.assertEqual(None, models.CACHE.get('state:locked:lock'))
+
+    def test_state_concurrent_writes(self):
+        def write(**state):
+            for x in range(50):
+                models.Instance.set_state_many({'racing': state})
+        writers = [
+            threading.Thread(target=write, kwargs={'status': 'build'}),
+            threading.Thread(target=write, kwargs={'progress': 10}),
+        ]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        state = models.Instance.get_state_many(['racing'])['racing']
+        self.assertEqual(100, state['version'])
+        self.assertEqual('build', state['status'])
+        self.assertEqual(10, state['progress'])
+
+    def test_state_single_write(self):
+        instance = create_instance(server='single')
+        with patch('dtrove.models.CACHE.set_many') as set_many, \
+                patch('dtrove.feed.publish'):
+            instance.set_state(status='error', progress=0, message='fail')
+        self.assertEqual(1, set_many.call_count)
+
     def test_provision(self):
         with patch('dtrove.tasks.create') as task:
             instance = create_instance(server='', save=True)
@@ -58,11 +136,25 @@ class ClusterModelTests(DtroveTest):
         patcher = patch('dtrove.models.Instance.provision')
         self.MockClass = patcher.start()
         self.addCleanup(patcher.stop)
+        self.cluster_patcher = patch('dtrove.models.Cluster.provision')
+        self.MockProvision = self.cluster_patcher.start()
+        self.addCleanup(self.cluster_patcher.stop)
         self.cluster = create_cluster(size=2, save=True)
 
     def test_unicode(self):
         self.assertEqual(u'test_cluster', unicode(self.cluster))
 
+    def test_provision_once(self):
+        ids = list(self.cluster.instance_set.values_list('pk', flat=True))
+        self.MockProvision.assert_called_once_with(ids)
+        self.assertFalse(self.MockClass.called)
+
+    def test_provision_task(self):
+        with patch('dtrove.tasks.create_cluster') as task:
+            provision = self.cluster_patcher.temp_original
+            provision(self.cluster, [1, 2])
+            task.delay.assert_called_with(self.cluster.pk, [1, 2])
+
     def test_max_cluster(self):
         kwargs = {
             'name': 'foo',
@@ -88,10 +180,169 @@ class ClusterModelTests(DtroveTest):
         self.cluster.add_node()
         self.assertEqual(3, self.cluster.instance_set.count())
         self.assertEqual(3, self.cluster.size)
+        newest = self.cluster.instance_set.latest('pk')
+        self.MockProvision.assert_called_with([newest.pk])
 
     def test_add_too_large(self):
         self.cluster.save()
         self.assertRaises(ValidationError, self.cluster.add_node, 5)
+        self.assertEqual(2, self.cluster.instance_set.count())
+
+    def test_add_node_shares_key(self):
+        keys = set(self.cluster.instance_set.values_list('key', flat=True))
+        self.assertEqual(1, len(keys))
+        with patch('dtrove.models.Key.create') as create:
+            self.cluster.add_node(2)
+            self.assertFalse(create.called)
+        keys = set(self.cluster.instance_set.values_list('key', flat=True))
+        self.assertEqual(1, len(keys))
+
+    def test_add_node_skips_removing_key(self):
+        self.cluster.save()
+        self.cluster.instance_set.update(removing=True)
+        key = create_key(name='fresh', save=True)
+        with patch('dtrove.models.Key.claim', return_value=key):
+            added = self.cluster.add_node(1)
+        node = models.Instance.objects.get(pk=added[0])
+        self.assertEqual(key.pk, node.key_id)
+
+    def test_key_protected(self):
+        from django.db.models import ProtectedError
+        self.cluster.save()
+        key = self.cluster.instance_set.first().key
+        self.assertRaises(ProtectedError, key.delete)
+
+    def test_add_node_queries(self):
+        # Savepoint, lock, key lookup, count, insert, id lookup, size update
+        # and release no matter how many nodes are added.
+        with self.assertNumQueries(8):
+            ids = self.cluster.add_node(3)
+        self.assertEqual(3, len(ids))
+        cluster = models.Cluster.objects.get(pk=self.cluster.pk)
+        self.assertEqual(5, cluster.size)
+
+    def test_add_no_nodes(self):
+        self.MockProvision.reset_mock()
+        self.assertEqual([], self.cluster.add_node(0))
+        self.assertFalse(self.MockProvision.called)
+
+    def test_aggregate(self):
+        def nodes(*states):
+            return [{'status': status, 'progress': progress}
+                    for status, progress in states]
+        aggregate = models.Cluster.aggregate
+        self.assertEqual(('unknown', 0), aggregate([]))
+        self.assertEqual(('active', 100),
+                         aggregate(nodes(('active', None), ('active', 90))))
+        self.assertEqual(('build', 50),
+                         aggregate(nodes(('active', 100), ('unknown', None))))
+        self.assertEqual(('error', 10),
+                         aggregate(nodes(('error', 0), ('build', 20))))
+        self.assertEqual(('unknown', 0),
+                         aggregate(nodes(('unknown', None))))
+
+    def test_refresh_status(self):
+        with patch('dtrove.tasks.refresh_status') as task:
+            self.cluster.refresh_status([1, 2])
+            task.delay.assert_called_with([1, 2])
+
+    def servers(self, *states):
+        """Give the nodes of the cluster a server in the given states"""
+        models.CACHE.clear()
+        self.addCleanup(models.CACHE.clear)
+        nodes = list(self.cluster.instance_set.order_by('pk'))
+        for x, (node, status) in enumerate(zip(nodes, states)):
+            node.server = 'resize_%d' % x
+            node.save()
+            if status is not None:
+                node.server_status = status
+        return nodes
+
+    def test_resize_grow(self):
+        with patch.object(self.cluster, 'scale_down') as scale_down:
+            added, removed = self.cluster.resize(4)
+        self.assertEqual(2, len(added))
+        self.assertEqual([], removed)
+        self.assertFalse(scale_down.called)
+        self.assertEqual(4, self.cluster.instance_set.count())
+        self.MockProvision.assert_called_with(added)
+
+    def test_resize_grow_locked(self):
+        from django.db import transaction
+        connection = transaction.get_connection()
+        depth = len(connection.savepoint_ids)
+        insert = models.Cluster._insert_nodes
+        depths = []
+
+        def insert_nodes(*args):
+            depths.append(len(connection.savepoint_ids))
+            return insert(self.cluster, *args)
+        with patch.object(self.cluster, '_insert_nodes', insert_nodes):
+            with patch.object(self.cluster, 'add_node') as add_node:
+                self.cluster.resize(3)
+                self.cluster.resize(3)
+        # The nodes are counted and inserted in the one locked transaction
+        self.assertFalse(add_node.called)
+        self.assertEqual([depth + 1], depths)
+        self.assertEqual(3, len(self.cluster.live_nodes()))
+        cluster = models.Cluster.objects.get(pk=self.cluster.pk)
+        self.assertEqual(3, cluster.size)
+
+    def test_resize_shrink(self):
+        nodes = self.servers('active', 'active')
+        with patch.object(self.cluster, 'scale_down') as scale_down:
+            added, removed = self.cluster.resize(1)
+        self.assertEqual([], added)
+        # The newest node goes first
+        self.assertEqual([nodes[1].pk], removed)
+        scale_down.assert_called_once_with(removed)
+        self.assertEqual('draining', nodes[1].server_status)
+        cluster = models.Cluster.objects.get(pk=self.cluster.pk)
+        self.assertEqual(1, cluster.size)
+        # The draining node doesn't count
+        self.assertEqual([nodes[0].pk],
+                         [node['id'] for node in self.cluster.live_nodes()])
+
+    def test_resize_same_size(self):
+        self.servers('active', 'active')
+        with patch.object(self.cluster, 'scale_down') as scale_down:
+            self.assertEqual(([], []), self.cluster.resize(2))
+        self.assertFalse(scale_down.called)
+
+    def test_resize_invalid(self):
+        self.assertRaises(ValidationError, self.cluster.resize, -1)
+        self.assertRaises(ValidationError, self.cluster.resize, 6)
+
+    def test_resize_after_shrink(self):
+        nodes = self.servers('active', 'active')
+        with patch.object(self.cluster, 'scale_down'):
+            self.cluster.resize(1)
+            added, removed = self.cluster.resize(0)
+        self.assertEqual([nodes[0].pk], removed)
+
+    def test_resize_unbuilt(self):
+        # Nodes without a server yet are marked too
+        nodes = list(self.cluster.instance_set.order_by('pk'))
+        with patch.object(self.cluster, 'scale_down'):
+            added, removed = self.cluster.resize(1)
+        self.assertEqual([nodes[1].pk], removed)
+        self.assertTrue(models.Instance.objects.get(pk=nodes[1].pk).removing)
+        self.assertEqual([nodes[0].pk],
+                         [node['id'] for node in self.cluster.live_nodes()])
+
+    def test_pick_victims(self):
+        nodes = [{'id': 1, 'status': 'active'},
+                 {'id': 2, 'status': 'active'},
+                 {'id': 3, 'status': 'build'},
+                 {'id': 4, 'status': 'error'},
+                 {'id': 5, 'status': None}]
+        picked = models.Cluster.pick_victims(nodes, 4)
+        self.assertEqual([4, 5, 3, 2], [node['id'] for node in picked])
+
+    def test_scale_down_task(self):
+        with patch('dtrove.tasks.scale_down') as task:
+            self.cluster.scale_down([1, 2])
+            task.delay.assert_called_with(self.cluster.pk, [1, 2])
 
 
 class DatastoreModelTests(DtroveTest):
@@ -107,6 +358,48 @@ class KeyModelTests(DtroveTest):
 
     def setUp(self):
         self.key = create_key()
+        models.CACHE.clear()
+        self.addCleanup(models.CACHE.clear)
 
     def test_unicode(self):
         self.assertEqual(u'testkey', unicode(self.key))
+
+    def test_generate_rsa(self):
+        public, private = models.Key.generate('rsa')
+        self.assertTrue(public.startswith('ssh-rsa '))
+        self.assertTrue('RSA PRIVATE KEY' in private)
+
+    def test_generate_ed25519(self):
+        public, private = models.Key.generate('ed25519')
+        self.assertTrue(public.startswith('ssh-ed25519 '))
+        self.assertTrue('OPENSSH PRIVATE KEY' in private)
+
+    def test_generate_unknown(self):
+        self.assertRaises(ValueError, models.Key.generate, 'dsa')
+
+    def test_claim_pooled(self):
+        pooled = create_key(name='pooled', save=True)
+        pooled.pooled = True
+        pooled.save()
+        with patch('dtrove.models.Key.generate') as generate:
+            key = models.Key.claim()
+            self.assertFalse(generate.called)
+        self.assertEqual(pooled.pk, key.pk)
+        self.assertFalse(models.Key.objects.get(pk=key.pk).pooled)
+        self.assertEqual(1, models.Key.pool_stats()['claims'])
+
+    def test_claim_empty(self):
+        with patch('dtrove.models.Key.generate') as generate:
+            generate.return_value = ('pub', 'priv')
+            key = models.Key.claim()
+        self.assertEqual('pub', key.public)
+        self.assertFalse(key.pooled)
+        self.assertEqual(1, models.Key.pool_stats()['empty'])
+
+    def test_pool_level(self):
+        models.Key.record_pool_level(5)
+        models.Key.record_pool_level(2)
+        models.Key.record_pool_level(4)
+        stats = models.Key.pool_stats()
+        self.assertEqual(4, stats['available'])
+        self.assertEqual(2, stats['low_water'])
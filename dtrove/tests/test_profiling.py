@@ -0,0 +1,78 @@
+
+import cProfile
+import glob
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from dtrove import celery
+from dtrove.tasks import generate_key
+from .base import *
+
+
+class ProfilingTests(DtroveTest):
+
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool)
+        patcher = patch('dtrove.config.DTROVE_PROFILE_DIR', self.spool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def profiles(self):
+        return glob.glob(os.path.join(self.spool, '*.pstats'))
+
+    def test_off(self):
+        generate_key.apply()
+        self.assertEqual([], self.profiles())
+
+    def test_task_names(self):
+        with patch('dtrove.config.DTROVE_PROFILE_TASKS',
+                   ['dtrove.tasks.generate_key']):
+            generate_key.apply()
+        profiles = self.profiles()
+        self.assertEqual(1, len(profiles))
+        self.assertTrue(os.path.basename(profiles[0])
+                        .startswith('dtrove.tasks.generate_key-'))
+
+    def test_rate(self):
+        with patch('dtrove.config.DTROVE_PROFILE_RATE', 1):
+            generate_key.apply()
+        self.assertEqual(1, len(self.profiles()))
+
+    def test_rotation(self):
+        profile = cProfile.Profile()
+        profile.runcall(sum, range(10))
+        first = celery.spool_profile(profile, 'task', 'a')
+        size = os.path.getsize(first)
+        # Make sure the first file is the oldest
+        os.utime(first, (0, 0))
+        with patch('dtrove.config.DTROVE_PROFILE_MAX_BYTES', size * 2 - 1):
+            second = celery.spool_profile(profile, 'task', 'b')
+        self.assertEqual([second], self.profiles())
+
+    def test_report(self):
+        with patch('dtrove.config.DTROVE_PROFILE_TASKS',
+                   ['dtrove.tasks.generate_key']):
+            generate_key.apply()
+            generate_key.apply()
+        out = StringIO()
+        call_command('profile_report', top=5, stdout=out)
+        output = out.getvalue()
+        self.assertIn('Merged 2 profiles', output)
+        self.assertIn('dtrove.tasks.generate_key', output)
+        self.assertIn('cumulative', output)
+
+    def test_report_clear(self):
+        with patch('dtrove.config.DTROVE_PROFILE_RATE', 1):
+            generate_key.apply()
+        call_command('profile_report', clear=True, stdout=StringIO())
+        self.assertEqual([], self.profiles())
+
+    def test_report_empty(self):
+        self.assertRaises(CommandError, call_command, 'profile_report',
+                          stdout=StringIO())
@@ -1,5 +1,8 @@
 
 from collections import namedtuple
+from datetime import datetime, timedelta
+
+from novaclient.exceptions import NotFound
 
 from .base import *
 
@@ -23,6 +26,9 @@ class BaseProviderTests(DtroveTest):
     def test_base_destroy(self):
         self.assertRaises(NotImplementedError, self.provider.destroy, '')
 
+    def test_base_delete_key(self):
+        self.assertRaises(NotImplementedError, self.provider.delete_key, '')
+
     def test_base_snapshot(self):
         self.assertRaises(NotImplementedError, self.provider.snapshot, '')
 
@@ -32,18 +38,53 @@ class BaseProviderTests(DtroveTest):
     def test_base_flavors(self):
         self.assertRaises(NotImplementedError, self.provider.flavors, '')
 
+    def test_base_update_bulk(self):
+        instances = [create_instance(), create_instance()]
+        instances[0].pk, instances[1].pk = 1, 2
+        with patch.object(self.provider, 'update_status') as update:
+            update.return_value = ('active', 100)
+            found = self.provider.update_status_bulk(instances)
+        self.assertEqual({1: ('active', 100), 2: ('active', 100)}, found)
+        update.assert_has_calls([call(instances[0]), call(instances[1])])
+
     def test_get_provider(self):
         from dtrove.providers.openstack import Provider
         from dtrove.providers import get_provider
         p = get_provider()
         self.assertTrue(isinstance(p, Provider))
+        self.assertTrue(p is get_provider())
+
+    def test_reset_provider(self):
+        from dtrove.providers import get_provider, reset_provider
+        p = get_provider()
+        reset_provider()
+        self.assertFalse(p is get_provider())
+
+    def test_lazy_provider(self):
+        from dtrove.providers import LazyProvider
+        lazy = LazyProvider()
+        with patch('dtrove.providers.base.get_provider') as get_provider:
+            self.assertFalse(get_provider.called)
+            lazy.create('instance')
+            get_provider.return_value.create.assert_called_with('instance')
+
+    def test_import_budget(self):
+        from dtrove.benchmarks import import_time
+        found = import_time.run()
+        # Importing dtrove.models doesn't pull in the slow client libraries
+        self.assertEqual([], found['cloud_clients'])
+        self.assertEqual([], found['ssh_clients'])
 
 
 class OpenStackProviderTests(DtroveTest):
 
     def setUp(self):
-        from dtrove.providers.openstack import Provider
+        from dtrove.providers.openstack import Provider, clear_clients, CACHE
         self.provider = Provider()
+        clear_clients()
+        self.addCleanup(clear_clients)
+        CACHE.clear()
+        self.addCleanup(CACHE.clear)
         # Mocks
         mock_nova = patch('dtrove.providers.openstack.nova_client')
         mock_cinder = patch('dtrove.providers.openstack.cinder_client')
@@ -63,6 +104,9 @@ class OpenStackProviderTests(DtroveTest):
         # shortcut to mock clients
         self.nova = self.MockNova.Client()
         self.keystone = self.MockKeystone.Client()
+        self.keystone.auth_ref.auth_token = 'token'
+        self.keystone.auth_ref.expires = datetime.utcnow() + timedelta(1)
+        self.keystone.auth_ref.service_catalog.get_endpoints.return_value = {}
 
     def test_nova_client(self):
         self.assertEqual(self.nova, self.provider.nova)
@@ -74,27 +118,150 @@ class OpenStackProviderTests(DtroveTest):
             auth_token=self.keystone.auth_ref.auth_token,
             auth_url=settings.OS_AUTH_URL,
             api_key=settings.OS_PASSWORD,
+            connection_pool=True,
         )
 
+    def test_nova_client_cached(self):
+        self.MockNova.Client.reset_mock()
+        self.MockKeystone.Client.reset_mock()
+        self.provider.nova
+        self.provider.nova
+        self.assertEqual(1, self.MockNova.Client.call_count)
+        self.assertEqual(1, self.MockKeystone.Client.call_count)
+
+    def test_nova_client_shared(self):
+        from dtrove.providers.openstack import Provider
+        self.MockNova.Client.reset_mock()
+        self.MockKeystone.Client.reset_mock()
+        self.provider.nova
+        other = Provider()
+        self.assertEqual(self.provider.nova, other.nova)
+        self.assertEqual(1, self.MockNova.Client.call_count)
+        self.assertEqual(1, self.MockKeystone.Client.call_count)
+
+    def test_nova_client_token_expiring(self):
+        self.keystone.auth_ref.expires = datetime.utcnow()
+        self.provider.nova
+        self.keystone.auth_ref.expires = datetime.utcnow() + timedelta(1)
+        self.keystone.auth_ref.auth_token = 'new_token'
+        self.MockNova.Client.reset_mock()
+        self.provider.nova
+        self.assertEqual('new_token', self.provider.auth_token)
+        self.assertEqual(1, self.MockNova.Client.call_count)
+
+    def test_token_shared_between_workers(self):
+        from dtrove.providers.openstack import Provider, token_stats
+        self.MockKeystone.Client.reset_mock()
+        self.provider._auth()
+        # A fresh provider is the same as a new worker process
+        other = Provider()
+        other._auth()
+        self.assertEqual(self.provider.auth_token, other.auth_token)
+        self.assertEqual(self.provider.endpoints, other.endpoints)
+        self.assertEqual(1, self.MockKeystone.Client.call_count)
+        stats = token_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['auths'])
+
+    def test_token_expires_with_keystone(self):
+        from dtrove.providers.openstack import CACHE
+        self.keystone.auth_ref.expires = datetime.utcnow()
+        self.provider._auth()
+        self.assertEqual(None, CACHE.get(self.provider.token_key))
+
+    def test_token_waits_for_lock(self):
+        from dtrove.providers.openstack import Provider, CACHE, token_stats
+        lock_key = '%s:lock' % self.provider.token_key
+        CACHE.add(lock_key, 1)
+        token = {
+            'auth_token': 'from_other_worker',
+            'expires': datetime.utcnow() + timedelta(1),
+            'endpoints': {},
+        }
+
+        def other_worker(seconds):
+            CACHE.set(self.provider.token_key, token)
+
+        self.MockKeystone.Client.reset_mock()
+        with patch('dtrove.providers.openstack.time.sleep', other_worker):
+            self.provider._auth()
+        self.assertEqual('from_other_worker', self.provider.auth_token)
+        self.assertEqual(0, self.MockKeystone.Client.call_count)
+        self.assertEqual(1, token_stats()['waits'])
+
+    def test_invalidate_drops_shared_token(self):
+        from dtrove.providers.openstack import CACHE
+        self.provider._auth()
+        self.provider.invalidate()
+        self.assertEqual(None, CACHE.get(self.provider.token_key))
+        self.assertEqual(None, self.provider.auth_token)
+
+    def test_reauth_on_unauthorized(self):
+        from novaclient.exceptions import Unauthorized
+        self.instance.server = 'uuid'
+        server = OSServer('127.0.0.1', 'uuid', 'building', 10, {})
+        self.nova.servers.get.side_effect = [Unauthorized(401), server]
+        self.MockKeystone.Client.reset_mock()
+        status, progress = self.provider.update_status(self.instance)
+        self.assertEqual(('building', 10), (status, progress))
+        self.assertEqual(2, self.MockKeystone.Client.call_count)
+
+    def test_reauth_only_once(self):
+        from novaclient.exceptions import Unauthorized
+        self.instance.server = 'uuid'
+        self.nova.servers.get.side_effect = Unauthorized(401)
+        self.assertRaises(Unauthorized,
+                          self.provider.update_status, self.instance)
+        self.assertEqual(2, self.nova.servers.get.call_count)
+
     def test_create(self):
-        servers = [
-            OSServer('127.0.0.1', 'uuid', 'building', 10, {}),
-            OSServer('127.0.0.1', 'uuid', 'building', 50, {}),
-            OSServer('127.0.0.1', 'uuid', 'active', 90, {}),
-        ]
+        server = OSServer(None, 'uuid', 'BUILD', 0, {})
+        self.nova.servers.create.return_value = server
+        self.provider.create(self.instance)
+        self.assertEqual('uuid', self.instance.server)
+        self.assertEqual('build', self.instance.server_status)
+        self.assertEqual(0, self.instance.progress)
+        # Waiting for the server is left to the tasks
+        self.assertFalse(self.nova.servers.get.called)
+
+    def test_create_removed_while_booting(self):
+        from dtrove.models import Instance
+        server = OSServer(None, 'uuid', 'BUILD', 0, {})
+        cluster = self.instance.cluster
+
+        def boot(**kwargs):
+            # The cluster shrinks while create_server waits for nova
+            with patch('dtrove.models.Cluster.scale_down'):
+                self.assertEqual(([], [self.instance.pk]), cluster.resize(0))
+            return server
+        self.nova.servers.create.side_effect = boot
+        self.nova.servers.get.side_effect = NotFound(404)
+        self.provider.create(self.instance)
+        self.nova.servers.delete.assert_called_once_with('uuid')
+        instance = Instance.objects.get(pk=self.instance.pk)
+        self.assertEqual('', instance.server)
+        self.assertTrue(instance.removing)
 
-        def side_effect(*args, **kwargs):
-            return servers.pop(0)
+    def test_create_deleted_while_booting(self):
+        from dtrove.models import Instance
+        server = OSServer(None, 'uuid', 'BUILD', 0, {})
 
-        self.nova.servers.get.side_effect = side_effect
+        def boot(**kwargs):
+            Instance.objects.filter(pk=self.instance.pk).delete()
+            return server
+        self.nova.servers.create.side_effect = boot
+        self.nova.servers.get.side_effect = NotFound(404)
         self.provider.create(self.instance)
-        self.assertEqual('active', self.instance.server_status)
-        self.assertEqual(100, self.instance.progress)
+        self.nova.servers.delete.assert_called_once_with('uuid')
+        # The row is not inserted again
+        self.assertFalse(Instance.objects.filter(pk=self.instance.pk).exists())
 
-    def test_create_error(self):
+    def test_update_status_error(self):
+        self.instance.server = 'uuid'
         server = OSServer('127.0.0.1', 'id', 'error', 10, {'message': 'fail'})
         self.nova.servers.get.return_value = server
-        self.assertRaises(Exception, self.provider.create, self.instance)
+        self.provider.update_status(self.instance)
         self.assertEqual('error', self.instance.server_status)
         self.assertEqual(10, self.instance.progress)
         self.assertEqual('fail', self.instance.message)
@@ -105,6 +272,80 @@ class OpenStackProviderTests(DtroveTest):
         self.assertEqual('NA', self.instance.server_status)
         self.assertEqual(0, self.instance.progress)
 
+    def test_update_status_bulk(self):
+        from dtrove.models import Instance
+        building = create_instance(server='s1', addr=None, save=True,
+                                   cluster=self.instance.cluster)
+        broken = create_instance(server='s2', save=True,
+                                 cluster=self.instance.cluster)
+        self.nova.servers.list.return_value = [
+            OSServer('10.0.0.1', 's1', 'BUILD', 40, {}),
+            OSServer('10.0.0.2', 's2', 'ERROR', 10, {'message': 'fail'}),
+            OSServer('10.0.0.3', 'not_ours', 'ACTIVE', 100, {}),
+        ]
+        found = self.provider.update_status_bulk(
+            [building, broken, self.instance])
+        self.assertEqual({
+            building.pk: ('build', 40),
+            broken.pk: ('error', 10),
+            self.instance.pk: ('NA', 0),
+        }, found)
+        self.nova.servers.list.assert_called_once_with(
+            detailed=True, search_opts={'name': '^dtrove\\-'}, marker=None,
+            limit=1000)
+        self.assertEqual(0, self.nova.servers.get.call_count)
+        self.assertEqual('build', building.server_status)
+        self.assertEqual(40, building.progress)
+        self.assertEqual('fail', broken.message)
+        self.assertEqual('10.0.0.1', Instance.objects.get(pk=building.pk).addr)
+
+    def test_update_status_bulk_missing(self):
+        missing = create_instance(server='gone', save=True,
+                                  cluster=self.instance.cluster)
+        self.nova.servers.list.return_value = []
+        self.nova.servers.get.side_effect = NotFound(404)
+        self.assertEqual({missing.pk: ('error', 0)},
+                         self.provider.update_status_bulk([missing]))
+        # Done, so poll_status leaves it alone from now on
+        self.assertEqual('error', missing.server_status)
+        self.assertEqual('Server not found', missing.message)
+
+    def test_update_status_bulk_pages(self):
+        first = create_instance(server='s1', save=True,
+                                cluster=self.instance.cluster)
+        second = create_instance(server='s3', save=True,
+                                 cluster=self.instance.cluster)
+        # Nova returns fewer servers than asked for per page
+        self.nova.servers.list.side_effect = [
+            [OSServer('10.0.0.1', 's1', 'BUILD', 40, {}),
+             OSServer('10.0.0.2', 's2', 'BUILD', 40, {})],
+            [OSServer('10.0.0.3', 's3', 'ACTIVE', 100, {})],
+        ]
+        found = self.provider.update_status_bulk([first, second])
+        self.assertEqual({first.pk: ('build', 40),
+                          second.pk: ('active', 100)}, found)
+        # Stops once every server was seen
+        self.assertEqual(2, self.nova.servers.list.call_count)
+        self.assertEqual('s2',
+                         self.nova.servers.list.call_args[1]['marker'])
+
+    def test_update_status_bulk_unprefixed(self):
+        old = create_instance(server='old', save=True,
+                              cluster=self.instance.cluster)
+        self.nova.servers.list.return_value = []
+        self.nova.servers.get.return_value = OSServer(
+            '10.0.0.1', 'old', 'ACTIVE', 100, {})
+        found = self.provider.update_status_bulk([old])
+        self.assertEqual({old.pk: ('active', 100)}, found)
+        self.nova.servers.get.assert_called_once_with('old')
+
+    def test_boot_tagged(self):
+        self.provider._boot(self.instance, 'image', '3')
+        self.nova.servers.create.assert_called_once_with(
+            name='dtrove-test_instance', image='image', flavor='3',
+            meta={'dtrove_cluster': str(self.instance.cluster_id)},
+            key_name=self.instance.key.name)
+
     def test_url(self):
         SC = {
             'foo': [
@@ -122,3 +363,46 @@ class OpenStackProviderTests(DtroveTest):
             name=self.instance.key.name,
             public_key=self.instance.key.public
         )
+
+    def test_delete_key(self):
+        self.provider.delete_key(self.instance.key)
+        self.nova.keypairs.delete.assert_called_once_with(
+            self.instance.key.name)
+
+    def test_delete_key_missing(self):
+        from novaclient.exceptions import NotFound
+        self.nova.keypairs.delete.side_effect = NotFound(404)
+        self.provider.delete_key(self.instance.key)
+
+    def test_destroy(self):
+        from novaclient.exceptions import NotFound
+        self.instance.server = 'uuid'
+        self.nova.servers.get.side_effect = [
+            OSServer(None, 'uuid', 'ACTIVE', 100, {}), NotFound(404)]
+        with patch('dtrove.providers.openstack.time.sleep') as sleep:
+            self.provider.destroy(self.instance)
+        self.nova.servers.delete.assert_called_once_with('uuid')
+        self.assertEqual(2, self.nova.servers.get.call_count)
+        self.assertEqual(1, sleep.call_count)
+
+    def test_destroy_gone(self):
+        from novaclient.exceptions import NotFound
+        self.instance.server = 'uuid'
+        self.nova.servers.delete.side_effect = NotFound(404)
+        self.provider.destroy(self.instance)
+        self.assertFalse(self.nova.servers.get.called)
+
+    def test_destroy_no_server(self):
+        self.provider.destroy(self.instance)
+        self.assertFalse(self.nova.servers.delete.called)
+
+    def test_destroy_timeout(self):
+        from dtrove.providers.base import ProviderError
+        self.instance.server = 'uuid'
+        self.nova.servers.get.return_value = OSServer(
+            None, 'uuid', 'ERROR', 0, {})
+        with patch('dtrove.providers.openstack.time') as fake_time:
+            fake_time.time.side_effect = [0, 0, 601]
+            self.assertRaises(ProviderError,
+                              self.provider.destroy, self.instance)
+        self.assertEqual(2, self.nova.servers.get.call_count)
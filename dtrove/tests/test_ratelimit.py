@@ -0,0 +1,136 @@
+
+from novaclient import exceptions as nova_exceptions
+
+from dtrove import ratelimit
+from dtrove.providers.openstack import Provider
+from .base import *
+
+
+class Clock(object):
+    """Fake time that moves forward when something sleeps"""
+
+    def __init__(self, now=120.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimitTest(DtroveTest):
+
+    def setUp(self):
+        ratelimit.CACHE.clear()
+        self.addCleanup(ratelimit.CACHE.clear)
+        self.clock = Clock()
+        for name in ('time', 'sleep'):
+            patcher = patch('dtrove.ratelimit.time.%s' % name,
+                            getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class LimiterTests(RateLimitTest):
+
+    def setUp(self):
+        super(LimiterTests, self).setUp()
+        patcher = patch('dtrove.config.DTROVE_RATE_LIMITS',
+                        {'create': (3, 60)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = ratelimit.Limiter('create')
+
+    def test_budget(self):
+        for x in range(3):
+            self.limiter.acquire()
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_waits_for_next_window(self):
+        for x in range(4):
+            self.limiter.acquire()
+        self.assertEqual(1, len(self.clock.sleeps))
+        self.assertTrue(60 <= self.clock.sleeps[0] <= 60.1)
+
+    def test_max_wait(self):
+        with patch('dtrove.config.DTROVE_RATE_LIMIT_MAX_WAIT', 10):
+            for x in range(3):
+                self.limiter.acquire()
+            self.assertRaises(ratelimit.RateLimited, self.limiter.acquire)
+
+    def test_unlimited(self):
+        limiter = ratelimit.Limiter('read')
+        for x in range(100):
+            limiter.acquire()
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_backoff(self):
+        self.limiter.backoff(30)
+        self.assertEqual(0.5, self.limiter.scale)
+        self.assertEqual(1, self.limiter.budget())
+
+    def test_blocked(self):
+        # Another worker got a 413 asking to wait 30 seconds
+        ratelimit.Limiter('create').backoff(30)
+        with patch('dtrove.config.DTROVE_RATE_LIMIT_MAX_WAIT', 5):
+            self.assertRaises(ratelimit.RateLimited, self.limiter.acquire)
+        self.limiter.acquire()
+        self.assertEqual([30], self.clock.sleeps)
+
+    def test_backoff_floor(self):
+        for x in range(10):
+            self.limiter.backoff(1)
+        self.assertEqual(ratelimit.MIN_SCALE, self.limiter.scale)
+
+    def test_recovery(self):
+        self.limiter.backoff(1)
+        self.clock.now += 60
+        self.limiter.acquire()
+        self.assertEqual(0.6, self.limiter.scale)
+
+    def test_limiter(self):
+        self.assertIs(ratelimit.limiter('read'), ratelimit.limiter('read'))
+
+
+class ThrottledTests(RateLimitTest):
+
+    def setUp(self):
+        super(ThrottledTests, self).setUp()
+        patcher = patch('dtrove.providers.openstack.Provider.nova')
+        self.nova = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.provider = Provider()
+
+    def test_retry_after(self):
+        self.nova.servers.list.side_effect = [
+            nova_exceptions.OverLimit(413, retry_after='7'), []]
+        self.assertEqual([], self.provider._list())
+        self.assertEqual(2, self.nova.servers.list.call_count)
+        self.assertEqual([7], self.clock.sleeps)
+        self.assertEqual(0.5, ratelimit.limiter('read').scale)
+
+    def test_gives_up(self):
+        self.nova.servers.list.side_effect = nova_exceptions.RateLimit(
+            429, retry_after='1')
+        with patch('dtrove.config.DTROVE_RATE_LIMIT_RETRIES', 2):
+            self.assertRaises(ratelimit.RateLimited, self.provider._list)
+        self.assertEqual(3, self.nova.servers.list.call_count)
+
+    def test_rate_limit_not_over_limit(self):
+        # Newer novaclients don't derive RateLimit from OverLimit
+        class RateLimit(Exception):
+            retry_after = 2
+        with patch('dtrove.providers.openstack._OVER_LIMIT',
+                   (nova_exceptions.OverLimit, RateLimit)):
+            self.nova.servers.list.side_effect = [RateLimit(), []]
+            self.assertEqual([], self.provider._list())
+        self.assertEqual([2], self.clock.sleeps)
+
+    def test_create_key_limited(self):
+        self.nova.keypairs.get.side_effect = ratelimit.RateLimited()
+        self.assertRaises(ratelimit.RateLimited, self.provider.create_key,
+                          create_key())
+        self.assertFalse(self.nova.keypairs.create.called)
@@ -0,0 +1,151 @@
+
+import json
+
+from dtrove.simulator import SIMULATOR, Simulator
+from .base import *
+
+
+class SimulatorTests(DtroveTest):
+
+    def setUp(self):
+        self.sim = Simulator(seed=1)
+
+    def create(self):
+        response = self.sim.handle('POST', 'servers',
+                                   {'server': {'name': 'test'}})
+        self.assertEqual(202, response.status)
+        return response.body['server']['id']
+
+    def get(self, server_id):
+        response = self.sim.handle('GET', 'servers/%s' % server_id)
+        return response.body['server']
+
+    def test_build_steps(self):
+        server_id = self.create()
+        progress = [self.get(server_id)['progress'] for x in range(10)]
+        self.assertEqual(range(10, 101, 10), progress)
+        server = self.get(server_id)
+        self.assertEqual('ACTIVE', server['status'])
+        self.assertEqual('10.0.0.1', server['accessIPv4'])
+
+    def test_build_time(self):
+        self.sim.configure(build_time=(10, 10))
+        with patch('dtrove.simulator.time.time', return_value=1000):
+            server_id = self.create()
+        with patch('dtrove.simulator.time.time', return_value=1005):
+            self.assertEqual(50, self.get(server_id)['progress'])
+        with patch('dtrove.simulator.time.time', return_value=1010):
+            self.assertEqual('ACTIVE', self.get(server_id)['status'])
+
+    def test_unique_addresses(self):
+        self.sim.configure(build_time=(0, 0))
+        first, second = self.create(), self.create()
+        self.assertNotEqual(self.get(first)['accessIPv4'],
+                            self.get(second)['accessIPv4'])
+
+    def test_list_and_delete(self):
+        first, second = self.create(), self.create()
+        found = self.sim.handle('GET', 'servers/detail').body['servers']
+        self.assertEqual([first, second], [s['id'] for s in found])
+        path = 'servers/%s' % first
+        self.assertEqual(204, self.sim.handle('DELETE', path).status)
+        self.assertEqual(404, self.sim.handle('GET', path).status)
+        found = self.sim.handle('GET', 'servers/detail').body['servers']
+        self.assertEqual([second], [s['id'] for s in found])
+
+    def test_list_query(self):
+        ids = [self.create() for x in range(3)]
+        self.sim.handle('POST', 'servers', {'server': {'name': 'other'}})
+        query = {'name': '^test', 'limit': '2'}
+        found = self.sim.handle('GET', 'servers/detail', query=query)
+        page = [s['id'] for s in found.body['servers']]
+        self.assertEqual(ids[:2], page)
+        query['marker'] = page[-1]
+        found = self.sim.handle('GET', 'servers/detail', query=query)
+        self.assertEqual(ids[2:], [s['id'] for s in found.body['servers']])
+
+    def test_max_limit(self):
+        self.sim.configure(max_limit=1)
+        self.create(), self.create()
+        found = self.sim.handle('GET', 'servers/detail',
+                                query={'limit': '10'})
+        self.assertEqual(1, len(found.body['servers']))
+
+    def test_tenant_in_path(self):
+        self.assertEqual(200, self.sim.handle('GET', '1234/flavors').status)
+
+    def test_flavors(self):
+        flavors = self.sim.handle('GET', 'flavors/detail').body['flavors']
+        self.assertEqual(4, len(flavors))
+        self.assertEqual('3', self.sim.handle(
+            'GET', 'flavors/3').body['flavor']['id'])
+        self.assertEqual(404, self.sim.handle('GET', 'flavors/9').status)
+
+    def test_volumes_and_snapshots(self):
+        self.sim.configure(build_time=(0, 0))
+        volume = self.sim.handle('POST', 'os-volumes',
+                                 {'volume': {'size': 10}}).body['volume']
+        self.assertEqual('creating', volume['status'])
+        found = self.sim.handle('GET', 'os-volumes/%s' % volume['id'])
+        self.assertEqual('available', found.body['volume']['status'])
+        snapshot = self.sim.handle(
+            'POST', 'os-snapshots',
+            {'snapshot': {'volume_id': volume['id']}}).body['snapshot']
+        self.assertEqual(volume['id'], snapshot['volumeId'])
+        listed = self.sim.handle('GET', 'os-snapshots/detail')
+        self.assertEqual(1, len(listed.body['snapshots']))
+
+    def test_fail_rate(self):
+        self.sim.configure(fail_rate=1, build_time=(0, 0))
+        server = self.get(self.create())
+        self.assertEqual('ERROR', server['status'])
+        self.assertTrue(server['fault']['message'])
+
+    def test_error_rate(self):
+        self.sim.configure(error_rate=1)
+        self.assertEqual(500, self.sim.handle('GET', 'servers').status)
+        self.assertEqual(1, self.sim.stats[500])
+
+    def test_rate_limit(self):
+        self.sim.configure(rate_limit=2, rate_limit_window=60)
+        with patch('dtrove.simulator.time.time', return_value=1000):
+            statuses = [self.sim.handle('GET', 'servers').status
+                        for x in range(3)]
+            response = self.sim.handle('GET', 'servers')
+        self.assertEqual([200, 200, 413], statuses)
+        self.assertEqual('60', response.headers['Retry-After'])
+        with patch('dtrove.simulator.time.time', return_value=1060):
+            self.assertEqual(200, self.sim.handle('GET', 'servers').status)
+
+    def test_latency(self):
+        self.sim.configure(latency=0.5, latency_distribution='exponential')
+        with patch('dtrove.simulator.time.sleep') as sleep:
+            self.sim.handle('GET', 'servers')
+            self.assertTrue(sleep.called)
+
+    def test_unknown_option(self):
+        self.assertRaises(ValueError, self.sim.configure, speed=1)
+
+
+class FakeNovaViewTests(DtroveTest):
+
+    def setUp(self):
+        SIMULATOR.reset()
+        self.addCleanup(SIMULATOR.reset)
+
+    def test_over_limit(self):
+        SIMULATOR.configure(rate_limit=1)
+        self.client.get('/osnova/servers')
+        response = self.client.get('/osnova/servers')
+        self.assertEqual(413, response.status_code)
+        self.assertTrue(response['Retry-After'])
+        body = json.loads(response.content)
+        self.assertEqual(413, body['overLimit']['code'])
+
+    def test_create(self):
+        response = self.client.post('/osnova/servers',
+                                    json.dumps({'server': {'name': 'x'}}),
+                                    content_type='application/json')
+        self.assertEqual(202, response.status_code)
+        server = json.loads(response.content)['server']
+        self.assertEqual('x', server['name'])
@@ -0,0 +1,127 @@
+import time
+
+from .base import *
+from dtrove.ssh import ConnectionPool, healthy, execute, private_key
+
+
+class ConnectionPoolTests(DtroveTest):
+
+    def setUp(self):
+        patcher = patch('dtrove.ssh.connections', {})
+        self.connections = patcher.start()
+        self.addCleanup(patcher.stop)
+        connect = patch('dtrove.ssh.connect')
+        self.connect = connect.start()
+        self.connect.side_effect = lambda instance: MagicMock()
+        self.addCleanup(connect.stop)
+        self.pool = ConnectionPool(max_connections=2, idle_timeout=60)
+        self.addCleanup(self.pool.close_all)
+        self.instance = create_instance()
+
+    def borrow(self, instance):
+        with self.pool.connection(instance) as client:
+            return client
+
+    def test_reuse(self):
+        first = self.borrow(self.instance)
+        second = self.borrow(self.instance)
+        self.assertTrue(first is second)
+        self.assertEqual(1, len(self.pool))
+        self.assertFalse(first.close.called)
+
+    def test_fabric_settings(self):
+        from fabric.api import env
+        with self.pool.connection(self.instance) as client:
+            self.assertEqual('root@127.0.0.1', env.host_string)
+            self.assertEqual('sec', env.key)
+            self.assertTrue(client is self.connections[env.host_string])
+
+    def test_new_key(self):
+        first = self.borrow(self.instance)
+        other = create_instance(key=create_key(public='other'))
+        second = self.borrow(other)
+        self.assertFalse(first is second)
+
+    def test_unhealthy(self):
+        first = self.borrow(self.instance)
+        first.get_transport.return_value.is_active.return_value = False
+        second = self.borrow(self.instance)
+        self.assertFalse(first is second)
+        self.assertTrue(first.close.called)
+
+    def test_idle_timeout(self):
+        first = self.borrow(self.instance)
+        with patch('dtrove.ssh.time.time', return_value=time.time() + 61):
+            second = self.borrow(self.instance)
+        self.assertFalse(first is second)
+        self.assertTrue(first.close.called)
+
+    def test_max_connections(self):
+        clients = [self.borrow(create_instance(addr='10.0.0.%s' % x))
+                   for x in range(3)]
+        self.assertEqual(2, len(self.pool))
+        # The least recently used connection is closed first
+        self.assertTrue(clients[0].close.called)
+        self.assertFalse(clients[2].close.called)
+
+    def test_client(self):
+        from fabric.api import env
+        with self.pool.client(self.instance) as client:
+            self.assertEqual(None, env.host_string)
+        self.connect.assert_called_once_with(self.instance)
+        self.assertTrue(client is self.borrow(self.instance))
+
+    def test_borrow_twice(self):
+        with self.pool.client(self.instance) as first:
+            with self.pool.client(self.instance) as second:
+                self.assertFalse(first is second)
+        # Only one connection per key is kept
+        self.assertEqual(1, len(self.pool))
+        self.assertTrue(second.close.called)
+
+    def test_discard(self):
+        client = self.borrow(self.instance)
+        self.pool.discard(self.instance)
+        self.assertEqual(0, len(self.pool))
+        self.assertTrue(client.close.called)
+        # Nothing to close the second time
+        self.pool.discard(self.instance)
+
+    def test_close_all(self):
+        client = self.borrow(self.instance)
+        self.pool.close_all()
+        self.assertEqual(0, len(self.pool))
+        self.assertTrue(client.close.called)
+
+    def test_healthy(self):
+        client = MagicMock()
+        self.assertTrue(healthy(client))
+        client.get_transport.return_value.send_ignore.side_effect = EOFError
+        self.assertFalse(healthy(client))
+        client.get_transport.return_value = None
+        self.assertFalse(healthy(client))
+
+
+class SSHHelperTests(DtroveTest):
+
+    def test_execute(self):
+        client = MagicMock()
+        stdin, stdout, stderr = MagicMock(), MagicMock(), MagicMock()
+        client.exec_command.return_value = (stdin, stdout, stderr)
+        stdout.read.return_value = 'out'
+        stderr.read.return_value = 'err'
+        stdout.channel.recv_exit_status.return_value = 2
+        self.assertEqual(('out', 'err', 2), execute(client, 'ls'))
+        client.exec_command.assert_called_with('ls', timeout=None)
+
+    def test_private_key_rsa(self):
+        from dtrove.models import Key
+        public, private = Key.generate('rsa')
+        key = create_key(public=public, private=private, passphrase='')
+        self.assertEqual('ssh-rsa', private_key(key).get_name())
+
+    def test_private_key_ed25519(self):
+        from dtrove.models import Key
+        public, private = Key.generate('ed25519')
+        key = create_key(public=public, private=private, passphrase='')
+        self.assertEqual('ssh-ed25519', private_key(key).get_name())
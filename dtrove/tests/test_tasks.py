@@ -1,4 +1,6 @@
 
+import time
+
 from .base import *
 
 
@@ -8,11 +10,24 @@ class TaskTests(DtroveTest):
         patcher = patch('dtrove.models.Instance.provision')
         self.MockClass = patcher.start()
         self.addCleanup(patcher.stop)
+        cluster_patcher = patch('dtrove.models.Cluster.provision')
+        cluster_patcher.start()
+        self.addCleanup(cluster_patcher.stop)
         self.cluster = create_cluster(size=2, save=True)
         self.key = create_key(save=True)
         self.instance = create_instance(cluster=self.cluster,
                                         key=self.key,
                                         save=True)
+        # Don't open real ssh connections
+        from dtrove.ssh import POOL
+        ssh_patcher = patch('dtrove.ssh.connections', {})
+        self.connections = ssh_patcher.start()
+        self.addCleanup(ssh_patcher.stop)
+        connect_patcher = patch('dtrove.ssh.connect')
+        self.connect = connect_patcher.start()
+        self.connect.side_effect = lambda instance: MagicMock()
+        self.addCleanup(connect_patcher.stop)
+        self.addCleanup(POOL.close_all)
 
     def test_debug(self):
         from dtrove.celery import debug_task
@@ -28,10 +43,390 @@ class TaskTests(DtroveTest):
             output = preform(self.instance.pk, '', cmd)
             fake_run.assert_called_with('sec none root@127.0.0.1')
 
+    def test_prepare(self):
+        from dtrove.tasks import prepare
+        from dtrove.ssh import POOL
+        with patch('dtrove.datastores.mysql.MySQLManager.prepare') as mgr:
+            prepare(self.instance.pk)
+            mgr.assert_called_with(self.instance)
+        # The connection is kept for the next task
+        self.assertEqual(1, len(POOL))
+        client = self.connections['root@127.0.0.1']
+        self.assertFalse(client.close.called)
+
+    def preform_cluster(self, results, **kwargs):
+        from dtrove.tasks import preform_cluster
+        create_instance(name='extra', cluster=self.cluster, key=self.key,
+                        addr='10.0.0.2', save=True)
+        with patch('dtrove.tasks.execute') as execute:
+            execute.side_effect = lambda client, cmd: results[cmd]
+            output = preform_cluster(self.cluster.pk, 'test',
+                                     'uptime', 'false', **kwargs)
+        return output, execute
+
+    def test_preform_cluster(self):
+        results = {'uptime': ('up', '', 0), 'false': ('', 'no', 0)}
+        output, execute = self.preform_cluster(results)
+        self.assertTrue(output['ok'])
+        self.assertEqual('test', output['name'])
+        # The one from setUp and the extra one, the two nodes the cluster
+        # was created with have no address yet
+        self.assertEqual(2, len(output['hosts']))
+        host = output['hosts']['extra']
+        self.assertEqual('root@10.0.0.2', host['host'])
+        self.assertEqual('ok', host['status'])
+        self.assertEqual([
+            {'cmd': 'uptime', 'stdout': 'up', 'stderr': '', 'exit_code': 0},
+            {'cmd': 'false', 'stdout': '', 'stderr': 'no', 'exit_code': 0},
+        ], host['results'])
+
+    def test_preform_cluster_best_effort(self):
+        results = {'uptime': ('up', '', 0), 'false': ('', 'no', 1)}
+        output, execute = self.preform_cluster(results)
+        self.assertFalse(output['ok'])
+        statuses = [host['status'] for host in output['hosts'].values()]
+        self.assertEqual(['failed'] * 2, statuses)
+        self.assertEqual(4, execute.call_count)
+
+    def test_preform_cluster_fail_fast(self):
+        results = {'uptime': ('up', '', 1), 'false': ('', 'no', 0)}
+        output, execute = self.preform_cluster(results, fail_fast=True,
+                                               parallel=1)
+        self.assertFalse(output['ok'])
+        statuses = sorted(host['status'] for host in output['hosts'].values())
+        self.assertEqual(['failed', 'skipped'], statuses)
+        self.assertEqual(1, execute.call_count)
+
+    def test_preform_cluster_skips_removing(self):
+        from dtrove.models import Instance
+        Instance.objects.filter(pk=self.instance.pk).update(removing=True)
+        results = {'uptime': ('up', '', 0), 'false': ('', 'no', 0)}
+        output, execute = self.preform_cluster(results)
+        self.assertEqual(['extra'], list(output['hosts']))
+
+    def test_preform_cluster_format(self):
+        from dtrove.tasks import preform_cluster
+        with patch('dtrove.tasks.execute') as execute:
+            execute.return_value = ('', '', 0)
+            output = preform_cluster(self.cluster.pk, 'test',
+                                     'echo %(user)s %(host)s')
+        host = output['hosts'][self.instance.name]
+        self.assertEqual('echo root 127.0.0.1', host['results'][0]['cmd'])
+        # The key material is not available to the commands
+        output = preform_cluster(self.cluster.pk, 'test', 'echo %(key)s')
+        host = output['hosts'][self.instance.name]
+        self.assertEqual('failed', host['status'])
+        self.assertNotIn('sec', str(output))
+
+    def test_preform_cluster_connect_error(self):
+        self.connect.side_effect = EOFError('gone')
+        results = {'uptime': ('up', '', 0), 'false': ('', 'no', 0)}
+        output, execute = self.preform_cluster(results)
+        self.assertFalse(output['ok'])
+        host = output['hosts']['extra']
+        self.assertEqual('failed', host['status'])
+        self.assertEqual('gone', host['results'][0]['stderr'])
+
     def test_create(self):
-        from dtrove.tasks import create
+        from dtrove.tasks import create, create_server, wait_for_server
+        from dtrove.tasks import prepare
+        with patch('dtrove.tasks.chain') as chain:
+            create(self.instance.pk)
+            chain.assert_called_with(create_server.si(self.instance.pk),
+                                     wait_for_server.si(self.instance.pk),
+                                     prepare.si(self.instance.pk))
+            self.assertTrue(chain.return_value.called)
+
+    def test_create_cluster(self):
+        from dtrove.tasks import create_cluster, create_server
+        from dtrove.tasks import wait_for_server, prepare_cluster
+        with patch('dtrove.tasks.chord') as chord:
+            create_cluster(self.cluster.pk, [1, 2])
+            builds = list(chord.call_args[0][0].tasks)
+            chord.return_value.assert_called_with(
+                prepare_cluster.si(self.cluster.pk, [1, 2]))
+        self.assertEqual(2, len(builds))
+        self.assertEqual([create_server.si(1), wait_for_server.si(1)],
+                         list(builds[0].tasks))
+
+    def test_prepare_cluster(self):
+        from dtrove.tasks import prepare_cluster, prepare, cluster_ready
+        with patch('dtrove.tasks.chord') as chord:
+            prepare_cluster(self.cluster.pk, [1, 2])
+            self.assertEqual([prepare.si(1), prepare.si(2)],
+                             list(chord.call_args[0][0]))
+            chord.return_value.assert_called_with(
+                cluster_ready.si(self.cluster.pk))
+
+    def test_cluster_ready(self):
+        from dtrove.tasks import cluster_ready
+        self.assertEqual(self.cluster.pk, cluster_ready(self.cluster.pk))
+
+    def test_create_server(self):
+        from dtrove.tasks import create_server
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            create_server(self.instance.pk)
+            prov.create.assert_called_with(self.instance)
+
+    def test_wait_for_server_active(self):
+        from dtrove.tasks import wait_for_server
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status.return_value = ('active', 90)
+            self.assertEqual(self.instance.pk,
+                             wait_for_server(self.instance.pk))
+        self.assertEqual(100, self.instance.progress)
+
+    def test_wait_for_server_building(self):
+        from celery.exceptions import Retry
+        from dtrove.tasks import wait_for_server
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status.return_value = ('build', 10)
+            with patch('dtrove.tasks.time.time', return_value=1010):
+                with patch.object(wait_for_server, 'retry') as retry:
+                    retry.return_value = Retry()
+                    self.assertRaises(Retry, wait_for_server,
+                                      self.instance.pk, started=1000)
+                    retry.assert_called_with(args=[self.instance.pk, 1000],
+                                             countdown=ANY)
+
+    def test_wait_for_server_cached(self):
+        from dtrove.tasks import wait_for_server
+        instance = create_instance(cluster=self.cluster, key=self.key,
+                                   server='wait_cached', save=True)
+        instance.set_state(status='active', progress=100)
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            self.assertEqual(instance.pk, wait_for_server(instance.pk))
+        self.assertFalse(prov.update_status.called)
+
+    def test_wait_for_server_stale(self):
+        from dtrove import config
+        from dtrove.models import Instance
+        from dtrove.tasks import wait_for_server
+        instance = create_instance(cluster=self.cluster, key=self.key,
+                                   server='wait_stale', save=True)
+        observed = time.time() - config.DTROVE_STATE_MAX_AGE - 1
+        Instance.set_state_many({instance.server: {'status': 'build'}},
+                                observed)
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status.return_value = ('active', 100)
+            self.assertEqual(instance.pk, wait_for_server(instance.pk))
+        prov.update_status.assert_called_once_with(instance)
+
+    def test_wait_for_server_error(self):
+        from dtrove.providers.base import ProviderError
+        from dtrove.tasks import wait_for_server
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status.return_value = ('error', 0)
+            self.assertRaises(ProviderError, wait_for_server,
+                              self.instance.pk)
+
+    def test_wait_for_server_timeout(self):
+        from dtrove import config
+        from dtrove.providers.base import ProviderError
+        from dtrove.tasks import wait_for_server
+        instance = create_instance(cluster=self.cluster, key=self.key,
+                                   server='wait_timeout', save=True)
+        started = time.time() - config.DTROVE_BUILD_TIMEOUT - 1
         with patch('dtrove.tasks.PROVIDER') as prov:
-            with patch('dtrove.tasks.prepare') as prepare:
-                create(self.instance.pk)
-                prov.create.assert_called_with(self.instance)
-                prepare.assert_called_with(self.instance.id)
+            prov.update_status.return_value = ('build', 10)
+            self.assertRaises(ProviderError, wait_for_server,
+                              instance.pk, started)
+        self.assertEqual('error', instance.server_status)
+        self.assertTrue('Timed out' in instance.message)
+
+    def test_backoff(self):
+        from dtrove.tasks import backoff
+        from dtrove import config
+        for retries in range(10):
+            delay = min(config.DTROVE_BUILD_POLL_MAX_DELAY,
+                        config.DTROVE_BUILD_POLL_DELAY * 2 ** retries)
+            found = backoff(retries)
+            self.assertTrue(delay / 2.0 <= found <= delay)
+
+    def test_poll_status(self):
+        from dtrove.tasks import poll_status
+        done = create_instance(cluster=self.cluster, key=self.key,
+                               server='poll_done', save=True)
+        done.server_status = 'active'
+        building = create_instance(cluster=self.cluster, key=self.key,
+                                   server='poll_building', save=True)
+        building.server_status = 'build'
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status_bulk.return_value = {}
+            poll_status()
+            polled = prov.update_status_bulk.call_args[0][0]
+        polled = set(instance.pk for instance in polled)
+        self.assertTrue(building.pk in polled)
+        self.assertFalse(done.pk in polled)
+
+    def test_poll_status_nothing_pending(self):
+        from dtrove.tasks import poll_status
+        from dtrove.models import Instance
+        for instance in Instance.objects.all():
+            instance.server_status = 'active'
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            self.assertEqual({}, poll_status())
+            self.assertFalse(prov.update_status_bulk.called)
+
+    def test_refresh_status(self):
+        from dtrove.tasks import refresh_status
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.update_status_bulk.return_value = {self.instance.pk: 'ok'}
+            self.assertEqual({self.instance.pk: 'ok'},
+                             refresh_status([self.instance.pk]))
+            polled = prov.update_status_bulk.call_args[0][0]
+        self.assertEqual([self.instance.pk], [i.pk for i in polled])
+
+    def test_refresh_status_no_server(self):
+        from dtrove.tasks import refresh_status
+        instance = create_instance(cluster=self.cluster, key=self.key,
+                                   server='', save=True)
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            self.assertEqual({}, refresh_status([instance.pk]))
+            self.assertFalse(prov.update_status_bulk.called)
+
+    def scale_down(self, destroy=None):
+        from dtrove.tasks import scale_down
+        from dtrove.models import CACHE
+        CACHE.clear()
+        self.addCleanup(CACHE.clear)
+        extra = create_instance(name='extra', cluster=self.cluster,
+                                key=self.key, server='extra_server',
+                                addr='10.0.0.2', save=True)
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            prov.destroy.side_effect = destroy
+            with patch('dtrove.datastores.base.execute') as execute:
+                execute.return_value = ('', '', 0)
+                output = scale_down(self.cluster.pk,
+                                    [self.instance.pk, extra.pk])
+        return output, prov, execute, extra
+
+    def test_scale_down(self):
+        from dtrove.models import Instance, Key
+        output, prov, execute, extra = self.scale_down()
+        self.assertEqual(sorted([self.instance.pk, extra.pk]),
+                         sorted(output['removed']))
+        self.assertEqual([], output['failed'])
+        self.assertEqual(2, prov.destroy.call_count)
+        execute.assert_called_with(ANY, 'service mysql stop')
+        self.assertFalse(Instance.objects.filter(
+            pk__in=output['removed']).exists())
+        self.assertEqual('deleted', self.instance.server_status)
+        self.assertEqual(100, extra.progress)
+        # Nothing uses the key anymore
+        prov.delete_key.assert_called_once_with(self.key)
+        self.assertFalse(Key.objects.filter(pk=self.key.pk).exists())
+
+    def test_scale_down_shared_key(self):
+        from dtrove.models import Key
+        create_instance(name='kept', cluster=self.cluster, key=self.key,
+                        save=True)
+        output, prov, execute, extra = self.scale_down()
+        # The rest of the cluster still uses the key
+        self.assertFalse(prov.delete_key.called)
+        self.assertTrue(Key.objects.filter(pk=self.key.pk).exists())
+
+    def test_scale_down_key_reused(self):
+        from dtrove.models import Key
+        from dtrove.tasks import scale_down
+        # The unused keys were looked up before a new node took the key
+        unused = Key.objects.filter(pk=self.key.pk)
+        create_instance(name='new', cluster=self.cluster, key=self.key,
+                        save=True)
+        with patch('dtrove.tasks.Key.objects.filter', return_value=unused):
+            with patch('dtrove.tasks.PROVIDER') as prov:
+                with patch('dtrove.datastores.base.execute') as execute:
+                    execute.return_value = ('', '', 0)
+                    output = scale_down(self.cluster.pk, [self.instance.pk])
+        self.assertEqual([self.instance.pk], output['removed'])
+        self.assertFalse(prov.delete_key.called)
+        self.assertTrue(Key.objects.filter(pk=self.key.pk).exists())
+
+    def test_scale_down_error(self):
+        from dtrove.models import Instance
+        from dtrove.providers.base import ProviderError
+
+        def destroy(instance):
+            if instance.name == 'extra':
+                raise ProviderError('stuck')
+        output, prov, execute, extra = self.scale_down(destroy)
+        self.assertEqual([self.instance.pk], output['removed'])
+        self.assertEqual([extra.pk], output['failed'])
+        self.assertTrue(Instance.objects.filter(pk=extra.pk).exists())
+        self.assertEqual('error', extra.server_status)
+        self.assertEqual('stuck', extra.message)
+
+    def test_scale_down_drain_fails(self):
+        self.connect.side_effect = EOFError('gone')
+        output, prov, execute, extra = self.scale_down()
+        # A node that can't be drained is destroyed all the same
+        self.assertEqual(2, len(output['removed']))
+        self.assertEqual(2, prov.destroy.call_count)
+
+    def test_build_skips_removed(self):
+        from dtrove.models import Instance
+        from dtrove.tasks import create_server, wait_for_server, prepare
+        Instance.objects.filter(pk=self.instance.pk).update(removing=True)
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            create_server(self.instance.pk)
+            wait_for_server(self.instance.pk)
+            self.assertEqual({}, prepare(self.instance.pk))
+        self.assertFalse(prov.create.called)
+        self.assertFalse(prov.update_status.called)
+
+    def test_poll_status_skips_removing(self):
+        from dtrove.tasks import poll_status
+        draining = create_instance(cluster=self.cluster, key=self.key,
+                                   server='poll_draining', save=True)
+        draining.server_status = 'draining'
+        building = create_instance(cluster=self.cluster, key=self.key,
+                                   server='poll_building', save=True)
+        building.server_status = 'build'
+        with patch('dtrove.tasks.PROVIDER') as prov:
+            poll_status()
+            polled = prov.update_status_bulk.call_args[0][0]
+        polled = set(instance.pk for instance in polled)
+        self.assertTrue(building.pk in polled)
+        self.assertFalse(draining.pk in polled)
+
+    def test_fill_key_pool(self):
+        from dtrove import config
+        from dtrove.models import CACHE
+        from dtrove.tasks import fill_key_pool, generate_key
+        CACHE.clear()
+        self.addCleanup(CACHE.clear)
+        pooled = create_key(name='pooled', save=True)
+        pooled.pooled = True
+        pooled.save()
+        with patch('dtrove.tasks.group') as group:
+            missing = fill_key_pool()
+            tasks = list(group.call_args[0][0])
+        self.assertEqual(config.DTROVE_KEY_POOL_SIZE - 1, missing)
+        self.assertEqual([generate_key.si()] * missing, tasks)
+
+    def test_fill_key_pool_in_flight(self):
+        from dtrove import config
+        from dtrove.models import CACHE
+        from dtrove.tasks import fill_key_pool, generate_key
+        CACHE.clear()
+        self.addCleanup(CACHE.clear)
+        with patch('dtrove.tasks.group') as group:
+            self.assertEqual(config.DTROVE_KEY_POOL_SIZE, fill_key_pool())
+            # The queued tasks haven't run by the next tick
+            self.assertEqual(0, fill_key_pool())
+            self.assertEqual(1, group.call_count)
+        with patch('dtrove.models.Key.generate') as generate:
+            generate.return_value = ('pub', 'priv')
+            generate_key()
+        # The key that was made is in the pool now, not pending
+        with patch('dtrove.tasks.group') as group:
+            self.assertEqual(0, fill_key_pool())
+            self.assertFalse(group.called)
+
+    def test_generate_key(self):
+        from dtrove.models import Key
+        from dtrove.tasks import generate_key
+        with patch('dtrove.models.Key.generate') as generate:
+            generate.return_value = ('pub', 'priv')
+            pk = generate_key()
+        self.assertTrue(Key.objects.get(pk=pk).pooled)
@@ -0,0 +1,107 @@
+
+from dtrove import tracing
+from dtrove.models import Span
+from .base import *
+
+
+class TracingTests(DtroveTest):
+
+    def setUp(self):
+        for name in ('Instance', 'Cluster'):
+            patcher = patch('dtrove.models.%s.provision' % name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        tracing.clear()
+        self.addCleanup(tracing.clear)
+        self.cluster = create_cluster(save=True)
+        self.instance = create_instance(cluster=self.cluster, save=True)
+
+    def test_span(self):
+        with tracing.span('prepare', self.instance):
+            pass
+        self.assertEqual(0, Span.objects.count())
+        self.assertEqual(1, tracing.flush())
+        span = Span.objects.get()
+        self.assertEqual('prepare', span.stage)
+        self.assertEqual('ok', span.outcome)
+        self.assertEqual(self.cluster.pk, span.cluster_id)
+        self.assertEqual(self.instance.pk, span.instance_id)
+        self.assertTrue(span.duration >= 0)
+
+    def test_nested(self):
+        with tracing.span('prepare', self.instance):
+            with tracing.span('install'):
+                pass
+        tracing.flush()
+        self.assertEqual(
+            [('install', self.instance.pk), ('prepare', self.instance.pk)],
+            list(Span.objects.order_by('pk')
+                 .values_list('stage', 'instance')))
+
+    def test_no_owner(self):
+        with tracing.span('install'):
+            pass
+        self.assertEqual(0, tracing.flush())
+
+    def test_error(self):
+        def fail():
+            with tracing.span('boot', self.instance):
+                raise ValueError('no room')
+        self.assertRaises(ValueError, fail)
+        tracing.flush()
+        span = Span.objects.get()
+        self.assertEqual('error', span.outcome)
+        self.assertEqual('no room', span.message)
+
+    def test_single_insert(self):
+        for stage in ('keypair', 'boot', 'build'):
+            tracing.record(stage, 1.0, 2.0, instance=self.instance)
+        with self.assertNumQueries(1):
+            tracing.flush()
+        self.assertEqual(3, Span.objects.count())
+
+    def test_buffer_size(self):
+        with patch('dtrove.config.DTROVE_TRACE_BUFFER_SIZE', 2):
+            tracing.record('boot', 1.0, 2.0, instance=self.instance)
+            self.assertEqual(0, Span.objects.count())
+            tracing.record('build', 2.0, 3.0, instance=self.instance)
+            self.assertEqual(2, Span.objects.count())
+
+    def test_disabled(self):
+        with patch('dtrove.config.DTROVE_TRACE', False):
+            tracing.record('boot', 1.0, 2.0, instance=self.instance)
+        self.assertEqual(0, tracing.flush())
+
+    @patch('dtrove.tasks.PROVIDER')
+    def test_task(self, provider):
+        from dtrove.tasks import create_server
+        create_server.apply(args=(self.instance.pk,))
+        # Written when the task finished
+        self.assertEqual(['create_server'],
+                         list(Span.objects.values_list('stage', flat=True)))
+
+    def test_timeline(self):
+        other = create_instance(name='other', cluster=self.cluster,
+                                save=True)
+        tracing.record('boot', 100.0, 104.0, instance=self.instance)
+        tracing.record('boot', 101.0, 103.0, instance=other)
+        tracing.record('build', 104.0, 160.0, instance=self.instance)
+        tracing.record('build', 103.0, 130.0, tracing.ERROR, other, 'bad')
+        tracing.flush()
+
+        timeline = self.cluster.timeline()
+        self.assertEqual(60, timeline['duration'])
+        self.assertEqual({'count': 2, 'errors': 0, 'mean': 3.0, 'max': 4.0},
+                         timeline['stages']['boot'])
+        self.assertEqual(1, timeline['stages']['build']['errors'])
+        first, second = timeline['hosts']
+        self.assertEqual(self.instance.pk, first['instance'])
+        self.assertEqual(60, first['duration'])
+        self.assertEqual([('boot', 0, 4), ('build', 4, 56)],
+                         [(s['stage'], s['offset'], s['duration'])
+                          for s in first['spans']])
+        self.assertEqual('other', second['name'])
+        self.assertEqual(30, second['duration'])
+
+    def test_empty_timeline(self):
+        self.assertEqual([], self.cluster.timeline()['hosts'])
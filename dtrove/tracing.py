@@ -0,0 +1,146 @@
+"""
+Tracing
+=======
+
+Records how long each stage of a build takes as a
+:py:class:`dtrove.models.Span`, so the timeline of a cluster shows where
+the time went::
+
+    from dtrove import tracing
+
+    with tracing.span('prepare', instance):
+        with tracing.span('install'):
+            run('apt-get install -y mysql-server')
+
+A span without an instance belongs to the one of the span it is nested in.
+The spans are kept in memory and written with a single insert when a
+celery task finishes, or once
+:py:attr:`dtrove.config.DTROVE_TRACE_BUFFER_SIZE` of them are waiting.
+
+Stages recorded during a build:
+
+* `create_server`: The whole `create_server` task, which includes
+* `keypair` and `boot`: Uploading the ssh key and asking nova for a server
+* `build`: From the first status check until nova reports the server
+  active
+* `prepare`: The whole `prepare` task, which includes the steps of the
+  datastore manager like `plan`, `install`, `config` and `restart`
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from celery.signals import task_postrun, worker_process_shutdown
+from django.utils import timezone
+
+from dtrove import config
+
+OK = 'ok'
+ERROR = 'error'
+
+_BUFFER = []
+_LOCK = threading.Lock()
+_local = threading.local()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _datetime(seconds):
+    return datetime.utcfromtimestamp(seconds).replace(tzinfo=timezone.utc)
+
+
+def record(stage, started, ended, outcome=OK, instance=None, message=''):
+    """Buffer a finished span
+
+    :param str stage: Name of the stage
+    :param float started: Start time in seconds since the epoch
+    :param float ended: End time in seconds since the epoch
+    :param str outcome: `ok` or `error`
+    :param instance: The :py:class:`dtrove.models.Instance`, defaults to
+                     the one of the enclosing span
+    """
+    if not config.DTROVE_TRACE:
+        return
+    if instance is not None:
+        owner = (instance.cluster_id, instance.pk)
+    else:
+        stack = _stack()
+        if not stack:
+            return
+        owner = stack[-1]
+    if owner[0] is None:
+        # Not saved, there is no cluster to show it on
+        return
+    with _LOCK:
+        _BUFFER.append({
+            'cluster_id': owner[0],
+            'instance_id': owner[1],
+            'stage': stage,
+            'started': started,
+            'ended': ended,
+            'outcome': outcome,
+            'message': message[:255],
+        })
+        full = len(_BUFFER) >= config.DTROVE_TRACE_BUFFER_SIZE
+    if full:
+        flush()
+
+
+@contextmanager
+def span(stage, instance=None):
+    """Record how long the block takes, see :py:func:`record`"""
+    stack = _stack()
+    pushed = instance is not None
+    if pushed:
+        stack.append((instance.cluster_id, instance.pk))
+    started = time.time()
+    try:
+        yield
+    except Exception as exc:
+        record(stage, started, time.time(), ERROR, instance, str(exc))
+        raise
+    else:
+        record(stage, started, time.time(), OK, instance)
+    finally:
+        if pushed:
+            stack.pop()
+
+
+def flush():
+    """Write the buffered spans of this process to the database"""
+    from dtrove.models import Span
+
+    with _LOCK:
+        spans = list(_BUFFER)
+        del _BUFFER[:]
+    if not spans:
+        return 0
+    for values in spans:
+        values['started'] = _datetime(values['started'])
+        values['ended'] = _datetime(values['ended'])
+    Span.objects.bulk_create([Span(**values) for values in spans])
+    return len(spans)
+
+
+def clear():
+    """Drop the buffered spans"""
+    with _LOCK:
+        del _BUFFER[:]
+
+
+@task_postrun.connect
+def _flush_after_task(**kwargs):
+    flush()
+
+
+@worker_process_shutdown.connect
+def _flush_on_shutdown(**kwargs):
+    flush()
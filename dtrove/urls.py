@@ -8,6 +8,7 @@ from dtrove.forms import KeystoneForm
 urlpatterns = patterns(
     'dtrove.views',
     url(r'^api/', include('dtrove.api.urls')),
+    url(r'^metrics$', 'metrics'),
     url(r'^osauth/(?P<path>.*)', 'fake_os_auth'),
     url(r'^osnova/(?P<path>.*)', 'fake_os_nova'),
 )
@@ -1,13 +1,15 @@
 
+import copy
 import json
 import logging
-import uuid
+from datetime import datetime, timedelta
 
-from django.core.cache import caches
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-CACHE = caches['default']
+from dtrove import metrics as dtrove_metrics
+from dtrove.simulator import SIMULATOR
+
 LOG = logging.getLogger()
 
 SERVICE_CATALOG = {
@@ -44,83 +46,37 @@ SERVICE_CATALOG = {
     }
 }
 
-KEYPAIR = {
-    "keypair": {
-        "fingerprint": "1e:2c:9b:56:79:4b:45:77:f9:ca:7a:98:2c:b0:d5:3c",
-        "name": "keypair-dab428fe-6186-4a14-b3de-92131f76cd39",
-        "public_key": "ssh-rsa AAAAB3NzaC1yc2EAAAADAQsdHw== FAKE",
-        "user_id": "fake"
-    }
-}
-
 
 @csrf_exempt
 def fake_os_auth(request, path):
     LOG.error(request.POST)
-    return HttpResponse(json.dumps(SERVICE_CATALOG),
+    catalog = copy.deepcopy(SERVICE_CATALOG)
+    access = catalog['access']
+    # Point the compute endpoint at this server and hand out a fresh token
+    # so the clients don't immediately try to re-authenticate.
+    endpoint = access['serviceCatalog'][0]['endpoints'][0]
+    endpoint['publicURL'] = request.build_absolute_uri('/osnova/')
+    expires = datetime.utcnow() + timedelta(days=1)
+    access['token']['expires'] = expires.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return HttpResponse(json.dumps(catalog),
                         content_type="application/json")
 
 
 @csrf_exempt
 def fake_os_nova(request, path):
-    if 'keypair' in path:
-        return HttpResponse(json.dumps(KEYPAIR),
-                            content_type="application/json")
-    if 'servers' in path:
-        if request.method == 'POST':
-            server_id = str(uuid.uuid4())
-            server = {
-                "server": {
-                    "security_groups": [],
-                    "OS-DCF:diskConfig": "MANUAL",
-                    "id": server_id,
-                    "links": [],
-                    "adminPass": "aabbccddeeff"
-                }
-            }
+    body = json.loads(request.body) if request.body else None
+    response = SIMULATOR.handle(request.method, path, body,
+                                request.GET.dict())
+    content = ''
+    if response.body is not None:
+        content = json.dumps(response.body)
+    http_response = HttpResponse(content, status=response.status,
+                                 content_type="application/json")
+    for header, value in response.headers.items():
+        http_response[header] = value
+    return http_response
 
-            return HttpResponse(json.dumps(server),
-                                content_type="application/json")
-
-        elif request.method == 'GET':
-            _, server_id = path.split('/')
-            key = 'fake_server:%s' % server_id
-            # Make it appear to be building
-            progress = CACHE.get(key, 0)
-            if progress == 0:
-                CACHE.set(key, 0)
-            if progress < 100:
-                progress = CACHE.incr(key, 10)
-                status = 'BUILD'
-            else:
-                progress = 100
-                status = 'ACTIVE'
-
-            server = {
-                "server": {
-                    "accessIPv4": "10.0.0.3",
-                    "addresses": {},
-                    "created": "2012-08-20T21:11:09Z",
-                    "flavor": {
-                        "id": "1",
-                        "links": []
-                    },
-                    "hostId": "36",
-                    "id": server_id,
-                    "image": {
-                        "id": "70a599e0-31e7-49b7-b260-868f441e862b",
-                        "links": []
-                    },
-                    "links": [],
-                    "metadata": {},
-                    "name": "new-server-test",
-                    "progress": progress,
-                    "status": status,
-                    "tenant_id": "openstack",
-                    "updated": "2012-08-20T21:11:09Z",
-                    "user_id": "fake"
-                }
-            }
 
-            return HttpResponse(json.dumps(server),
-                                content_type="application/json")
+def metrics(request):
+    return HttpResponse(dtrove_metrics.render(),
+                        content_type='text/plain; version=0.0.4')